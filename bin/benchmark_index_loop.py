@@ -0,0 +1,310 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import re
+import sys
+import textwrap
+from time import time
+from collections import defaultdict
+from subprocess import check_output
+
+import click
+from twisted.internet import reactor, task
+from twisted.internet.defer import inlineCallbacks, returnValue as returnD, succeed, DeferredLock, DeferredList, CancelledError
+
+ROOT = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..")
+CORE = os.path.join("hyphe_backend", "core.tac")
+
+# Methods of Memory_Structure run by the index loop, the ones missing from
+# older revisions of the core are skipped
+LOOP_METHODS = ["index_batch_loop", "_index_batch_loop", "check_crashed_index_jobs", "index_batch", "get_index_batch_jobs", "cut_index_batch", "adapt_index_batch_size", "finish_index_batch", "finish_job_index_batch", "start_index_batch", "wait_index_bookkeeping", "prefetch_index_batch"]
+
+
+class Enum(set):
+    def __getattr__(self, name):
+        if name in self:
+            return name
+        raise AttributeError
+
+class QuietLogger(object):
+    def msg(self, *args, **kwargs):
+        pass
+
+
+class Latencies(object):
+
+    def __init__(self, mongo, queue_read, traph, traph_cost, batch):
+        self.mongo = mongo
+        self.queue_read = queue_read
+        self.traph = traph
+        self.traph_cost = traph_cost
+        self.batch = float(batch)
+
+    def later(self, delay, value=None):
+        return task.deferLater(reactor, delay, lambda: value)
+
+
+class FakeQueue(object):
+
+    def __init__(self, db):
+        self.db = db
+
+    def drop(self):
+        self.db.queue_items = []
+        return self.db.lat.later(self.db.lat.mongo)
+
+
+class FakeMongo(object):
+    # Jobs and crawl queue held in memory, each call answering after a
+    # fixed latency, reading the queue costing more with more pages
+
+    def __init__(self, lat, n_pages, n_jobs):
+        self.lat = lat
+        self.queue_items = []
+        self.jobs = {}
+        for j in range(n_jobs):
+            self.jobs["crawl%d" % j] = {"_id": "job%d" % j, "crawljob_id": "crawl%d" % j, "webentity_id": None, "crawl_arguments": {}, "crawling_status": "FINISHED", "indexing_status": "PENDING", "nb_pages": 0, "nb_links": 0}
+        for i in range(n_pages):
+            lru = "s:http|h:com|h:site%d|p:page%d|" % (i % 50, i)
+            links = ["s:http|h:com|h:site%d|p:page%d|" % ((i + k) % 50, (i * 7 + k) % n_pages) for k in range(10)]
+            self.queue_items.append({"_id": "q%06d" % i, "_job": "crawl%d" % (i * n_jobs // n_pages), "url": "http://site%d.com/page%d" % (i % 50, i), "lru": lru, "lrulinks": links, "nb_links": len(links), "depth": 1, "status": 200, "timestamp": i})
+
+    @staticmethod
+    def _match(doc, specs):
+        for key, cond in specs.items():
+            if isinstance(cond, dict):
+                if "$in" in cond and doc.get(key) not in cond["$in"]:
+                    return False
+                if "$nin" in cond and doc.get(key) in cond["$nin"]:
+                    return False
+                if "$ne" in cond and doc.get(key) == cond["$ne"]:
+                    return False
+            elif doc.get(key) != cond:
+                return False
+        return True
+
+    def _jobs_by_id(self, ids):
+        return [j for j in self.jobs.values() if j["_id"] in ids]
+
+    def list_jobs(self, corpus, specs={}, **kwargs):
+        res = [dict(j) for j in sorted(self.jobs.values(), key=lambda j: j["_id"]) if self._match(j, specs)]
+        if kwargs.get("limit"):
+            res = res[:kwargs["limit"]]
+        if res and kwargs.get("limit") == 1:
+            res = res[0]
+        return self.lat.later(self.lat.mongo, res)
+
+    def update_jobs(self, corpus, specs, modifs, **kwargs):
+        if isinstance(specs, dict):
+            jobs = [j for j in self.jobs.values() if self._match(j, specs)]
+        else:
+            jobs = self._jobs_by_id(specs if isinstance(specs, list) else [specs])
+        for job in jobs:
+            job.update(modifs)
+            for key, inc in kwargs.get("inc", {}).items():
+                job[key] = job.get(key, 0) + inc
+        return self.lat.later(self.lat.mongo)
+
+    def get_queue(self, corpus, specs={}, **kwargs):
+        res = [dict(p) for p in self.queue_items if self._match(p, specs)]
+        res = res[kwargs.get("skip", 0):]
+        if kwargs.get("limit"):
+            res = res[:kwargs["limit"]]
+        delay = self.lat.mongo + self.lat.queue_read * len(res) / self.lat.batch
+        if res and kwargs.get("limit") == 1:
+            res = res[0]
+        return self.lat.later(delay, res)
+
+    def count_queue(self, corpus, job, **kwargs):
+        return self.lat.later(self.lat.mongo, len([p for p in self.queue_items if p["_job"] == job]))
+
+    def clean_queue(self, corpus, specs, **kwargs):
+        ids = set(specs if isinstance(specs, list) else [specs])
+        self.queue_items = [p for p in self.queue_items if p["_id"] not in ids]
+        return self.lat.later(self.lat.mongo)
+
+    def queue(self, corpus):
+        return FakeQueue(self)
+
+    def count_pages(self, corpus, job, **kwargs):
+        return self.lat.later(self.lat.mongo, 0)
+
+    def count_pages_by_code(self, corpus, job, code, **kwargs):
+        return self.lat.later(self.lat.mongo, 0)
+
+    def check_pages(self, corpus):
+        return self.lat.later(self.lat.mongo, False)
+
+    def get_indexed_fingerprints(self, corpus, lrus, **kwargs):
+        return self.lat.later(self.lat.mongo, set())
+
+    def set_indexed_fingerprints(self, corpus, fingerprints, **kwargs):
+        return self.lat.later(self.lat.mongo)
+
+    def add_WEs(self, corpus, new_WEs):
+        return self.lat.later(self.lat.mongo, [])
+
+    def get_WEs(self, corpus, specs={}, **kwargs):
+        return self.lat.later(self.lat.mongo, [])
+
+    def add_log(self, corpus, job, msg, timestamp=None):
+        return self.lat.later(self.lat.mongo)
+
+
+class FakeTraphs(object):
+    # Indexing costs a fixed time per query plus a time per page
+
+    def __init__(self, lat):
+        self.lat = lat
+        self.indexed = defaultdict(int)
+
+    def call_links_deltas(self, corpus, method, pages, *args, **kwargs):
+        for lru in pages:
+            self.indexed[lru] += 1
+        groups = kwargs.get("groups", {})
+        return self.lat.later(self.lat.traph_cost + self.lat.traph * len(pages) / self.lat.batch, {
+          "code": "success",
+          "result": {
+            "nb_created_pages": len(pages),
+            "created_pages_by_group": dict((group, len(lrus)) for group, lrus in groups.items()),
+            "created_webentities": {},
+            "webentities_links": {},
+            "structural": True
+          }
+        })
+
+
+class FakeParent(object):
+
+    def corpus_ready(self, corpus):
+        return True
+
+    def update_corpus(self, *args, **kwargs):
+        return succeed(None)
+
+
+class FakeIndexer(object):
+
+    def acquire(self, corpus, oldest=0):
+        return succeed(None)
+
+    def release(self, corpus):
+        pass
+
+
+def read_core(revision):
+    if not revision:
+        with open(os.path.join(ROOT, CORE)) as f:
+            return f.read()
+    return check_output(["git", "show", "%s:%s" % (revision, CORE)], cwd=ROOT)
+
+def load_store(source, batch):
+    # The core is a twistd application file which cannot be imported, so
+    # the loop's methods are extracted from the Memory_Structure class
+    # and run against the fakes above
+    ns = {
+      "inlineCallbacks": inlineCallbacks,
+      "returnD": returnD,
+      "DeferredLock": DeferredLock,
+      "DeferredList": DeferredList,
+      "CancelledError": CancelledError,
+      "defaultdict": defaultdict,
+      "time": __import__("time"),
+      "randint": lambda a, b: 0,
+      "ObjectId": str,
+      "now_ts": lambda: int(time() * 1000),
+      "is_error": lambda res: isinstance(res, dict) and res.get("code") == "fail",
+      "logger": QuietLogger(),
+      "crawling_statuses": Enum(['UNCRAWLED', 'PENDING', 'RUNNING', 'FINISHED', 'CANCELED', 'RETRIED']),
+      "indexing_statuses": Enum(['UNINDEXED', 'PENDING', 'BATCH_RUNNING', 'BATCH_FINISHED', 'BATCH_CRASHED', 'FINISHED']),
+      "config": {"traph": {"max_simul_pages_indexing": batch, "max_simul_links_indexing": 50 * batch, "indexing_latency_budget": 5, "query_timeout": 600, "shared_transfer": True}},
+      "DEFAULT_CORPUS": "benchmark"
+    }
+    for constant in re.findall(r"^[A-Z_]+ = [^\n]+$", source, re.M):
+        exec(constant, ns)
+    body = source[source.index("class Memory_Structure"):]
+    methods = {}
+    for name in LOOP_METHODS:
+        match = re.search(r"(    (?:@inlineCallbacks\n    )?def %s\(.*?)(?=\n    @|\n    def |\n  # )" % name, body, re.S)
+        if match:
+            exec(textwrap.dedent(match.group(1)), ns)
+            methods[name] = ns[name]
+    return type("Store", (object,), methods), ns
+
+def build_corpus(lat, batch, n_pages):
+    return {
+      "loop_running": None,
+      "loop_running_since": 0,
+      "reset": False,
+      "recent_changes": 0,
+      "webentities_links": {},
+      "links_deltas": 0,
+      "links_duration": 1,
+      "last_links_loop": 0,
+      "last_index_loop": 0,
+      "last_crashed_jobs_check": 0,
+      "pages_queued": n_pages,
+      "total_webentities": 0,
+      "webentities_discovered": 0,
+      "index_prefetch": None,
+      "index_inflight": set(),
+      "index_bookkeeping": DeferredLock(),
+      "index_batch_size": {"pages": batch, "links": 50 * batch, "last": None}
+    }
+
+@inlineCallbacks
+def benchmark(revision, lat, n_pages, n_jobs, batch):
+    Store, ns = load_store(read_core(revision), batch)
+    store = Store()
+    store.db = FakeMongo(lat, n_pages, n_jobs)
+    store.traphs = FakeTraphs(lat)
+    store.parent = FakeParent()
+    store.indexer = FakeIndexer()
+    store.count_webentities = lambda corpus: lat.later(6 * lat.mongo)
+    store.corpora = {"benchmark": build_corpus(lat, batch, n_pages)}
+    interval = ns.get("INDEX_LOOP_INTERVAL", 0.05)
+    t0 = time()
+    ticks = 0
+    while store.db.queue_items:
+        yield store.index_batch_loop("benchmark")
+        ticks += 1
+        yield lat.later(interval)
+    if hasattr(store, "wait_index_bookkeeping"):
+        yield store.wait_index_bookkeeping("benchmark")
+    duration = time() - t0
+    indexed = store.traphs.indexed
+    counted = sum(j.get("nb_pages", 0) for j in store.db.jobs.values())
+    if len(indexed) != n_pages or any(n != 1 for n in indexed.values()) or counted != n_pages:
+        print >> sys.stderr, "ERROR: %s indexed %s distinct pages out of %s, %s more than once, %s accounted in jobs" % (revision or "working tree", len(indexed), n_pages, len([n for n in indexed.values() if n > 1]), counted)
+    returnD((duration, ticks))
+
+
+@click.command()
+@click.option('-r', '--revision', multiple=True, help="Git revision of the core to benchmark, several can be compared (defaults to the working tree)")
+@click.option('-p', '--pages', default=3000, type=int, show_default=True, help="Number of crawled pages in queue")
+@click.option('-j', '--jobs', default=1, type=int, show_default=True, help="Number of finished crawl jobs the queued pages are split among")
+@click.option('-b', '--batch', default=100, type=int, show_default=True, help="Maximum number of pages per indexing batch (max_simul_pages_indexing)")
+@click.option('--mongo-latency', default=0.004, type=float, show_default=True, help="Seconds taken by each Mongo call")
+@click.option('--queue-latency', default=0.03, type=float, show_default=True, help="Seconds taken to read a full batch of pages from the queue")
+@click.option('--traph-latency', default=0.08, type=float, show_default=True, help="Seconds taken by the traph to index a full batch of pages")
+@click.option('--traph-cost', default=0, type=float, show_default=True, help="Seconds taken by each traph indexing query whatever its size")
+def cli(revision, pages, jobs, batch, mongo_latency, queue_latency, traph_latency, traph_cost):
+    """Measure the throughput of the core's index loop on a crawl queue,
+    simulating Mongo and traph latencies."""
+    lat = Latencies(mongo_latency, queue_latency, traph_latency, traph_cost, batch)
+    print "Queue: %s pages from %s jobs, batches of %s pages, Mongo %sms per call, queue read %sms and traph %sms per full batch plus %sms per query" % (pages, jobs, batch, mongo_latency * 1000, queue_latency * 1000, traph_latency * 1000, traph_cost * 1000)
+    @inlineCallbacks
+    def run():
+        try:
+            for rev in (revision or [None]):
+                duration, ticks = yield benchmark(rev, lat, pages, jobs, batch)
+                print "%-16s %7.2fs  %4d ticks  %7.1f pages/s" % (rev or "working tree", duration, ticks, pages / duration)
+        finally:
+            reactor.stop()
+    reactor.callWhenRunning(run)
+    reactor.run()
+
+
+if __name__ == '__main__':
+    cli()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+from time import time
+from random import randint, seed
+
+import click
+from twisted.test.proto_helpers import StringTransport
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), ".."))
+from hyphe_backend.traph.framing import MsgPackReceiver, FRAMINGS
+
+
+class BenchmarkReceiver(MsgPackReceiver):
+
+    def __init__(self):
+        self.received = 0
+        self.errors = 0
+
+    def messageReceived(self, msg):
+        self.received += 1
+
+    def messageDecodingFailed(self, error, length):
+        self.errors += 1
+
+
+def build_links_payload(n_webentities, n_links):
+    # Same shape as get_webentities_inlinks answers: {target: {source: weight}}
+    seed(n_webentities)
+    links = {}
+    for _ in range(n_links):
+        target = randint(1, n_webentities)
+        source = randint(1, n_webentities)
+        if target not in links:
+            links[target] = {}
+        links[target][source] = links[target].get(source, 0) + randint(1, 50)
+    return {
+      "code": "success",
+      "result": links,
+      "query": {"method": "get_webentities_inlinks", "total_time": 0},
+      "id": 1
+    }
+
+
+def benchmark(framing, payload, n_messages, chunk_size):
+    sender = BenchmarkReceiver()
+    sender.makeConnection(StringTransport())
+    sender.setFraming(framing)
+    t0 = time()
+    for _ in range(n_messages):
+        sender.sendPacked(payload)
+    data = sender.transport.value()
+    encode_time = time() - t0
+
+    receiver = BenchmarkReceiver()
+    receiver.makeConnection(StringTransport())
+    receiver.setFraming(framing)
+    t0 = time()
+    for i in range(0, len(data), chunk_size):
+        receiver.dataReceived(data[i:i+chunk_size])
+    decode_time = time() - t0
+    if receiver.received != n_messages or receiver.errors:
+        print >> sys.stderr, "ERROR: %s framing decoded %s messages out of %s (%s errors)" % (framing, receiver.received, n_messages, receiver.errors)
+    return len(data), encode_time, decode_time
+
+
+@click.command()
+@click.option('-w', '--webentities', default=20000, type=int, show_default=True, help="Number of webentities in the synthetic links graph")
+@click.option('-l', '--links', default=500000, type=int, show_default=True, help="Number of webentity links in the synthetic links graph")
+@click.option('-m', '--messages', default=5, type=int, show_default=True, help="Number of messages to send for each framing")
+@click.option('-c', '--chunk-size', default=65536, type=int, show_default=True, help="Size of the chunks delivered to the receiver, as read from the socket")
+def cli(webentities, links, messages, chunk_size):
+    """Measure throughput of the traph socket framings on large links payloads."""
+    payload = build_links_payload(webentities, links)
+    print "Payload: %s webentities, %s links, %s messages read in %sB chunks" % (webentities, links, messages, chunk_size)
+    for framing in FRAMINGS:
+        size, encode_time, decode_time = benchmark(framing, payload, messages, chunk_size)
+        mbytes = size / 1024. / 1024
+        print "%-16s %8.1fMB  send %7.3fs (%7.1fMB/s)  receive %7.3fs (%7.1fMB/s, %6.1f msg/s)" % (framing, mbytes, encode_time, mbytes / encode_time, decode_time, mbytes / decode_time, messages / decode_time)
+
+
+if __name__ == '__main__':
+    cli()
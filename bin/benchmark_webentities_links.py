@@ -0,0 +1,372 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import re
+import imp
+import sys
+import json
+import textwrap
+from inspect import getargspec
+from itertools import compress
+from sys import getsizeof
+from time import time
+from subprocess import check_output
+from shutil import rmtree
+from tempfile import mkdtemp
+from array import array
+from random import choice, randint, seed
+from collections import defaultdict
+from multiprocessing import Process, Queue
+
+import click
+
+ROOT = os.path.join(os.path.dirname(os.path.realpath(__file__)), "..")
+LINKS = os.path.join("hyphe_backend", "lib", "webentitieslinks.py")
+CORE = os.path.join("hyphe_backend", "core.tac")
+
+sys.path.append(ROOT)
+from hyphe_backend.lib import webentitieslinks, centrality
+from hyphe_backend.lib.webentitieslinks import WebentitiesLinks, WebentitiesStatuses, STATUSES
+from hyphe_backend.lib.webentitiescatalog import WebentitiesCatalog
+from hyphe_backend.lib.centrality import _Graph, compute_centralities, pagerank, hits, in_strength, CENTRALITY_FIELDS
+
+
+def build_links_columns(n_webentities, n_links):
+    # Distinct random links between webentities as sources, targets and
+    # weights columns, as handed over by the traph
+    seed(n_webentities)
+    pairs = set()
+    while len(pairs) < n_links:
+        source, target = randint(1, n_webentities), randint(1, n_webentities)
+        if source != target:
+            pairs.add(source * (n_webentities + 1) + target)
+    sources = array("i", (pair // (n_webentities + 1) for pair in pairs))
+    targets = array("i", (pair % (n_webentities + 1) for pair in pairs))
+    weights = array("i", (randint(1, 50) for _ in xrange(n_links)))
+    return sources, targets, weights
+
+def build_links_dict(sources, targets, weights):
+    # Links as the core used to hold them: {target: {source: weight}}
+    links = {}
+    for source, target, weight in zip(sources, targets, weights):
+        if target not in links:
+            links[target] = {}
+        links[target][source] = weight
+    return links
+
+def rank_links_dict(links, kept=None):
+    # Degrees as the core used to compute them, counting only the links
+    # from the sources in kept when given
+    inlinks = defaultdict(set)
+    outlinks = defaultdict(set)
+    alllinks = defaultdict(set)
+    for target, sources in links.items():
+        for source in sources:
+            if kept is not None and source not in kept:
+                continue
+            if isinstance(source, int):
+                outlinks[source].add(target)
+                alllinks[source].add(target)
+                alllinks[target].add(source)
+                inlinks[target].add(source)
+    for target, sources in links.items():
+        sources["undirected_degree"] = len(alllinks[target])
+        sources["indegree"] = len(inlinks[target])
+        sources["outdegree"] = len(outlinks[target])
+
+def network_links_dict(links):
+    return [[source, target, weight] for target, sources in links.items() for source, weight in sources.items() if isinstance(source, int)]
+
+def dict_footprint(links):
+    # Memory held by the dicts and the ints they hold, in MB, leaving out
+    # the small ints shared by Python
+    size = getsizeof(links)
+    for target, sources in links.iteritems():
+        size += getsizeof(target) + getsizeof(sources)
+        size += sum(getsizeof(k) + (getsizeof(v) if v > 256 else 0) for k, v in sources.iteritems())
+    return size / 1024. ** 2
+
+def rows_footprint(links):
+    # Memory held by the columns, in MB
+    columns = [links.present, links.in_offsets, links.out_offsets, links.in_sources, links.in_weights, links.out_targets, links.out_weights, links.mutual or ""] + links.stats.values()
+    return sum(getsizeof(c) for c in columns) / 1024. ** 2
+
+def load_links_module(revision):
+    if not revision:
+        return webentitieslinks
+    module = imp.new_module("webentitieslinks_%s" % revision)
+    exec check_output(["git", "show", "%s:%s" % (revision, LINKS)], cwd=ROOT) in module.__dict__
+    return module
+
+def load_core_sorting(links):
+    # The core is a twistd application file which cannot be imported, so
+    # its sort methods are extracted from the Memory_Structure class and
+    # bound to a structure holding the links of a single corpus
+    with open(os.path.join(ROOT, CORE)) as f:
+        source = f.read()
+    ns = {
+      "re": re,
+      "CENTRALITY_FIELDS": CENTRALITY_FIELDS,
+      "DEFAULT_CORPUS": "benchmark",
+      "crawling_statuses": None
+    }
+    body = source[source.index("class Memory_Structure"):]
+    methods = {}
+    for name in ["re_camelCase", "format_field"]:
+        match = re.search(r"^    (%s = [^\n]+)$" % name, body, re.M)
+        exec(textwrap.dedent(match.group(1)), ns)
+        methods[name] = ns[name]
+    for name in ["sortargs_field", "sortargs_accessor"]:
+        match = re.search(r"(    def %s\(.*?)(?=\n    @|\n    def )" % name, body, re.S)
+        exec(textwrap.dedent(match.group(1)), ns)
+        methods[name] = ns[name]
+    core = type("Core", (object,), methods)()
+    core.corpora = {"benchmark": {"webentities_links": links}}
+    return core
+
+def run_steps(steps):
+    # Runs the steps of a generator meant for twisted's cooperate, returning
+    # the longest time spent without giving back to the reactor
+    longest = 0
+    t0 = time()
+    for _ in steps:
+        t1 = time()
+        longest = max(longest, t1 - t0)
+        t0 = t1
+    return max(longest, time() - t0)
+
+def count_iterations(function, *args):
+    # Returns the time taken by function and the number of iterations of
+    # the centralities, counted from their convergence checks, which do not
+    # depend on the load of the machine
+    distance = centrality._distance
+    iterations = [0]
+    def counted(a, b):
+        iterations[0] += 1
+        return distance(a, b)
+    centrality._distance = counted
+    try:
+        t0 = time()
+        res = function(*args)
+        return time() - t0, iterations[0], res
+    finally:
+        centrality._distance = distance
+
+def isolated(function, *args):
+    # Runs a measure in a child process so that the garbage of one
+    # structure or revision does not slow the next one down
+    results = Queue()
+    process = Process(target=lambda: results.put(function(*args)))
+    process.start()
+    res = results.get()
+    process.join()
+    return res
+
+
+def measure_structure(structure, n_webentities, n_links):
+    sources, targets, weights = build_links_columns(n_webentities, n_links)
+    # The dicts were built and ranked at once, freezing the reactor
+    # meanwhile, the rows are built and ranked by steps
+    t0 = time()
+    if structure == "dict":
+        links = build_links_dict(sources, targets, weights)
+        build_step = time() - t0
+    else:
+        links = WebentitiesLinks()
+        build_step = run_steps(links.build_from_columns(sources, targets, weights))
+    build_time = time() - t0
+    del sources, targets, weights
+    t0 = time()
+    if structure == "dict":
+        rank_links_dict(links)
+        rank_step = time() - t0
+    else:
+        rank_step = run_steps(links.rank_steps())
+    rank_time = time() - t0
+    t0 = time()
+    if structure == "dict":
+        network = network_links_dict(links)
+    else:
+        network = [[source, target, weight] for source, target, weight in links]
+    network_time = time() - t0
+    del network
+    memory = dict_footprint(links) if structure == "dict" else rows_footprint(links)
+    return build_time, build_step, rank_time, rank_step, network_time, memory
+
+def measure_rank(revision, sources, targets, weights, statuses):
+    module = load_links_module(revision)
+    links = module.WebentitiesLinks.from_columns(sources, targets, weights)
+    # Earlier revisions were given the ids of the kept webentities rather
+    # than a mask of their statuses
+    by_ids = getargspec(links.rank).args[1] == "keep"
+    times = []
+    for _ in xrange(2):
+        t0 = time()
+        mask = statuses.mask(["IN", "UNDECIDED"])
+        if by_ids:
+            mask = list(compress(xrange(len(mask)), mask))
+        links.rank(mask)
+        times.append(time() - t0)
+    t0 = time()
+    links.rank()
+    times.append(time() - t0)
+    return times
+
+
+@click.group()
+def cli():
+    """Measure the webentities links structures of the core on synthetic
+    links graphs."""
+    pass
+
+@cli.command()
+@click.option('-w', '--webentities', default=50000, type=int, show_default=True, help="Number of webentities in the synthetic links graph")
+@click.option('-l', '--links', default=1000000, type=int, show_default=True, help="Number of webentity links in the synthetic links graph")
+def structure(webentities, links):
+    """Compare the former dict of dicts with WebentitiesLinks' rows, with
+    the longest step of the build and rank in parentheses."""
+    print "Graph: %s webentities, %s links" % (webentities, links)
+    for name in ["dict", "rows"]:
+        build_time, build_step, rank_time, rank_step, network_time, memory = isolated(measure_structure, name, webentities, links)
+        print "%-5s  build %6.2fs (%5.2fs)  rank %6.2fs (%5.2fs)  network %6.2fs  memory %6.1fMB" % (name, build_time, build_step, rank_time, rank_step, network_time, memory)
+
+@cli.command()
+@click.option('-w', '--webentities', default=50000, type=int, show_default=True, help="Number of webentities in the synthetic links graph")
+@click.option('-l', '--links', default=1000000, type=int, show_default=True, help="Number of webentity links in the synthetic links graph")
+def cache(webentities, links):
+    """Compare the former JSON links cache with WebentitiesLinks' binary one."""
+    print "Graph: %s webentities, %s links" % (webentities, links)
+    sources, targets, weights = build_links_columns(webentities, links)
+    links_dict = build_links_dict(sources, targets, weights)
+    rank_links_dict(links_dict)
+    rows = WebentitiesLinks.from_columns(sources, targets, weights)
+    rows.rank()
+    directory = mkdtemp()
+    try:
+        path = os.path.join(directory, "links.json")
+        t0 = time()
+        with open(path, "w") as f:
+            json.dump(links_dict, f)
+        write_time = time() - t0
+        t0 = time()
+        with open(path) as f:
+            json.load(f, object_hook=lambda x: {(int(k) if k.isdigit() else k): v for k, v in x.items()})
+        load_time = time() - t0
+        print "json    write %6.2fs  load %6.2fs  size %6.1fMB" % (write_time, load_time, os.path.getsize(path) / 1024. ** 2)
+        path = os.path.join(directory, "links.bin")
+        t0 = time()
+        rows.save(path)
+        write_time = time() - t0
+        t0 = time()
+        loaded = WebentitiesLinks.load(path)
+        load_time = time() - t0
+        # Links columns are only read from the disk once accessed
+        t0 = time()
+        network = [[source, target, weight] for source, target, weight in loaded]
+        network_time = time() - t0
+        assert len(network) == links
+        print "binary  write %6.2fs  load %6.2fs  size %6.1fMB  (then network %.2fs)" % (write_time, load_time, os.path.getsize(path) / 1024. ** 2, network_time)
+    finally:
+        rmtree(directory)
+
+@cli.command()
+@click.option('-r', '--revision', multiple=True, help="Git revision of the webentities links to benchmark, several can be compared (defaults to the working tree)")
+@click.option('-w', '--webentities', default=200000, type=int, show_default=True, help="Number of webentities in the synthetic links graph")
+@click.option('-l', '--links', default=1000000, type=int, show_default=True, help="Number of webentity links in the synthetic links graph")
+def rank(revision, webentities, links):
+    """Compare the ranking of webentities between revisions, with and
+    without filtering out the links from OUT and DISCOVERED webentities."""
+    print "Graph: %s webentities, %s links" % (webentities, links)
+    sources, targets, weights = build_links_columns(webentities, links)
+    statuses = WebentitiesStatuses()
+    for weid in xrange(webentities + 1):
+        statuses.set(weid, choice(STATUSES))
+    for rev in (revision or [None]):
+        times = isolated(measure_rank, rev, sources, targets, weights, statuses)
+        print "%-12s  filtered %6.2fs  filtered again %6.2fs  unfiltered %6.2fs" % (rev or "working tree", times[0], times[1], times[2])
+
+@cli.command()
+@click.option('-w', '--webentities', default=200000, type=int, show_default=True, help="Number of webentities in the synthetic links graph")
+@click.option('-l', '--links', default=1000000, type=int, show_default=True, help="Number of webentity links in the synthetic links graph")
+def centralities(webentities, links):
+    """Measure the computation of the webentities centralities, filtered as
+    the degrees and unfiltered."""
+    print "Graph: %s webentities, %s links" % (webentities, links)
+    sources, targets, weights = build_links_columns(webentities, links)
+    statuses = WebentitiesStatuses()
+    for weid in xrange(webentities + 1):
+        statuses.set(weid, choice(STATUSES))
+    rows = WebentitiesLinks.from_columns(sources, targets, weights)
+    mask = statuses.mask(["IN", "UNDECIDED"])
+    results = {}
+    for variant, suffix, variant_mask in [("filtered", "", mask), ("unfiltered", "_unfiltered", None)]:
+        graph = _Graph()
+        t0 = time()
+        longest = run_steps(graph.build(rows, variant_mask))
+        times = [time() - t0]
+        scores = {}
+        iterations = []
+        for compute in [pagerank, hits, in_strength]:
+            # Steps are given back to the reactor by the core
+            duration, count, step = count_iterations(run_steps, compute(graph, scores, {}))
+            longest = max(longest, step)
+            times.append(duration)
+            iterations.append(count)
+        results.update((key + suffix, value) for key, value in scores.items())
+        print "%-10s  snapshot %5.2fs  pagerank %6.2fs (%3s it.)  hits %6.2fs (%3s it.)  in_strength %5.2fs  total %6.2fs  (longest step %.2fs)" % (variant, times[0], times[1], iterations[0], times[2], iterations[1], times[3], sum(times), longest)
+    # Runs following a few changes start from the previous results
+    new_links = links / 1000
+    for _ in xrange(new_links):
+        rows.add_link(randint(1, webentities), randint(1, webentities), 1)
+    duration, count, longest = count_iterations(run_steps, compute_centralities(rows, mask, {}, results))
+    print "both after %s new links, from the previous results: total %6.2fs (%3s it.)  (longest step %.2fs)" % (new_links, duration, count, longest)
+
+@cli.command()
+@click.option('-w', '--webentities', default=200000, type=int, show_default=True, help="Number of webentities in the synthetic corpus")
+@click.option('-l', '--links', default=1000000, type=int, show_default=True, help="Number of webentity links in the synthetic corpus")
+@click.option('-s', '--sort', multiple=True, default=["-indegree", "name"], show_default=True, help="Sort fields as given to get_webentities, several can be combined")
+def catalog(webentities, links, sort):
+    """Compare sorting the webentities documents one by one, as the core
+    used to, with sorting the webentities catalog's columns."""
+    print "Corpus: %s webentities, %s links, sorted by %s" % (webentities, links, " ".join(sort))
+    sources, targets, weights = build_links_columns(webentities, links)
+    rows = WebentitiesLinks.from_columns(sources, targets, weights)
+    rows.rank()
+    core = load_core_sorting(rows)
+    names = [u"alpha", u"Beta", u"gamma", u"delta", u"\xe9clair", u"Zed"]
+    WEs = []
+    webentities_catalog = WebentitiesCatalog()
+    for weid in xrange(1, webentities + 1):
+        WE = {
+          "_id": weid,
+          "name": u"%s %s" % (choice(names), randint(0, 1000)),
+          "status": choice(STATUSES),
+          "crawled": randint(0, 2) == 0,
+          "creationDate": randint(0, 10 ** 12),
+          "lastModificationDate": randint(0, 10 ** 12),
+          "prefixes": [],
+          "tags": {},
+          "homepage": None,
+          "startpages": []
+        }
+        WEs.append(WE)
+        webentities_catalog.update(WE)
+    webentities_catalog.loaded = True
+    t0 = time()
+    for sortkey in reversed(sort):
+        key = sortkey.lstrip("-")
+        if core.sortargs_accessor(WEs[0], key) != None:
+            WEs.sort(key=lambda x: core.format_field(core.sortargs_accessor(x, key)), reverse=(key != sortkey))
+    documents_time = time() - t0
+    t0 = time()
+    sortfields = [("-" if sortkey.startswith("-") else "") + core.sortargs_field(sortkey.lstrip("-")) for sortkey in sort]
+    ids = webentities_catalog.sorted_ids(sortfields, rows)
+    catalog_time = time() - t0
+    assert ids == [WE["_id"] for WE in WEs]
+    print "documents  %6.2fs" % documents_time
+    print "catalog    %6.2fs" % catalog_time
+
+
+if __name__ == '__main__':
+    cli()
@@ -28,6 +28,8 @@ The API will always answer as such:
 }
 \`\`\`
 
+Calls which only read data are canceled, along with the traph queries they still wait for, when their client closes the connection before getting the answer: \`get_webentity_by_lruprefix\`, \`get_webentity_by_lruprefix_as_url\`, \`get_webentity_for_url\`, \`get_webentity_for_url_as_lru\`, \`get_webentity_pages\`, \`paginate_webentity_pages\`, \`get_webentity_mostlinked_pages\`, \`get_webentity_subwebentities\`, \`get_webentity_parentwebentities\`, \`get_webentity_pagelinks_network\`, \`paginate_webentity_pagelinks_network\` and \`simulate_creationrules_for_lrus\`. All other calls keep running until their end, only their answer is dropped.
+
 
 ## Summary
 - [Default API commands (no namespace)](#default-api-commands-no-namespace)" > doc/api.md
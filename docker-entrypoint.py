@@ -51,6 +51,14 @@ if "HYPHE_OBEY_ROBOTS"          in environ: setConfig("obey_robots", strToBool(e
 if "HYPHE_TRAPH_KEEPALIVE"      in environ: setConfig("keepalive", int(environ["HYPHE_TRAPH_KEEPALIVE"]),configdata,"traph")
 if "HYPHE_TRAPH_DATAPATH"       in environ: setConfig("data_path", environ["HYPHE_TRAPH_DATAPATH"],configdata,"traph")
 if "HYPHE_TRAPH_MAX_SIM_PAGES"  in environ: setConfig("max_simul_pages_indexing", int(environ["HYPHE_TRAPH_MAX_SIM_PAGES"]),configdata,"traph")
+if "HYPHE_TRAPH_MAX_SIM_LINKS"  in environ: setConfig("max_simul_links_indexing", int(environ["HYPHE_TRAPH_MAX_SIM_LINKS"]),configdata,"traph")
+if "HYPHE_TRAPH_INDEXING_BUDGET" in environ: setConfig("indexing_latency_budget", int(environ["HYPHE_TRAPH_INDEXING_BUDGET"]),configdata,"traph")
+if "HYPHE_TRAPH_MAX_SIM_INDEXING" in environ: setConfig("max_simul_indexing", int(environ["HYPHE_TRAPH_MAX_SIM_INDEXING"]),configdata,"traph")
+if "HYPHE_TRAPH_CHUNK_SIZE"     in environ: setConfig("stream_chunk_size", int(environ["HYPHE_TRAPH_CHUNK_SIZE"]),configdata,"traph")
+if "HYPHE_TRAPH_POOL_SIZE"      in environ: setConfig("pool_size", int(environ["HYPHE_TRAPH_POOL_SIZE"]),configdata,"traph")
+if "HYPHE_TRAPH_MEMORY_BUDGET"  in environ: setConfig("memory_budget", int(environ["HYPHE_TRAPH_MEMORY_BUDGET"]),configdata,"traph")
+if "HYPHE_TRAPH_QUERY_TIMEOUT"  in environ: setConfig("query_timeout", int(environ["HYPHE_TRAPH_QUERY_TIMEOUT"]),configdata,"traph")
+if "HYPHE_TRAPH_SHARED_TRANSFER" in environ: setConfig("shared_transfer", strToBool(environ["HYPHE_TRAPH_SHARED_TRANSFER"]),configdata,"traph")
 
 if "HYPHE_DEFAULT_STARTPAGES_MODE"  in environ: setConfig("defaultStartpagesMode", literal_eval(environ["HYPHE_DEFAULT_STARTPAGES_MODE"]),configdata)
 if "HYPHE_DEFAULT_CREATION_RULE"    in environ: setConfig("defaultCreationRule", environ["HYPHE_DEFAULT_CREATION_RULE"],configdata)
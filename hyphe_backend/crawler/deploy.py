@@ -55,7 +55,7 @@ if corpus_conf:
 else:
     print "WARNING: trying to deploy a crawler for a corpus project missing in DB"
 # Copy Hyphe libraries from HCI lib/
-for f in ["urllru", "webarchives", "tlds"]:
+for f in ["urllru", "webarchives", "tlds", "queueitems"]:
     if verbose:
         print "Importing %s.py library from HCI hyphe_backend/lib to hcicrawler..." % f
     try:
@@ -12,6 +12,7 @@ class Page(Item):
     redirects_to = Field()
     body = Field()
     lrulinks = Field()
+    links_fingerprint = Field()
     archive_url = Field()
     archive_date_requested = Field()
     archive_date_obtained = Field()
@@ -4,10 +4,13 @@ from twisted.internet.defer import inlineCallbacks, returnValue
 from txmongo import MongoConnection, connection as mongo_connection
 mongo_connection._Connection.noisy = False
 from txmongo.filter import sort as mongosort, ASCENDING
+from bson.binary import Binary
 
+from hcicrawler.items import Page
 from hcicrawler.urllru import url_to_lru_clean, has_prefix
 from hcicrawler.tlds_tree import TLDS_TREE
 from hcicrawler.resolver import ResolverAgent
+from hcicrawler.queueitems import pack_queue_item, links_fingerprint
 
 
 class RemoveBody(object):
@@ -19,12 +22,13 @@ class RemoveBody(object):
 
 class MongoOutput(object):
 
-    def __init__(self, host, port, db, queue_col, page_col, jobid):
+    def __init__(self, host, port, db, queue_col, page_col, jobs_col, jobid):
         store = MongoConnection(host, port)[db]
         self.jobid = jobid
         self.pageStore = store[page_col]
         self.queueStore = store[queue_col]
         self.queueStore.create_index(mongosort(ASCENDING('_job')))
+        self.jobsStore = store[jobs_col]
 
     @classmethod
     def from_crawler(cls, crawler):
@@ -33,8 +37,17 @@ class MongoOutput(object):
         db = crawler.settings['MONGO_DB']
         queue_col = crawler.settings['MONGO_QUEUE_COL']
         page_col = crawler.settings['MONGO_PAGESTORE_COL']
+        jobs_col = crawler.settings['MONGO_JOBS_COL']
         jobid = crawler.settings['JOBID']
-        return cls(host, port, db, queue_col, page_col, jobid)
+        return cls(host, port, db, queue_col, page_col, jobs_col, jobid)
+
+    def count_in_job(self, counts, crawljob_id=None):
+        # Keeps the pages counters of a job up to date without counting the
+        # collections, the core reconciles them regularly anyway
+        counts = dict((k, v) for k, v in counts.items() if v)
+        if not counts:
+            return
+        return self.jobsStore.update_one({'crawljob_id': crawljob_id or self.jobid}, {'$inc': counts})
 
 
 class OutputQueue(MongoOutput):
@@ -43,18 +56,43 @@ class OutputQueue(MongoOutput):
     def process_item(self, item, spider):
         d = dict(item)
         d['_job'] = self.jobid
+        # Links are stored front-coded in a msgpack blob unpacked by the core
+        d = pack_queue_item(d)
+        d['page'] = Binary(d['page'])
         yield self.queueStore.insert(d, safe=True)
+        yield self.count_in_job({'nb_unindexed_pages': 1})
         returnValue(item)
 
 class OutputStore(MongoOutput):
 
     @inlineCallbacks
     def process_item(self, item, spider):
+        item['links_fingerprint'] = links_fingerprint(item.get('lrulinks'))
         d = dict(item)
-        d['_id'] = "%s/%s" % (item['lru'], item['size'])
         d['_job'] = self.jobid
         d['forgotten'] = False
-        yield self.pageStore.update({'_id': d['_id']}, d, upsert=True, safe=True)
+        # Fields left over from the page's previous crawl are dropped, but
+        # not the fingerprint of the links already indexed by the core
+        update = {'$set': d}
+        unset = dict((k, "") for k in Page.fields if k not in d)
+        if unset:
+            update['$unset'] = unset
+        old = yield self.pageStore.find_one_and_update({'_id': "%s/%s" % (item['lru'], item['size'])}, update, projection=['_job', 'forgotten', 'status'], upsert=True)
+        counts = {
+          'nb_crawled_pages': 1,
+          'nb_crawled_pages_200': int(d.get('status') == 200)
+        }
+        # A page crawled again moves from its previous job to this one
+        if old and not old.get('forgotten'):
+            old_counts = {
+              'nb_crawled_pages': -1,
+              'nb_crawled_pages_200': -int(old.get('status') == 200)
+            }
+            if old.get('_job') == self.jobid:
+                counts = dict((k, v + old_counts[k]) for k, v in counts.items())
+            else:
+                yield self.count_in_job(old_counts, old.get('_job'))
+        yield self.count_in_job(counts)
         returnValue(item)
 
 
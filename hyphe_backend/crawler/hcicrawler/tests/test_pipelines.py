@@ -0,0 +1,64 @@
+import unittest
+from twisted.internet.defer import succeed
+from hcicrawler.items import Page
+from hcicrawler.pipelines import OutputStore
+
+
+class FakeCollection(object):
+
+    def __init__(self, old=None):
+        self.old = old
+        self.updates = []
+
+    def find_one_and_update(self, spec, update, **kwargs):
+        self.updates.append((spec, update, kwargs))
+        return succeed(self.old)
+
+    def update_one(self, spec, update):
+        self.updates.append((spec, update))
+        return succeed(None)
+
+
+class OutputStoreTest(unittest.TestCase):
+
+    def store(self, old=None):
+        store = OutputStore.__new__(OutputStore)
+        store.jobid = 'JOBID'
+        store.pageStore = FakeCollection(old)
+        store.jobsStore = FakeCollection()
+        return store
+
+    def crawl(self, store, status=200):
+        item = Page(url='http://example.com/', lru='s:http|h:com|h:example|', size=10, status=status, lrulinks=['s:http|h:com|h:example|p:a|'])
+        store.process_item(item, None)
+        return dict((spec['crawljob_id'], update['$inc']) for spec, update in store.jobsStore.updates)
+
+    def test_new_page(self):
+        store = self.store()
+        self.assertEqual(self.crawl(store), {'JOBID': {'nb_crawled_pages': 1, 'nb_crawled_pages_200': 1}})
+        spec, update, kwargs = store.pageStore.updates[0]
+        self.assertEqual(spec, {'_id': 's:http|h:com|h:example|/10'})
+        self.assertTrue(kwargs['upsert'])
+        # The links already indexed by the core are left alone, the fields
+        # missing from the new crawl are dropped
+        self.assertFalse('indexed_fingerprint' in update['$set'])
+        self.assertFalse('indexed_fingerprint' in update['$unset'])
+        self.assertTrue('error' in update['$unset'])
+        self.assertFalse(update['$set']['forgotten'])
+
+    def test_page_moving_from_another_job(self):
+        store = self.store({'_job': 'OLDJOB', 'forgotten': False, 'status': 404})
+        self.assertEqual(self.crawl(store), {
+          'OLDJOB': {'nb_crawled_pages': -1},
+          'JOBID': {'nb_crawled_pages': 1, 'nb_crawled_pages_200': 1}
+        })
+
+    def test_page_crawled_again_by_the_same_job(self):
+        store = self.store({'_job': 'JOBID', 'forgotten': False, 'status': 200})
+        self.assertEqual(self.crawl(store, status=500), {'JOBID': {'nb_crawled_pages_200': -1}})
+        store = self.store({'_job': 'JOBID', 'forgotten': False, 'status': 200})
+        self.assertEqual(self.crawl(store), {})
+
+    def test_forgotten_page(self):
+        store = self.store({'_job': 'OLDJOB', 'forgotten': True, 'status': 200})
+        self.assertEqual(self.crawl(store, status=301), {'JOBID': {'nb_crawled_pages': 1}})
@@ -0,0 +1,188 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from array import array
+from itertools import compress, imap, izip, izip_longest
+from operator import and_, mul, sub
+
+# Centralities of the webentities computed in the background from their
+# links, each one for the links filtered as for the degrees and for all
+# links (suffixed with "_unfiltered")
+CENTRALITIES = ["pagerank", "hits_authority", "hits_hub", "in_strength"]
+VARIANTS = ["", "_unfiltered"]
+CENTRALITY_FIELDS = [key + variant for variant in VARIANTS for key in CENTRALITIES]
+DAMPING = 0.85
+MAX_ITERATIONS = 100
+TOLERANCE = 1e-6
+# HITS converges slowly on sparse graphs, such as the links from a part of
+# the webentities only. Once the distances between iterations decrease by
+# a steady ratio, within that relative difference, the scores are carried
+# on to the limit they converge to.
+STEADY_RATIO = 0.01
+# Numbers of webentities and links processed between two steps given back
+# to the reactor
+STEP = 10000
+LINKS_STEP = 100000
+
+
+class _Graph(object):
+    # Snapshot of the links columns, so that links added from indexing
+    # batches meanwhile do not get in the way, restricted to the links from
+    # the webentities flagged in mask, with the slices of each webentity's
+    # inlinks and outlinks
+
+    def build(self, links, mask):
+        for step in links.compact_steps():
+            yield step
+        n = self.n = links.size
+        self.present = links.present[:n]
+        # Flags the webentities whose outlinks are counted
+        self.kept = bytearray([1]) * n
+        if mask is not None:
+            self.kept = mask[:n] + bytearray(max(0, n - len(mask)))
+        in_offsets, in_sources, in_weights = links.in_offsets, links.in_sources, links.in_weights
+        out_offsets, out_targets = links.out_offsets, links.out_targets
+        self.in_sources = in_sources if mask is None else array("i")
+        self.in_weights = in_weights if mask is None else array("i")
+        self.out_targets = out_targets if mask is None else array("i")
+        self.in_slices = []
+        self.out_slices = []
+        for i in xrange(0, n, STEP):
+            for weid in xrange(i, min(n, i + STEP)):
+                a, b = in_offsets[weid], in_offsets[weid + 1]
+                c, d = out_offsets[weid], out_offsets[weid + 1]
+                if mask is not None:
+                    start = len(self.in_sources)
+                    if a != b:
+                        kept = bytearray(imap(self.kept.__getitem__, in_sources[a:b]))
+                        self.in_sources.extend(compress(in_sources[a:b], kept))
+                        self.in_weights.extend(compress(in_weights[a:b], kept))
+                    a, b = start, len(self.in_sources)
+                    start = len(self.out_targets)
+                    if self.kept[weid]:
+                        self.out_targets.extend(out_targets[c:d])
+                    c, d = start, len(self.out_targets)
+                self.in_slices.append(slice(a, b))
+                self.out_slices.append(slice(c, d))
+            yield
+
+
+def _sums(values, indexes, slices, results):
+    # Appends to results the sum of the values found at the indexes within
+    # each slice, all loops running in C
+    gathered = []
+    for i in xrange(0, len(indexes), LINKS_STEP):
+        gathered.extend(imap(values.__getitem__, indexes[i:i + LINKS_STEP]))
+        yield
+    for i in xrange(0, len(slices), STEP):
+        results.extend(imap(sum, imap(gathered.__getitem__, slices[i:i + STEP])))
+        yield
+
+
+def _normalized(values):
+    total = sum(values)
+    if not total:
+        return values
+    return array("d", [v / total for v in values])
+
+
+def _distance(a, b):
+    return sum(imap(abs, imap(sub, a, b)))
+
+
+def _extrapolated(scores, previous_scores, ratio):
+    # Limit of scores whose differences decrease geometrically by ratio
+    k = ratio / (1 - ratio)
+    return _normalized(array("d", [max(0., s + (s - p) * k) for s, p in izip(scores, previous_scores)]))
+
+
+def _start(previous, flags):
+    # Returns scores summing to 1 over the flagged webentities, uniform or
+    # the previous ones when given, so that a run following a few changes
+    # converges within a few iterations. Webentities without a previous
+    # score get the uniform one so that none is left out.
+    uniform = 1. / (flags.count(b"\x01") or 1)
+    if previous is None or not any(compress(previous, flags)):
+        return array("d", [uniform if f else 0 for f in flags])
+    return _normalized(array("d", [(s or uniform) if f else 0 for s, f in izip_longest(previous[:len(flags)], flags, fillvalue=0)]))
+
+
+def pagerank(graph, results, previous):
+    n_present = graph.present.count(b"\x01") or 1
+    teleport = array("d", [(1 - DAMPING) / n_present if p else 0 for p in graph.present])
+    scores = _start(previous.get("pagerank"), graph.present)
+    inverse_outdegree = array("d", [1. / (s.stop - s.start) if s.stop > s.start else 0 for s in graph.out_slices])
+    dangling = bytearray(p and not o for p, o in izip(graph.present, inverse_outdegree))
+    for _ in xrange(MAX_ITERATIONS):
+        shares = array("d", imap(mul, scores, inverse_outdegree))
+        received = array("d")
+        for step in _sums(shares, graph.in_sources, graph.in_slices, received):
+            yield step
+        # Webentities without outlinks spread their score to all others
+        spread = sum(compress(scores, dangling)) / n_present
+        new_scores = array("d", [t + DAMPING * (spread + r) if p else 0 for t, r, p in izip(teleport, received, graph.present)])
+        converged = _distance(new_scores, scores) < TOLERANCE
+        scores = new_scores
+        if converged:
+            break
+    results["pagerank"] = scores
+
+
+def hits(graph, results, previous):
+    # Hubs of the webentities whose outlinks are not counted stay at 0
+    hubs = _start(previous.get("hits_hub"), bytearray(imap(and_, graph.present, graph.kept)))
+    authorities = array("d", [0]) * graph.n
+    distances = []
+    for _ in xrange(MAX_ITERATIONS):
+        new_authorities = array("d")
+        for step in _sums(hubs, graph.in_sources, graph.in_slices, new_authorities):
+            yield step
+        new_authorities = _normalized(new_authorities)
+        new_hubs = array("d")
+        for step in _sums(new_authorities, graph.out_targets, graph.out_slices, new_hubs):
+            yield step
+        new_hubs = _normalized(new_hubs)
+        distances.append(_distance(new_hubs, hubs))
+        converged = distances[-1] < TOLERANCE
+        if not converged and len(distances) >= 3:
+            ratio = distances[-1] / distances[-2]
+            if ratio < 1 and abs(distances[-2] / distances[-3] - ratio) < STEADY_RATIO * ratio:
+                new_hubs = _extrapolated(new_hubs, hubs, ratio)
+                distances = []
+        hubs, authorities = new_hubs, new_authorities
+        if converged:
+            break
+    results["hits_authority"] = authorities
+    results["hits_hub"] = hubs
+
+
+def in_strength(graph, results, previous):
+    weights = list(graph.in_weights)
+    strengths = array("d")
+    for i in xrange(0, graph.n, STEP):
+        strengths.extend(imap(sum, imap(weights.__getitem__, graph.in_slices[i:i + STEP])))
+        yield
+    results["in_strength"] = strengths
+
+
+def compute_centralities(links, mask, results, previous={}):
+    # Fills results with the centralities of all webentities, the filtered
+    # ones only counting the outlinks of the webentities flagged in mask
+    # (as given by WebentitiesStatuses.mask), starting from the previous
+    # results when given. Meant to be run cooperatively with
+    # twisted.internet.task.cooperate.
+    for variant, variant_mask in zip(VARIANTS, [mask, None]):
+        if variant and mask is None:
+            for key in CENTRALITIES:
+                results[key + variant] = results[key]
+            continue
+        graph = _Graph()
+        for step in graph.build(links, variant_mask):
+            yield step
+        start = dict((key, previous.get(key + variant)) for key in CENTRALITIES)
+        scores = {}
+        for compute in [pagerank, hits, in_strength]:
+            for step in compute(graph, scores, start):
+                yield step
+        for key in CENTRALITIES:
+            results[key + variant] = scores[key]
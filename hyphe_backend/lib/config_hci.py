@@ -44,6 +44,25 @@ def load_config():
             if missing_key not in conf['mongo-scrapy']:
                 conf['mongo-scrapy'][missing_key] = False
 
+  # Set default advanced traph settings if missing
+    if "traph" in conf:
+        if "stream_chunk_size" not in conf["traph"]:
+            conf["traph"]["stream_chunk_size"] = 10000
+        if "pool_size" not in conf["traph"]:
+            conf["traph"]["pool_size"] = 0
+        if "memory_budget" not in conf["traph"]:
+            conf["traph"]["memory_budget"] = 0
+        if "query_timeout" not in conf["traph"]:
+            conf["traph"]["query_timeout"] = 600
+        if "shared_transfer" not in conf["traph"]:
+            conf["traph"]["shared_transfer"] = True
+        if "max_simul_links_indexing" not in conf["traph"]:
+            conf["traph"]["max_simul_links_indexing"] = 50000
+        if "indexing_latency_budget" not in conf["traph"]:
+            conf["traph"]["indexing_latency_budget"] = 5
+        if "max_simul_indexing" not in conf["traph"]:
+            conf["traph"]["max_simul_indexing"] = 0
+
   # Set default creation rules if missing
     if "defaultCreationRule" not in conf:
         conf["defaultCreationRule"] = "domain"
@@ -106,9 +125,10 @@ GLOBAL_CONF_SCHEMA = {
     }
   }, "traph": {
     "type": dict,
-    "int_fields": ["keepalive", "max_simul_pages_indexing"],
+    "int_fields": ["keepalive", "max_simul_pages_indexing", "stream_chunk_size", "pool_size", "memory_budget", "query_timeout", "max_simul_links_indexing", "indexing_latency_budget", "max_simul_indexing"],
     "extra_fields": {
-      "data_path": "path"
+      "data_path": "path",
+      "shared_transfer": bool
     }
   }, "core_api_port": {
     "type": int
@@ -17,6 +17,15 @@ and avoid crashes on logging encoded strings
 
 """
 
+def readonly(function):
+    """Flags a JSON-RPC method which does not modify anything, so that it
+    can be canceled when its HTTP client gives up, other methods always run
+    until their end. Cached values refreshed from what a flagged method
+    read must be set without waiting on anything, so that canceling it
+    never leaves them halfway"""
+    function.readonly = True
+    return function
+
 class customJSONRPC(JSONRPC):
     def __init__(self, open_cors=False, debug=0):
         self.open_cors = open_cors
@@ -100,11 +109,21 @@ class customJSONRPC(JSONRPC):
             d.addCallback(self._cbRender, request, id, version)
 
             def _responseFailed(err, call):
+                # The client gave up: canceling a read-only call also cancels
+                # the traph queries it still waits for, queued or running,
+                # other calls finish without rendering their answer
+                request._aborted = True
+                if not getattr(function, "readonly", False):
+                    return
+                if self.debug:
+                    self.safe_log("%s: connection lost, canceling query" % functionPath, "DEBUG - QUERY%s" % from_ip)
                 call.cancel()
             request.notifyFinish().addErrback(_responseFailed, d)
         return server.NOT_DONE_YET
 
     def _cbRender(self, result, request, id, version):
+        if getattr(request, "_aborted", False):
+            return
         if self.debug == 2:
             request.content.seek(0, 0)
             content = request.content.read()
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from twisted.python import log as logger
+from twisted.internet import reactor
+from twisted.internet.defer import maybeDeferred
+
+
+class BackoffLoopingCall(object):
+    """Calls f repeatedly like a LoopingCall, but waits twice longer after
+    each call which reported having nothing to do, up to max_interval, and
+    can be woken up to run again right away when new work comes in"""
+
+    def __init__(self, f, *args, **kwargs):
+        self.f = f
+        self.args = args
+        self.kwargs = kwargs
+        self.running = False
+        self.interval = None
+        self.max_interval = None
+        self.delay = None
+        self.call = None
+        self.calling = False
+        self.woken = False
+
+    def start(self, interval, max_interval=None, now=True):
+        assert not self.running, "Tried to start an already running BackoffLoopingCall"
+        self.running = True
+        self.interval = interval
+        self.max_interval = max(interval, max_interval or interval)
+        self.delay = interval
+        self._schedule(0 if now else interval)
+
+    def stop(self):
+        assert self.running, "Tried to stop a BackoffLoopingCall that was not running"
+        self.running = False
+        if self.call and self.call.active():
+            self.call.cancel()
+        self.call = None
+
+    def wake(self):
+        # Runs the next call as soon as possible with the shortest interval
+        if not self.running:
+            return
+        self.delay = self.interval
+        if self.calling:
+            self.woken = True
+        elif self.call and self.call.active():
+            self.call.reset(0)
+
+    def _schedule(self, delay):
+        self.call = reactor.callLater(delay, self._call)
+
+    def _call(self):
+        self.call = None
+        self.calling = True
+        self.woken = False
+        d = maybeDeferred(self.f, *self.args, **self.kwargs)
+        d.addCallback(self._called)
+        d.addErrback(self._failed)
+
+    def _called(self, busy):
+        self.calling = False
+        if not self.running:
+            return
+        if busy or self.woken:
+            self.delay = self.interval
+        else:
+            self.delay = min(self.delay * 2, self.max_interval)
+        self._schedule(self.delay)
+
+    def _failed(self, failure):
+        # Stops looping like a LoopingCall would
+        self.calling = False
+        self.running = False
+        logger.err(failure)
@@ -10,9 +10,11 @@ from txmongo import MongoConnection, connection as mongo_connection
 mongo_connection._Pinger.noisy = False
 mongo_connection._Connection.noisy = False
 from txmongo.filter import TEXT as textIndex, sort as mongosort, ASCENDING, DESCENDING
+from pymongo import UpdateMany
 from pymongo.errors import OperationFailure
 from bson import ObjectId
 from hyphe_backend.lib.urllru import name_lru
+from hyphe_backend.lib.queueitems import QueueItem
 from hyphe_backend.lib.utils import crawling_statuses, indexing_statuses, salt, now_ts
 from hyphe_backend.lib.creationrules import getName as name_creationrule
 
@@ -236,8 +238,10 @@ class MongoDB(object):
     @inlineCallbacks
     def add_WEs(self, corpus, new_WEs):
         if not new_WEs:
-            returnD(None)
-        yield self.WEs(corpus).insert_many([self.new_WE(weid, prefixes) for weid, prefixes in new_WEs.items()])
+            returnD([])
+        WEs = [self.new_WE(weid, prefixes) for weid, prefixes in new_WEs.items()]
+        yield self.WEs(corpus).insert_many(WEs)
+        returnD(WEs)
 
     @inlineCallbacks
     def upsert_WE(self, corpus, weid, metas, update_timestamp=True):
@@ -365,6 +369,22 @@ class MongoDB(object):
     def forget_pages(self, corpus, job, urls, **kwargs):
         yield self.pages(corpus).update_many({"_job": job, "url": {"$in": urls}}, {"$set": {"forgotten": True}}, **kwargs)
 
+    @inlineCallbacks
+    def get_indexed_fingerprints(self, corpus, lrus, **kwargs):
+        # Returns the (lru, fingerprint) of the links sets already indexed
+        res = yield self.pages(corpus).find({"lru": {"$in": lrus}, "indexed_fingerprint": {"$exists": True}}, projection=["lru", "indexed_fingerprint"], **kwargs)
+        returnD(set((p["lru"], p["indexed_fingerprint"]) for p in res))
+
+    @inlineCallbacks
+    def set_indexed_fingerprints(self, corpus, fingerprints, **kwargs):
+        if not fingerprints:
+            returnD(None)
+        yield self.pages(corpus).bulk_write([UpdateMany({"lru": lru, "links_fingerprint": fp}, {"$set": {"indexed_fingerprint": fp}}) for lru, fp in fingerprints], ordered=False, **kwargs)
+
+    @inlineCallbacks
+    def forget_indexed_fingerprints(self, corpus, **kwargs):
+        yield self.pages(corpus).update_many({"indexed_fingerprint": {"$exists": True}}, {"$unset": {"indexed_fingerprint": ""}}, **kwargs)
+
     @inlineCallbacks
     def count_pages(self, corpus, job, **kwargs):
         tot = yield self.pages(corpus).count({"_job": job, "forgotten": False}, **kwargs)
@@ -404,17 +424,33 @@ class MongoDB(object):
         returnD(result)
 
     @inlineCallbacks
-    def update_job_pages(self, corpus, job_id):
-        crawled_pages = yield self.count_pages(corpus, job_id)
-        success_pages = yield self.count_pages_by_code(corpus, job_id, 200)
-        unindexed_pages = yield self.count_queue(corpus, job_id)
-        yield self.update_jobs(corpus, {"crawljob_id": job_id}, {'nb_crawled_pages': crawled_pages, 'nb_crawled_pages_200': success_pages, 'nb_unindexed_pages': unindexed_pages})
+    def update_job_pages(self, corpus, job_id, retries=3):
+        # Recounts the pages counters of a job, otherwise incremented by
+        # the crawler and the indexer: the counts are only set if no
+        # increment happened while counting, otherwise they are counted
+        # again, and left to the next recount after a few tries
+        counters = ['nb_crawled_pages', 'nb_crawled_pages_200', 'nb_unindexed_pages']
+        for _ in range(retries):
+            job = yield self.jobs(corpus).find_one({"crawljob_id": job_id}, projection=counters)
+            if not job:
+                returnD(False)
+            crawled_pages = yield self.count_pages(corpus, job_id)
+            success_pages = yield self.count_pages_by_code(corpus, job_id, 200)
+            unindexed_pages = yield self.count_queue(corpus, job_id)
+            specs = {"crawljob_id": job_id}
+            for key in counters:
+                specs[key] = job.get(key)
+            res = yield self.jobs(corpus).update_one(specs, {"$set": {'nb_crawled_pages': crawled_pages, 'nb_crawled_pages_200': success_pages, 'nb_unindexed_pages': unindexed_pages}})
+            if res.matched_count:
+                returnD(True)
+        returnD(False)
 
     @inlineCallbacks
     def get_queue(self, corpus, specs={}, **kwargs):
         if "sort" not in kwargs:
             kwargs["sort"] = sortasc('timestamp')
         res = yield self.queue(corpus).find(specs, **kwargs)
+        res = [QueueItem(r) for r in res]
         if res and "limit" in kwargs and kwargs["limit"] == 1:
             res = res[0]
         returnD(res)
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+# Compact format of the crawled pages stored by the crawler in the queue
+# collection for the core to index them (this file is copied within the
+# crawler at deploy time).
+#
+# Besides the fields used to query the queue (_job, timestamp, url, lru and
+# the fingerprint of its links) and the number of links, a queue item holds
+# its page as a msgpack blob:
+#   [version, stems, lrus, metas]
+# - stems lists the distinct stems ("s:http", "h:com", ...) of the page's
+#   LRU and its links, in order of appearance;
+# - lrus holds the page's LRU followed by its links, each one as a list of
+#   the number of leading stems it shares with the previous LRU, followed by
+#   the indexes of its other stems;
+# - metas holds the page's other fields (status, depth, encoding, ...).
+# Links mostly share long prefixes with the previous one, so they shrink
+# to a few small integers.
+
+import msgpack
+from hashlib import md5
+
+QUEUE_ITEM_VERSION = 1
+QUEUE_FIELDS = ["_job", "timestamp", "url", "lru", "links_fingerprint"]
+
+
+def _encode(value):
+    if isinstance(value, unicode):
+        return value.encode("utf-8")
+    return value
+
+def _decode(value):
+    if isinstance(value, str):
+        return value.decode("utf-8")
+    return value
+
+def links_fingerprint(lrulinks):
+    # Identifies the set of links of a page whatever their order
+    links = sorted(set(_encode(lru) for lru in lrulinks or []))
+    return md5("\n".join(links)).hexdigest()
+
+def pack_queue_item(page):
+    stems_index = {}
+    stems = []
+    lrus = []
+    previous = []
+    for lru in [page["lru"]] + list(page.get("lrulinks") or []):
+        lru_stems = _encode(lru).split("|")
+        shared = 0
+        while shared < min(len(previous), len(lru_stems)) and previous[shared] == lru_stems[shared]:
+            shared += 1
+        coded = [shared]
+        for stem in lru_stems[shared:]:
+            if stem not in stems_index:
+                stems_index[stem] = len(stems)
+                stems.append(stem)
+            coded.append(stems_index[stem])
+        lrus.append(coded)
+        previous = lru_stems
+    metas = dict((_encode(k), _encode(v)) for k, v in page.items() if k not in ["lru", "lrulinks", "body"] + QUEUE_FIELDS)
+    item = dict((k, page.get(k)) for k in QUEUE_FIELDS)
+    item["nb_links"] = len(lrus) - 1
+    item["page"] = msgpack.packb([QUEUE_ITEM_VERSION, stems, lrus, metas])
+    return item
+
+def unpack_queue_page(blob):
+    version, stems, lrus, metas = msgpack.unpackb(blob)
+    if version != QUEUE_ITEM_VERSION:
+        raise ValueError("Unsupported queue item version %s" % version)
+    stems = [_decode(s) for s in stems]
+    decoded = []
+    previous = []
+    for coded in lrus:
+        lru_stems = previous[:coded[0]] + [stems[i] for i in coded[1:]]
+        decoded.append(u"|".join(lru_stems))
+        previous = lru_stems
+    page = dict((_decode(k), _decode(v)) for k, v in metas.items())
+    page["lru"] = decoded[0]
+    page["lrulinks"] = decoded[1:]
+    return page
+
+
+class QueueItem(dict):
+    """Queue item from Mongo only unpacking its page's LRU, links and metas
+    on the first access to one of them"""
+
+    def __init__(self, doc):
+        dict.__init__(self, doc)
+        self.packed = self.pop("page", None)
+        # Items queued by crawlers deployed before the compact format
+        if self.packed is None and "nb_links" not in self:
+            self["nb_links"] = len(self.get("lrulinks") or [])
+
+    def unpack(self):
+        if self.packed is not None:
+            self.update(unpack_queue_page(self.packed))
+            self.packed = None
+
+    def __missing__(self, key):
+        if self.packed is None:
+            raise KeyError(key)
+        self.unpack()
+        return self[key]
+
+    def __contains__(self, key):
+        if not dict.__contains__(self, key):
+            self.unpack()
+        return dict.__contains__(self, key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
@@ -0,0 +1,116 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import time
+from math import exp, log
+from multiprocessing import cpu_count
+from twisted.internet.defer import Deferred
+
+# Half-life in seconds of the indexing time accounted to each corpus when
+# deciding which one is served next
+USAGE_HALF_LIFE = 120
+
+
+class IndexingScheduler(object):
+    """Shares a limited number of concurrent traph indexing batches between
+    all corpora: when all slots are busy, the next one goes to the corpus
+    with the oldest backlog relative to the indexing time it recently got"""
+
+    def __init__(self, max_concurrent=0):
+        self.max_concurrent = max_concurrent or cpu_count()
+        self.running = {}
+        self.waiting = {}
+        self.usage = {}
+        self.stats = {}
+        self.since = time.time()
+
+    def decayed_usage(self, corpus, now=None):
+        if corpus not in self.usage:
+            return 0
+        used, at = self.usage[corpus]
+        return used * exp(-log(2) * ((now or time.time()) - at) / USAGE_HALF_LIFE)
+
+    def priority(self, corpus, now):
+        backlog_since = self.waiting[corpus]["backlog_since"]
+        return (now - backlog_since) / (1 + self.decayed_usage(corpus, now))
+
+    def acquire(self, corpus, backlog_since=None):
+        # Returns a Deferred fired once the corpus may run an indexing batch
+        now = time.time()
+        d = Deferred()
+        if corpus in self.waiting:
+            self.waiting[corpus]["deferreds"].append(d)
+            return d
+        self.waiting[corpus] = {
+          "since": now,
+          "backlog_since": min(backlog_since or now, now),
+          "deferreds": [d]
+        }
+        self._serve()
+        return d
+
+    def release(self, corpus):
+        # Frees the slot of a corpus' batch and accounts its indexing time
+        if not self.running.get(corpus):
+            return
+        now = time.time()
+        duration = now - self.running[corpus].pop(0)
+        self.usage[corpus] = (self.decayed_usage(corpus, now) + duration, now)
+        if corpus in self.stats:
+            self.stats[corpus]["time"] += duration
+        if not self.running[corpus]:
+            del(self.running[corpus])
+        self._serve()
+
+    def cancel(self, corpus):
+        # Drops the corpus' waiting requests, for instance when it stops
+        if corpus in self.waiting:
+            for d in self.waiting.pop(corpus)["deferreds"]:
+                d.cancel()
+
+    def _serve(self):
+        while self.waiting and sum(len(r) for r in self.running.values()) < self.max_concurrent:
+            now = time.time()
+            corpus = max(self.waiting, key=lambda c: self.priority(c, now))
+            request = self.waiting[corpus]
+            d = request["deferreds"].pop(0)
+            if not request["deferreds"]:
+                del(self.waiting[corpus])
+            self._start(corpus, now, now - request["since"])
+            d.callback(None)
+
+    def _start(self, corpus, now, waited):
+        if corpus not in self.running:
+            self.running[corpus] = []
+        self.running[corpus].append(now)
+        if corpus not in self.stats:
+            self.stats[corpus] = {"batches": 0, "time": 0, "waited": 0}
+        self.stats[corpus]["batches"] += 1
+        self.stats[corpus]["waited"] += waited
+
+    def forget(self, corpus):
+        self.cancel(corpus)
+        for store in [self.usage, self.stats]:
+            if corpus in store:
+                del(store[corpus])
+
+    def corpus_status(self, corpus):
+        total = sum(s["time"] for s in self.stats.values())
+        stats = self.stats.get(corpus, {"batches": 0, "time": 0, "waited": 0})
+        return {
+          "running": len(self.running.get(corpus, [])),
+          "waiting": corpus in self.waiting,
+          "batches": stats["batches"],
+          "time": round(stats["time"], 3),
+          "waited": round(stats["waited"], 3),
+          "share": round(stats["time"] / total, 3) if total else 0
+        }
+
+    def status(self):
+        return {
+          "max_concurrent": self.max_concurrent,
+          "running": sum(len(r) for r in self.running.values()),
+          "waiting": len(self.waiting),
+          "since": int(self.since * 1000),
+          "corpora": dict((c, self.corpus_status(c)) for c in self.stats)
+        }
@@ -0,0 +1,131 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from array import array
+from itertools import compress
+from operator import add
+
+from hyphe_backend.lib.webentitieslinks import WebentitiesStatuses, STATUSES
+from hyphe_backend.lib.centrality import CENTRALITY_FIELDS
+
+# Fields of the webentities held in columns indexed by webentity id, the
+# other ones (prefixes, tags, homepage, startpages) only being read from
+# Mongo. Degrees, pages counts and centralities are the webentities links'.
+CATALOG_FIELDS = ["_id", "name", "status", "crawled", "creationDate", "lastModificationDate"]
+MONGO_FIELDS = ["prefixes", "tags", "homepage", "startpages"]
+
+
+def _padded(column, size):
+    if len(column) >= size:
+        return column
+    return list(column) + [0] * (size - len(column))
+
+
+class WebentitiesCatalog(WebentitiesStatuses):
+    """Names, statuses, crawled flags and dates of all webentities of a
+    corpus, kept in sync with Mongo by the core to sort and paginate them
+    without loading every webentity"""
+
+    def __init__(self):
+        WebentitiesStatuses.__init__(self)
+        # Whether all webentities were read from Mongo
+        self.loaded = False
+        self.names = []
+        self.name_keys = []
+        self.crawled = bytearray()
+        self.creation_dates = array("l")
+        self.modification_dates = array("l")
+
+    def _grow(self, size):
+        if size <= len(self.codes):
+            return
+        grow = size - len(self.codes)
+        self.codes.extend(bytearray(grow))
+        self.names.extend([None] * grow)
+        self.name_keys.extend([None] * grow)
+        self.crawled.extend(bytearray(grow))
+        self.creation_dates.extend(array("l", [0]) * grow)
+        self.modification_dates.extend(array("l", [0]) * grow)
+
+    def __len__(self):
+        return len(self.codes) - self.codes.count(b"\x00")
+
+    def set(self, weid, status):
+        self._grow(weid + 1)
+        WebentitiesStatuses.set(self, weid, status)
+
+    def remove(self, weid):
+        WebentitiesStatuses.remove(self, weid)
+        if 0 <= weid < len(self.codes):
+            self.names[weid] = None
+            self.name_keys[weid] = None
+
+    def update(self, WE):
+        # Records the catalog fields found in a webentity document
+        weid = WE["_id"]
+        self._grow(weid + 1)
+        if "status" in WE:
+            self.set(weid, WE["status"])
+        if "name" in WE:
+            self.names[weid] = WE["name"]
+            self.name_keys[weid] = (WE["name"] or "").upper()
+        if "crawled" in WE:
+            self.crawled[weid] = 1 if WE["crawled"] else 0
+        if "creationDate" in WE:
+            self.creation_dates[weid] = WE["creationDate"] or 0
+        if "lastModificationDate" in WE:
+            self.modification_dates[weid] = WE["lastModificationDate"] or 0
+
+    def name(self, weid):
+        if not 0 <= weid < len(self.names):
+            return None
+        return self.names[weid]
+
+    def ids(self):
+        return list(compress(xrange(len(self.codes)), self.codes))
+
+    def column(self, field, links):
+        # Returns the values of a sort field indexed by webentity id, None
+        # for fields only held in Mongo, or False for unknown fields which
+        # do not sort anything
+        size = len(self.codes)
+        if field == "_id":
+            return xrange(size)
+        if field == "name":
+            return self.name_keys
+        if field == "status":
+            # Ranks the statuses codes in the statuses' alphabetical order
+            table = bytearray(256)
+            for rank, status in enumerate(sorted(STATUSES)):
+                table[STATUSES.index(status) + 1] = rank + 1
+            return self.codes.translate(table)
+        if field == "crawled":
+            return self.crawled
+        if field == "creationDate":
+            return self.creation_dates
+        if field == "lastModificationDate":
+            return self.modification_dates
+        if field in MONGO_FIELDS:
+            return None
+        if field in CENTRALITY_FIELDS:
+            return _padded(links.centralities.get(field, []), size)
+        if field == "pages_total":
+            return _padded(map(add, links.stats["pages_crawled"], links.stats["pages_uncrawled"]), size)
+        if field.startswith("pages") or field.endswith("degree"):
+            return _padded(links.stats.get(field, []), size)
+        return False
+
+    def sorted_ids(self, sort, links):
+        # Returns the ids of all webentities ordered by the already
+        # normalized sort fields (prefixed with "-" for reverse order), or
+        # None when a sort field is only held in Mongo
+        ids = self.ids()
+        for sortkey in reversed(sort or []):
+            field = sortkey.lstrip("-")
+            column = self.column(field, links)
+            if column is None:
+                return None
+            if column is False:
+                continue
+            ids.sort(key=column.__getitem__, reverse=(field != sortkey))
+        return ids
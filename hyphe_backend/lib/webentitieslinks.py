@@ -0,0 +1,636 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import mmap
+from array import array
+from bisect import bisect_left
+from ctypes import c_int32
+from itertools import imap, izip
+from operator import and_
+from struct import Struct
+
+# Links between webentities are held in compressed sparse rows: the links
+# are sorted by target in one set of columns (sources and weights, with the
+# offsets of each target's links) and by source in another one, so that the
+# inlinks and outlinks of a webentity are contiguous slices. Per webentity
+# stats are columns indexed by webentity id, ids being allocated in sequence
+# by the traph.
+# Links added from indexed batches go to a small overlay of dicts which the
+# core merges into the columns once it grows beyond a share of the links.
+# Building the columns, merging the overlay and ranking are generators
+# yielding between steps, for the core to run them through twisted's
+# cooperate without freezing the reactor.
+STATS = ["pages_crawled", "pages_uncrawled", "indegree", "outdegree", "undirected_degree"]
+COMPACT_MIN_LINKS = 10000
+COMPACT_RATIO = 8
+# Numbers of links or webentities processed between two steps, larger for
+# the loops running in C
+STEP = 10000
+LINKS_STEP = 100000
+# Links are looked up one by one rather than read in whole slices for
+# webentities with that many times more links than the ones looked up
+LOOKUP_RATIO = 8
+
+# Links are cached on disk in a binary file made of a header followed by
+# the columns as native int32: the webentities' presence flags (as bytes,
+# padded to 4) and stats, the offsets of both rows, the links sorted by
+# target then by source, and finally the links of the overlay. The links
+# columns are memory-mapped when loading, so that only the parts actually
+# read are loaded from the disk.
+CACHE_MAGIC = b"HWEL"
+CACHE_VERSION = 1
+header = Struct("=4sIqqq")
+
+# Statuses are held as one byte per webentity id, 0 standing for no
+# webentity, so that the webentities of some statuses are picked out of
+# them at once as a mask of 0s and 1s
+STATUSES = ["IN", "OUT", "UNDECIDED", "DISCOVERED"]
+
+
+def _zeros(typecode, n):
+    return array(typecode, [0]) * n
+
+def _copy(column):
+    # Copies a column of int32, be it an array or memory-mapped
+    res = array("i")
+    res.fromstring(buffer(column))
+    return res
+
+def _run(steps):
+    # Runs at once the steps of one of the generators below
+    for _ in steps:
+        pass
+
+def _gather_steps(values, indexes, result):
+    # Appends to result the values found at the indexes
+    for i in xrange(0, len(indexes), LINKS_STEP):
+        result.extend(imap(values.__getitem__, indexes[i:i + LINKS_STEP]))
+        yield
+
+def _csr_steps(n, keys, values, result):
+    # Appends to result the offsets of each key's slice, the values sorted
+    # by key then value and the positions of the links they come from, for
+    # their weights to be gathered (plain lists are faster to shuffle around)
+    offsets = [0] * (n + 1)
+    for i in xrange(0, len(keys), STEP):
+        for k in keys[i:i + STEP]:
+            offsets[k + 1] += 1
+        yield
+    for i in xrange(0, n, STEP):
+        for j in xrange(i, min(n, i + STEP)):
+            offsets[j + 1] += offsets[j]
+        yield
+    positions = offsets[:-1]
+    order = [0] * len(keys)
+    for i in xrange(0, len(keys), STEP):
+        for j, k in enumerate(keys[i:i + STEP], i):
+            order[positions[k]] = j
+            positions[k] += 1
+        yield
+    sorted_values = []
+    for step in _gather_steps(values, order, sorted_values):
+        yield step
+    for i in xrange(0, n, STEP):
+        for j in xrange(i, min(n, i + STEP)):
+            a, b = offsets[j], offsets[j + 1]
+            if b - a > 1:
+                pairs = sorted(izip(sorted_values[a:b], order[a:b]))
+                sorted_values[a:b] = [v for v, _ in pairs]
+                order[a:b] = [o for _, o in pairs]
+        yield
+    result.extend([array("l", offsets), array("i", sorted_values), order])
+
+def _padding(size):
+    return (4 - size % 4) % 4
+
+def _find(offsets, values, key, value):
+    # Returns the position of value within key's slice or -1
+    if key >= len(offsets) - 1:
+        return -1
+    a, b = offsets[key], offsets[key + 1]
+    i = bisect_left(values, value, a, b)
+    if i < b and values[i] == value:
+        return i
+    return -1
+
+
+class WebentitiesLinks(object):
+    """Weighted links between webentities with their pages counts and
+    degrees, for the core to serve networks and rankings"""
+
+    def __init__(self):
+        # Whether it changed since it was last saved or loaded
+        self.dirty = True
+        self.map = None
+        self.size = 0
+        self.present = bytearray()
+        self.stats = dict((key, _zeros("i", 0)) for key in STATS)
+        # Computed in the background by the core, see lib/centrality.py
+        self.centralities = {}
+        # Weights added to links while the overlay is being merged, and how
+        # many times the columns were replaced, for the steps running
+        # meanwhile
+        self.compacting = None
+        self.builds = 0
+        _run(self._build_steps(_zeros("i", 0), _zeros("i", 0), _zeros("i", 0)))
+
+    @classmethod
+    def from_columns(cls, sources, targets, weights, stat_keys=[]):
+        links = cls()
+        _run(links.build_from_columns(sources, targets, weights, stat_keys))
+        return links
+
+    @classmethod
+    def from_dict(cls, links_dict):
+        links = cls()
+        _run(links.build_from_dict(links_dict))
+        return links
+
+    def build_from_columns(self, sources, targets, weights, stat_keys=[]):
+        # Fills a new instance from parallel columns of links, negative
+        # sources standing for the stats of stat_keys (-1 for the first
+        # one, and so on)
+        stats = []
+        link_sources = _zeros("i", 0)
+        link_targets = _zeros("i", 0)
+        link_weights = _zeros("i", 0)
+        for i in xrange(0, len(sources), STEP):
+            for source, target, weight in izip(sources[i:i + STEP], targets[i:i + STEP], weights[i:i + STEP]):
+                if source < 0:
+                    stats.append((target, stat_keys[-source - 1], weight))
+                else:
+                    link_sources.append(source)
+                    link_targets.append(target)
+                    link_weights.append(weight)
+            yield
+        self._grow(max(max(link_sources or [-1]), max(link_targets or [-1]), max([t for t, _, _ in stats] or [-1])) + 1)
+        for i in xrange(0, len(stats), STEP):
+            for target, key, value in stats[i:i + STEP]:
+                self.set_stat(target, key, value)
+            yield
+        for step in self._build_steps(link_sources, link_targets, link_weights):
+            yield step
+        for step in self._mark_linked_steps():
+            yield step
+
+    def build_from_dict(self, links_dict):
+        # Fills a new instance from {target: {source or stat key: weight or
+        # value}}
+        sources = _zeros("i", 0)
+        targets = _zeros("i", 0)
+        weights = _zeros("i", 0)
+        webentities = _zeros("i", 0)
+        stats = []
+        for i, (target, values) in enumerate(links_dict.iteritems(), 1):
+            target = int(target)
+            webentities.append(target)
+            for source, weight in values.iteritems():
+                if isinstance(source, int):
+                    sources.append(source)
+                    targets.append(target)
+                    weights.append(weight)
+                elif source in STATS:
+                    stats.append((target, source, weight))
+            if not i % STEP:
+                yield
+        self._grow(max(max(sources or [-1]), max(webentities or [-1])) + 1)
+        for weid in webentities:
+            self.present[weid] = 1
+        for i in xrange(0, len(stats), STEP):
+            for target, key, value in stats[i:i + STEP]:
+                self.set_stat(target, key, value)
+            yield
+        for step in self._build_steps(sources, targets, weights):
+            yield step
+        for step in self._mark_linked_steps():
+            yield step
+
+    @classmethod
+    def load(cls, path):
+        links = cls()
+        with open(path, "rb") as f:
+            links.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        magic, version, size, n_links, n_pending = header.unpack_from(links.map)
+        if magic != CACHE_MAGIC or version != CACHE_VERSION:
+            raise ValueError("Unsupported links cache %s (version %s)" % (magic, version))
+        expected = header.size + size + _padding(size)
+        expected += (len(STATS) * size + 2 * (size + 1) + 4 * n_links + 3 * n_pending) * 4
+        if len(links.map) != expected:
+            raise ValueError("Truncated links cache, expected %s bytes" % expected)
+        offset = [header.size]
+        def column(n, typecode="i"):
+            start = offset[0]
+            offset[0] += n * 4
+            if typecode == "b":
+                offset[0] = start + n + _padding(n)
+                return bytearray(links.map[start:start + n])
+            res = array("i")
+            res.fromstring(links.map[start:start + n * 4])
+            return res if typecode == "i" else array(typecode, res)
+        def mapped_column(n):
+            # Links are only read from the disk when accessed, and copied
+            # in memory once modified
+            start = offset[0]
+            offset[0] += n * 4
+            return (c_int32 * n).from_buffer(links.map, start)
+        links.size = size
+        links.present = column(size, "b")
+        links.stats = dict((key, column(size)) for key in STATS)
+        links.in_offsets = column(size + 1, "l")
+        links.out_offsets = column(size + 1, "l")
+        links.in_sources = mapped_column(n_links)
+        links.in_weights = mapped_column(n_links)
+        links.out_targets = mapped_column(n_links)
+        links.out_weights = mapped_column(n_links)
+        for source, target, weight in izip(column(n_pending), column(n_pending), column(n_pending)):
+            links.add_link(source, target, weight)
+        links.dirty = False
+        return links
+
+    def save(self, path):
+        # Writes the cache to a temporary file first so that it is replaced
+        # at once, and only when something changed
+        if not self.dirty:
+            return False
+        pending = zip(*((s, t, w) for t, sources in self.pending_in.iteritems() for s, w in sources.iteritems())) or [[], [], []]
+        with open(path + ".tmp", "wb") as f:
+            f.write(header.pack(CACHE_MAGIC, CACHE_VERSION, self.size, len(self.in_sources), self.n_pending))
+            f.write(str(self.present) + b"\0" * _padding(self.size))
+            for key in STATS:
+                self.stats[key].tofile(f)
+            for offsets in [self.in_offsets, self.out_offsets]:
+                array("i", offsets).tofile(f)
+            for column in [self.in_sources, self.in_weights, self.out_targets, self.out_weights]:
+                f.write(buffer(column))
+            for column in pending:
+                array("i", column).tofile(f)
+        os.rename(path + ".tmp", path)
+        self.dirty = False
+        return True
+
+    def to_dict(self):
+        links_dict = {}
+        for weid in xrange(self.size):
+            if not self.present[weid]:
+                continue
+            links_dict[weid] = dict(self.inlinks(weid))
+            for key in STATS + ["pages_total"]:
+                links_dict[weid][key] = self.stat(weid, key)
+        return links_dict
+
+    def _build_steps(self, sources, targets, weights):
+        inlinks, outlinks = [], []
+        for step in _csr_steps(self.size, targets, sources, inlinks):
+            yield step
+        for step in _csr_steps(self.size, sources, targets, outlinks):
+            yield step
+        in_weights = _zeros("i", 0)
+        out_weights = _zeros("i", 0)
+        for step in _gather_steps(weights, inlinks[2], in_weights):
+            yield step
+        for step in _gather_steps(weights, outlinks[2], out_weights):
+            yield step
+        self._set_columns(inlinks[0], inlinks[1], in_weights, outlinks[0], outlinks[1], out_weights)
+        self.pending_in = {}
+        self.pending_out = {}
+        self.n_pending = 0
+
+    def _set_columns(self, in_offsets, in_sources, in_weights, out_offsets, out_targets, out_weights):
+        # Webentities added since the columns were sorted get empty slices
+        grow = self.size + 1 - len(in_offsets)
+        in_offsets.extend(array("l", [in_offsets[-1]]) * grow)
+        out_offsets.extend(array("l", [out_offsets[-1]]) * grow)
+        self.in_offsets, self.in_sources, self.in_weights = in_offsets, in_sources, in_weights
+        self.out_offsets, self.out_targets, self.out_weights = out_offsets, out_targets, out_weights
+        self.mutual = None
+        self.builds += 1
+
+    def _mutual_steps(self):
+        # Flags the inlinks whose target also links to their source, so
+        # that undirected degrees are counted without building any set
+        builds = self.builds
+        n = self.size
+        in_offsets, in_sources = self.in_offsets, self.in_sources
+        out_offsets, out_targets = self.out_offsets, self.out_targets
+        mutual = bytearray(len(in_sources))
+        for i in xrange(0, n, STEP):
+            for weid in xrange(i, min(n, i + STEP)):
+                a, b = in_offsets[weid], in_offsets[weid + 1]
+                c, d = out_offsets[weid], out_offsets[weid + 1]
+                if a == b or c == d:
+                    continue
+                targets = set(out_targets[c:d])
+                mutual[a:b] = bytearray(imap(targets.__contains__, in_sources[a:b]))
+            yield
+        if self.builds == builds:
+            self.mutual = mutual
+
+    def _mark_linked_steps(self):
+        for i in xrange(0, self.size, STEP):
+            for weid in xrange(i, min(self.size, i + STEP)):
+                if self.in_offsets[weid] != self.in_offsets[weid + 1] or self.out_offsets[weid] != self.out_offsets[weid + 1]:
+                    self.present[weid] = 1
+            yield
+
+    def _grow(self, size):
+        if size <= self.size:
+            return
+        grow = size - self.size
+        self.present.extend(bytearray(grow))
+        for column in self.stats.values():
+            column.extend(_zeros("i", grow))
+        if hasattr(self, "in_offsets"):
+            self.in_offsets.extend(array("l", [self.in_offsets[-1]]) * grow)
+            self.out_offsets.extend(array("l", [self.out_offsets[-1]]) * grow)
+        self.size = size
+
+    def __len__(self):
+        return self.present.count(b"\x01")
+
+    def __contains__(self, weid):
+        return 0 <= weid < self.size and self.present[weid] == 1
+
+    def __iter__(self):
+        # Iterates over all links as (source, target, weight)
+        for target in xrange(self.size):
+            for i in xrange(self.in_offsets[target], self.in_offsets[target + 1]):
+                yield self.in_sources[i], target, self.in_weights[i]
+        for target, sources in self.pending_in.iteritems():
+            for source, weight in sources.iteritems():
+                yield source, target, weight
+
+    def n_links(self):
+        return len(self.in_sources) + self.n_pending
+
+    def add(self, weid):
+        self.dirty = True
+        self._grow(weid + 1)
+        self.present[weid] = 1
+
+    def stat(self, weid, key):
+        if not 0 <= weid < self.size:
+            return 0
+        if key == "pages_total":
+            return self.stats["pages_crawled"][weid] + self.stats["pages_uncrawled"][weid]
+        if key in self.centralities:
+            column = self.centralities[key]
+            return column[weid] if weid < len(column) else 0
+        if key not in self.stats:
+            return 0
+        return self.stats[key][weid]
+
+    def set_stat(self, weid, key, value):
+        self.add(weid)
+        # The total is always the sum of crawled and uncrawled pages
+        if key == "pages_total":
+            key = "pages_uncrawled"
+            value -= self.stats["pages_crawled"][weid]
+        self.stats[key][weid] = value
+
+    def inc_stat(self, weid, key, value):
+        self.set_stat(weid, key, self.stat(weid, key) + value)
+
+    def has_link(self, source, target):
+        return self.weight(source, target) > 0
+
+    def weight(self, source, target):
+        if source in self.pending_in.get(target, {}):
+            return self.pending_in[target][source]
+        i = _find(self.in_offsets, self.in_sources, target, source)
+        return self.in_weights[i] if i >= 0 else 0
+
+    def degree(self, weid):
+        # Number of links from and to weid, whichever their sources
+        if not 0 <= weid < self.size:
+            return 0
+        return self.in_offsets[weid + 1] - self.in_offsets[weid] + self.out_offsets[weid + 1] - self.out_offsets[weid] + \
+          len(self.pending_in.get(weid, {})) + len(self.pending_out.get(weid, {}))
+
+    def inlinks(self, target):
+        # Returns the list of (source, weight) linking to target
+        if not 0 <= target < self.size:
+            return []
+        a, b = self.in_offsets[target], self.in_offsets[target + 1]
+        links = zip(self.in_sources[a:b], self.in_weights[a:b])
+        if target in self.pending_in:
+            links.extend(self.pending_in[target].iteritems())
+        return links
+
+    def outlinks(self, source):
+        # Returns the list of (target, weight) linked from source
+        if not 0 <= source < self.size:
+            return []
+        a, b = self.out_offsets[source], self.out_offsets[source + 1]
+        links = zip(self.out_targets[a:b], self.out_weights[a:b])
+        if source in self.pending_out:
+            links.extend(self.pending_out[source].iteritems())
+        return links
+
+    def ego_links(self, weid):
+        # Returns the links between weid and its neighbors as (source,
+        # target, weight), looking up each neighbor's inlinks within the
+        # neighbors rather than reading them all when it is a hub, so that
+        # the cost depends on weid's degree rather than its neighbors'
+        neighbors = set([weid])
+        neighbors.update(source for source, _ in self.inlinks(weid))
+        neighbors.update(target for target, _ in self.outlinks(weid))
+        links = []
+        for target in neighbors:
+            if self.degree(target) > LOOKUP_RATIO * len(neighbors):
+                for source in neighbors:
+                    weight = self.weight(source, target)
+                    if weight:
+                        links.append((source, target, weight))
+            else:
+                links.extend((source, target, weight) for source, weight in self.inlinks(target) if source in neighbors)
+        return links
+
+    def add_link(self, source, target, weight):
+        # Adds weight to a link and returns whether it is a new one
+        self.add(source)
+        self.add(target)
+        if self.compacting is not None:
+            self.compacting[(source, target)] = self.compacting.get((source, target), 0) + weight
+        i = _find(self.in_offsets, self.in_sources, target, source)
+        if i >= 0:
+            self.in_weights[i] += weight
+            self.out_weights[_find(self.out_offsets, self.out_targets, source, target)] += weight
+            return False
+        if target not in self.pending_in:
+            self.pending_in[target] = {}
+        if source not in self.pending_out:
+            self.pending_out[source] = {}
+        new = source not in self.pending_in[target]
+        self.pending_in[target][source] = self.pending_in[target].get(source, 0) + weight
+        self.pending_out[source][target] = self.pending_in[target][source]
+        if new:
+            self.n_pending += 1
+        return new
+
+    def needs_compaction(self):
+        # Whether the overlay grew beyond its share of the links
+        return self.compacting is None and self.n_pending > max(COMPACT_MIN_LINKS, len(self.in_sources) / COMPACT_RATIO)
+
+    def compact(self):
+        _run(self.compact_steps())
+
+    def compact_steps(self):
+        # Merges the links added since the last build into the columns.
+        # Links added meanwhile stay in the overlay, and weights added
+        # meanwhile to the links merged are added again to the new columns
+        if not self.n_pending or self.compacting is not None:
+            return
+        self.compacting = {}
+        try:
+            n = self.size
+            pending = [(source, target) for target, sources in self.pending_in.iteritems() for source in sources]
+            weights = _copy(self.in_weights)
+            weights.extend(self.pending_in[target][source] for source, target in pending)
+            in_offsets = self.in_offsets
+            sources = _copy(self.in_sources)
+            targets = _zeros("i", 0)
+            for i in xrange(0, n, STEP):
+                for weid in xrange(i, min(n, i + STEP)):
+                    targets.extend(array("i", [weid]) * (in_offsets[weid + 1] - in_offsets[weid]))
+                yield
+            sources.extend(source for source, _ in pending)
+            targets.extend(target for _, target in pending)
+            inlinks, outlinks = [], []
+            for step in _csr_steps(n, targets, sources, inlinks):
+                yield step
+            for step in _csr_steps(n, sources, targets, outlinks):
+                yield step
+            in_weights = _zeros("i", 0)
+            out_weights = _zeros("i", 0)
+            for step in _gather_steps(weights, inlinks[2], in_weights):
+                yield step
+            for step in _gather_steps(weights, outlinks[2], out_weights):
+                yield step
+            for (source, target), weight in self.compacting.iteritems():
+                i = _find(inlinks[0], inlinks[1], target, source)
+                if i >= 0:
+                    in_weights[i] += weight
+                    out_weights[_find(outlinks[0], outlinks[1], source, target)] += weight
+            for source, target in pending:
+                del self.pending_in[target][source]
+                if not self.pending_in[target]:
+                    del self.pending_in[target]
+                del self.pending_out[source][target]
+                if not self.pending_out[source]:
+                    del self.pending_out[source]
+            self.n_pending -= len(pending)
+            self._set_columns(inlinks[0], inlinks[1], in_weights, outlinks[0], outlinks[1], out_weights)
+            self.dirty = True
+        finally:
+            self.compacting = None
+
+    def rank(self, mask=None):
+        _run(self.rank_steps(mask))
+
+    def rank_steps(self, mask=None):
+        # Computes the degrees of all webentities, only counting the links
+        # from the sources flagged in mask (as given by
+        # WebentitiesStatuses.mask) when given. Links added meanwhile are
+        # counted from the overlay at the end, and the columns are read
+        # again if replaced in between
+        for step in self.compact_steps():
+            yield step
+        while True:
+            builds = self.builds
+            if self.mutual is None:
+                for step in self._mutual_steps():
+                    yield step
+                if self.builds != builds:
+                    continue
+            n = self.size
+            in_offsets, in_sources, out_offsets = self.in_offsets, self.in_sources, self.out_offsets
+            mutual = self.mutual
+            kept = None
+            if mask is not None:
+                flags = mask[:n] + bytearray(max(0, n - len(mask)))
+                kept = bytearray()
+                for step in _gather_steps(flags, in_sources, kept):
+                    yield step
+                kept_mutual = bytearray()
+                for i in xrange(0, len(kept), LINKS_STEP):
+                    kept_mutual.extend(imap(and_, kept[i:i + LINKS_STEP], mutual[i:i + LINKS_STEP]))
+                    yield
+                mutual = kept_mutual
+            indegree = _zeros("i", n)
+            outdegree = _zeros("i", n)
+            undirected_degree = _zeros("i", n)
+            for i in xrange(0, n, STEP):
+                for weid in xrange(i, min(n, i + STEP)):
+                    a, b = in_offsets[weid], in_offsets[weid + 1]
+                    if kept is None:
+                        indegree[weid] = b - a
+                    elif a != b:
+                        indegree[weid] = kept.count(b"\x01", a, b)
+                    if mask is None or flags[weid]:
+                        outdegree[weid] = out_offsets[weid + 1] - out_offsets[weid]
+                        both = mutual.count(b"\x01", a, b) if outdegree[weid] and a != b else 0
+                        undirected_degree[weid] = indegree[weid] + outdegree[weid] - both
+                    else:
+                        undirected_degree[weid] = indegree[weid]
+                yield
+            if self.builds == builds:
+                break
+        # Both ends of a link from the overlay were already neighbors when
+        # the reverse link is counted, from the columns or before it
+        size = self.size
+        for column in [indegree, outdegree, undirected_degree]:
+            column.extend(_zeros("i", size - n))
+        if mask is not None:
+            flags = mask[:size] + bytearray(max(0, size - len(mask)))
+        counted = set()
+        for target, sources in self.pending_in.iteritems():
+            for source in sources:
+                if mask is not None and not flags[source]:
+                    continue
+                indegree[target] += 1
+                outdegree[source] += 1
+                reverse = (target, source) in counted or (_find(in_offsets, in_sources, source, target) >= 0 and (mask is None or flags[target]))
+                counted.add((source, target))
+                if reverse:
+                    continue
+                undirected_degree[target] += 1
+                if source != target:
+                    undirected_degree[source] += 1
+        self.dirty = True
+        self.stats["indegree"] = indegree
+        self.stats["outdegree"] = outdegree
+        self.stats["undirected_degree"] = undirected_degree
+
+
+class WebentitiesStatuses(object):
+    """Status of each webentity of a corpus, kept in memory along the links
+    to filter them without querying Mongo"""
+
+    def __init__(self):
+        self.codes = bytearray()
+
+    def set(self, weid, status):
+        if weid >= len(self.codes):
+            self.codes.extend(bytearray(weid + 1 - len(self.codes)))
+        self.codes[weid] = STATUSES.index(status) + 1
+
+    def remove(self, weid):
+        if 0 <= weid < len(self.codes):
+            self.codes[weid] = 0
+
+    def get(self, weid):
+        if not 0 <= weid < len(self.codes) or not self.codes[weid]:
+            return None
+        return STATUSES[self.codes[weid] - 1]
+
+    def mask(self, statuses, size=0):
+        # Returns a bytearray flagging with 1 the ids of the webentities
+        # having one of the statuses, at least size long
+        table = bytearray(256)
+        for status in statuses:
+            table[STATUSES.index(status) + 1] = 1
+        mask = self.codes.translate(table)
+        if len(mask) < size:
+            mask.extend(bytearray(size - len(mask)))
+        return mask
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+
+import random
+import unittest
+from hyphe_backend.lib.webentitieslinks import WebentitiesLinks, WebentitiesStatuses, STATUSES
+from hyphe_backend.lib.centrality import compute_centralities, CENTRALITIES, CENTRALITY_FIELDS, DAMPING
+
+
+def reference_pagerank(nodes, edges):
+    outlinks = dict((x, []) for x in nodes)
+    inlinks = dict((x, []) for x in nodes)
+    for source, target in edges:
+        outlinks[source].append(target)
+        inlinks[target].append(source)
+    n = len(nodes)
+    scores = dict((x, 1. / n) for x in nodes)
+    for _ in xrange(1000):
+        dangling = sum(scores[x] for x in nodes if not outlinks[x])
+        new_scores = dict((x, (1 - DAMPING) / n + DAMPING * dangling / n + DAMPING * sum(scores[y] / len(outlinks[y]) for y in inlinks[x])) for x in nodes)
+        converged = sum(abs(new_scores[x] - scores[x]) for x in nodes) < 1e-13
+        scores = new_scores
+        if converged:
+            break
+    return scores
+
+def reference_hits(nodes, edges):
+    outlinks = dict((x, []) for x in nodes)
+    inlinks = dict((x, []) for x in nodes)
+    for source, target in edges:
+        outlinks[source].append(target)
+        inlinks[target].append(source)
+    hubs = dict((x, 1.) for x in nodes)
+    for _ in xrange(2000):
+        authorities = dict((x, sum(hubs[y] for y in inlinks[x])) for x in nodes)
+        total = sum(authorities.values()) or 1
+        authorities = dict((x, v / total) for x, v in authorities.items())
+        new_hubs = dict((x, sum(authorities[y] for y in outlinks[x])) for x in nodes)
+        total = sum(new_hubs.values()) or 1
+        new_hubs = dict((x, v / total) for x, v in new_hubs.items())
+        converged = sum(abs(new_hubs[x] - hubs[x]) for x in nodes) < 1e-14
+        hubs = new_hubs
+        if converged:
+            break
+    return authorities, hubs
+
+
+class CentralityTest(unittest.TestCase):
+
+    def setUp(self):
+        rand = random.Random(1)
+        self.n = 300
+        self.links = {}
+        for _ in xrange(3000):
+            self.links[(rand.randrange(self.n), rand.randrange(self.n))] = rand.randint(1, 5)
+        sources, targets, weights = zip(*[(s, t, w) for (s, t), w in self.links.items()])
+        self.rows = WebentitiesLinks.from_columns(list(sources), list(targets), list(weights))
+        for weid in xrange(self.n):
+            self.rows.add(weid)
+        statuses = WebentitiesStatuses()
+        for weid in xrange(self.n):
+            statuses.set(weid, rand.choice(STATUSES))
+        self.mask = statuses.mask(["IN", "UNDECIDED"])
+
+    def compute(self, mask, previous={}):
+        results = {}
+        self.steps = sum(1 for _ in compute_centralities(self.rows, mask, results, previous))
+        return results
+
+    def assertClose(self, scores, reference, tolerance):
+        for weid in xrange(self.n):
+            self.assertAlmostEqual(scores[weid], reference[weid], delta=tolerance)
+
+    def assertCentralities(self, results, variant, mask):
+        nodes = range(self.n)
+        edges = [(s, t) for s, t in self.links if mask is None or mask[s]]
+        self.assertClose(results["pagerank" + variant], reference_pagerank(nodes, edges), 1e-5)
+        authorities, hubs = reference_hits(nodes, edges)
+        self.assertClose(results["hits_authority" + variant], authorities, 1e-4)
+        self.assertClose(results["hits_hub" + variant], hubs, 1e-4)
+        strengths = dict((weid, 0) for weid in nodes)
+        for (source, target), weight in self.links.items():
+            if mask is None or mask[source]:
+                strengths[target] += weight
+        self.assertClose(results["in_strength" + variant], strengths, 1e-9)
+
+    def test_filtered(self):
+        results = self.compute(self.mask)
+        self.assertEqual(sorted(results), sorted(CENTRALITY_FIELDS))
+        self.assertCentralities(results, "", self.mask)
+        self.assertCentralities(results, "_unfiltered", None)
+
+    def test_unfiltered(self):
+        results = self.compute(None)
+        self.assertCentralities(results, "", None)
+        for key in CENTRALITIES:
+            self.assertTrue(results[key + "_unfiltered"] is results[key])
+
+    def test_pending_links(self):
+        # Links added since the last build are merged before computing
+        self.rows.add_link(1, 2, 3)
+        self.links[(1, 2)] = self.links.get((1, 2), 0) + 3
+        self.assertCentralities(self.compute(None), "", None)
+
+    def test_previous_results(self):
+        # Runs start from the previous results, converging at once when
+        # nothing changed
+        results = self.compute(self.mask)
+        steps = self.steps
+        results = self.compute(self.mask, results)
+        self.assertTrue(self.steps < steps / 4)
+        self.assertCentralities(results, "", self.mask)
+        for source, target in [(1, 2), (5, 250), (260, 3)]:
+            self.rows.add_link(source, target, 1)
+            self.links[(source, target)] = self.links.get((source, target), 0) + 1
+        # Webentities filtered out since get no hub score
+        mask = self.mask[:100] + bytearray(self.n - 100)
+        results = self.compute(mask, results)
+        self.assertCentralities(results, "", mask)
+        self.assertCentralities(results, "_unfiltered", None)
+
+    def test_links_added_meanwhile(self):
+        # Links added while computing are left for the next run
+        results = {}
+        steps = compute_centralities(self.rows, None, results)
+        for _ in xrange(5):
+            next(steps)
+        self.rows.add_link(1, 2, 3)
+        for _ in steps:
+            pass
+        self.assertCentralities(results, "", None)
+
+    def test_empty(self):
+        results = {}
+        for _ in compute_centralities(WebentitiesLinks(), None, results):
+            pass
+        for key in CENTRALITY_FIELDS:
+            self.assertEqual(len(results[key]), 0)
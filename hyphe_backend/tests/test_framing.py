@@ -0,0 +1,102 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+import msgpack
+from struct import pack
+from twisted.test.proto_helpers import StringTransport
+from hyphe_backend.traph.framing import MsgPackReceiver, pack_message, read_message_id, LINE_FRAMING, LENGTH_PREFIXED_FRAMING
+
+
+class Receiver(MsgPackReceiver):
+
+    def __init__(self, framing=LINE_FRAMING):
+        self.messages = []
+        self.failures = []
+        self.setFraming(framing)
+        self.makeConnection(StringTransport())
+
+    def messageReceived(self, msg):
+        self.messages.append(msg)
+
+    def messageDecodingFailed(self, error, length, queryId):
+        self.failures.append((length, queryId))
+
+
+def frame(data):
+    return pack("!I", len(data)) + data
+
+
+class FramingTest(unittest.TestCase):
+
+    def test_pack_message_id_first(self):
+        msg = {"method": "get_webentity_pages", "args": [1, ["s:http|"]], "kwargs": {}, "id": 12}
+        data = pack_message(msg)
+        self.assertEqual(msgpack.unpackb(data), msg)
+        self.assertEqual(read_message_id(data[:8]), 12)
+        self.assertEqual(msgpack.unpackb(pack_message([1, 2])), [1, 2])
+
+    def test_read_message_id(self):
+        self.assertEqual(read_message_id(pack_message({"id": 2 ** 40, "code": "fail"})), 2 ** 40)
+        self.assertEqual(read_message_id(msgpack.packb({"code": "fail"})), None)
+        self.assertEqual(read_message_id(pack_message({"id": "abc"})), None)
+        self.assertEqual(read_message_id(b"\xc1garbage"), None)
+        self.assertEqual(read_message_id(b""), None)
+
+    def test_lines(self):
+        receiver = Receiver()
+        data = MsgPackReceiver.delimiter.join(pack_message({"id": i, "result": "x" * i}) for i in range(3)) + MsgPackReceiver.delimiter
+        # Messages are read whatever the way they are cut
+        for i in xrange(0, len(data), 7):
+            receiver.dataReceived(data[i:i+7])
+        self.assertEqual([m["id"] for m in receiver.messages], [0, 1, 2])
+        self.assertEqual(receiver.failures, [])
+
+    def test_frames(self):
+        receiver = Receiver(LENGTH_PREFIXED_FRAMING)
+        messages = [{"id": i, "result": range(i * 100)} for i in range(5)]
+        data = b"".join(frame(pack_message(m)) for m in messages)
+        for i in xrange(0, len(data), 3):
+            receiver.dataReceived(data[i:i+3])
+        self.assertEqual(receiver.messages, messages)
+
+    def test_send(self):
+        receiver = Receiver(LENGTH_PREFIXED_FRAMING)
+        size = receiver.sendPacked({"id": 3, "code": "success"})
+        data = receiver.transport.value()
+        self.assertEqual(len(data), size + 4)
+        other = Receiver(LENGTH_PREFIXED_FRAMING)
+        other.dataReceived(data)
+        self.assertEqual(other.messages, [{"id": 3, "code": "success"}])
+
+    def test_corrupted_frame(self):
+        # The id of an undecodable message is read from its start, and the
+        # next messages are still received
+        receiver = Receiver(LENGTH_PREFIXED_FRAMING)
+        corrupted = pack_message({"id": 7, "result": [1, 2, 3]})[:-2] + b"\xc1\xc1"
+        receiver.dataReceived(frame(corrupted) + frame(pack_message({"id": 8})))
+        self.assertEqual(receiver.failures, [(len(corrupted), 7)])
+        self.assertEqual(receiver.messages, [{"id": 8}])
+
+    def test_corrupted_line(self):
+        receiver = Receiver()
+        delimiter = MsgPackReceiver.delimiter
+        receiver.dataReceived(b"\xc1" + delimiter + pack_message({"id": 9, "a": 1})[:-1] + delimiter + pack_message({"id": 10}) + delimiter)
+        self.assertEqual(receiver.failures, [(1, None), (len(pack_message({"id": 9, "a": 1})) - 1, 9)])
+        self.assertEqual(receiver.messages, [{"id": 10}])
+
+    def test_switch_framing(self):
+        # Messages following one which switches framing are read as frames
+        class Switcher(Receiver):
+            def messageReceived(self, msg):
+                Receiver.messageReceived(self, msg)
+                if msg.get("switch"):
+                    self.setFraming(LENGTH_PREFIXED_FRAMING)
+        receiver = Switcher()
+        receiver.dataReceived(pack_message({"id": 1, "switch": True}) + MsgPackReceiver.delimiter + frame(pack_message({"id": 2})))
+        self.assertEqual(receiver.messages, [{"id": 1, "switch": True}, {"id": 2}])
+
+    def test_frame_length_exceeded(self):
+        receiver = Receiver(LENGTH_PREFIXED_FRAMING)
+        receiver.dataReceived(pack("!I", 0) + b"rest")
+        self.assertTrue(receiver.transport.disconnecting)
+        self.assertEqual(receiver.messages, [])
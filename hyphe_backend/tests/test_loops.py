@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+from twisted.internet.defer import Deferred
+from twisted.internet.task import Clock
+from hyphe_backend.lib import loops
+from hyphe_backend.lib.loops import BackoffLoopingCall
+
+
+class BackoffLoopingCallTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.reactor = loops.reactor
+        loops.reactor = self.clock
+        self.calls = []
+        self.busy = False
+        self.loop = BackoffLoopingCall(self.call)
+
+    def tearDown(self):
+        loops.reactor = self.reactor
+
+    def call(self):
+        self.calls.append(self.clock.seconds())
+        return self.busy
+
+    def test_backoff(self):
+        self.loop.start(1, 5)
+        self.clock.pump([0] + [1] * 20)
+        # Idle calls wait twice longer each time up to the maximum interval
+        self.assertEqual(self.calls, [0, 2, 6, 11, 16])
+        self.busy = True
+        self.clock.pump([1] * 3)
+        self.assertEqual(self.calls[-3:], [21, 22, 23])
+
+    def test_wake(self):
+        self.loop.start(1, 5)
+        self.clock.pump([0] + [1] * 7)
+        self.assertEqual(self.calls, [0, 2, 6])
+        self.loop.wake()
+        self.clock.advance(0)
+        self.assertEqual(self.calls, [0, 2, 6, 7])
+        # The backoff starts again from the minimum interval
+        self.clock.pump([1] * 2)
+        self.assertEqual(self.calls, [0, 2, 6, 7, 9])
+
+    def test_wake_while_calling(self):
+        # A call running while woken up is followed by another one after
+        # the shortest interval rather than backing off
+        d = Deferred()
+        self.loop = BackoffLoopingCall(lambda: d)
+        self.loop.start(1, 5)
+        self.clock.advance(0)
+        self.loop.wake()
+        d.callback(False)
+        self.assertEqual(self.loop.delay, 1)
+        self.assertEqual([c.getTime() for c in self.clock.getDelayedCalls()], [1])
+
+    def test_stop(self):
+        self.loop.start(1, 5)
+        self.clock.advance(0)
+        self.loop.stop()
+        self.clock.advance(10)
+        self.assertEqual(self.calls, [0])
+        self.assertFalse(self.clock.getDelayedCalls())
+
+    def test_failure_stops(self):
+        errors = []
+        self.loop = BackoffLoopingCall(lambda: 1 / 0)
+        self.patch_err(errors)
+        self.loop.start(1)
+        self.clock.advance(0)
+        self.assertFalse(self.loop.running)
+        self.assertEqual(len(errors), 1)
+        self.assertFalse(self.clock.getDelayedCalls())
+
+    def patch_err(self, errors):
+        err = loops.logger.err
+        loops.logger.err = errors.append
+        self.addCleanup(setattr, loops.logger, "err", err)
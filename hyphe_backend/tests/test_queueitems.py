@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+import msgpack
+from hyphe_backend.lib.queueitems import pack_queue_item, unpack_queue_page, links_fingerprint, QueueItem, QUEUE_ITEM_VERSION
+
+PAGE = {
+  "_job": "JOBID",
+  "timestamp": 1500000000000,
+  "url": "http://www.example.com/café/",
+  "lru": u"s:http|h:com|h:example|h:www|p:café|",
+  "lrulinks": [
+    u"s:http|h:com|h:example|h:www|p:café|p:menu|",
+    u"s:http|h:com|h:example|h:www|p:thé|",
+    u"s:https|h:org|h:wikipedia|h:fr|p:wiki|p:Café|",
+    u"s:http|h:com|h:example|h:www|p:café|"
+  ],
+  "links_fingerprint": "abc",
+  "status": 200,
+  "depth": 1,
+  "encoding": "utf-8",
+  "content_type": "text/html",
+  "body": "<html/>"
+}
+
+
+class QueueItemsTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        item = pack_queue_item(PAGE)
+        self.assertEqual(item["nb_links"], 4)
+        for field in ["_job", "timestamp", "url", "lru", "links_fingerprint"]:
+            self.assertEqual(item[field], PAGE[field])
+        page = unpack_queue_page(item["page"])
+        self.assertEqual(page["lru"], PAGE["lru"])
+        self.assertEqual(page["lrulinks"], PAGE["lrulinks"])
+        self.assertTrue(isinstance(page["lru"], unicode))
+        for field in ["status", "depth", "encoding", "content_type"]:
+            self.assertEqual(page[field], PAGE[field])
+        self.assertFalse("body" in page)
+
+    def test_page_without_links(self):
+        page = dict(PAGE)
+        del page["lrulinks"]
+        item = pack_queue_item(page)
+        self.assertEqual(item["nb_links"], 0)
+        self.assertEqual(unpack_queue_page(item["page"])["lrulinks"], [])
+
+    def test_unsupported_version(self):
+        blob = msgpack.packb([QUEUE_ITEM_VERSION + 1, [], [[0]], {}])
+        self.assertRaises(ValueError, unpack_queue_page, blob)
+
+    def test_lazy_unpacking(self):
+        item = QueueItem(pack_queue_item(PAGE))
+        self.assertFalse(item.packed is None)
+        # Fields used to query the queue are read without unpacking
+        self.assertEqual(item["url"], PAGE["url"])
+        self.assertEqual(item["nb_links"], 4)
+        self.assertFalse(item.packed is None)
+        self.assertEqual(item["lrulinks"], PAGE["lrulinks"])
+        self.assertTrue(item.packed is None)
+        self.assertEqual(item["status"], 200)
+        self.assertRaises(KeyError, item.__getitem__, "missing")
+
+    def test_lazy_contains_and_get(self):
+        item = QueueItem(pack_queue_item(PAGE))
+        self.assertTrue("encoding" in item)
+        self.assertEqual(QueueItem(pack_queue_item(PAGE)).get("depth"), 1)
+        self.assertEqual(item.get("missing", "default"), "default")
+        self.assertFalse("page" in item)
+
+    def test_legacy_item(self):
+        # Items queued by crawlers deployed before the compact format
+        doc = dict((k, v) for k, v in PAGE.items() if k != "body")
+        item = QueueItem(doc)
+        self.assertTrue(item.packed is None)
+        self.assertEqual(item["nb_links"], 4)
+        self.assertEqual(item["lrulinks"], PAGE["lrulinks"])
+        self.assertEqual(item.get("status"), 200)
+        self.assertRaises(KeyError, item.__getitem__, "missing")
+        legacy = QueueItem({"url": PAGE["url"], "lru": PAGE["lru"]})
+        self.assertEqual(legacy["nb_links"], 0)
+
+    def test_links_fingerprint(self):
+        links = PAGE["lrulinks"]
+        self.assertEqual(links_fingerprint(links), links_fingerprint(list(reversed(links)) + links[:1]))
+        self.assertNotEqual(links_fingerprint(links), links_fingerprint(links[1:]))
+        self.assertEqual(links_fingerprint(None), links_fingerprint([]))
@@ -0,0 +1,86 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+from twisted.internet.defer import CancelledError
+from hyphe_backend.lib import scheduler
+from hyphe_backend.lib.scheduler import IndexingScheduler, USAGE_HALF_LIFE
+
+
+class FakeTime(object):
+
+    def __init__(self):
+        self.now = 1000.
+
+    def time(self):
+        return self.now
+
+
+class IndexingSchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeTime()
+        self.time = scheduler.time
+        scheduler.time = self.clock
+        self.scheduler = IndexingScheduler(max_concurrent=2)
+        self.served = []
+
+    def tearDown(self):
+        scheduler.time = self.time
+
+    def acquire(self, corpus, backlog_since=None):
+        d = self.scheduler.acquire(corpus, backlog_since)
+        d.addCallback(lambda _: self.served.append(corpus))
+        return d
+
+    def test_slots(self):
+        for corpus in ["a", "b", "c"]:
+            self.acquire(corpus)
+        self.assertEqual(self.served, ["a", "b"])
+        self.assertEqual(self.scheduler.status()["running"], 2)
+        self.assertEqual(self.scheduler.status()["waiting"], 1)
+        self.clock.now += 3
+        self.scheduler.release("a")
+        self.assertEqual(self.served, ["a", "b", "c"])
+        status = self.scheduler.corpus_status("c")
+        self.assertEqual((status["running"], status["batches"], status["waited"]), (1, 1, 3))
+        self.assertEqual(self.scheduler.corpus_status("a")["time"], 3)
+
+    def test_oldest_backlog_first(self):
+        self.acquire("a")
+        self.acquire("b")
+        self.acquire("c", backlog_since=self.clock.now - 10)
+        self.acquire("d", backlog_since=self.clock.now - 50)
+        self.scheduler.release("a")
+        self.assertEqual(self.served, ["a", "b", "d"])
+
+    def test_recent_usage_lowers_priority(self):
+        # A corpus which just indexed for long waits behind another one
+        # with a more recent backlog
+        self.acquire("a")
+        self.clock.now += USAGE_HALF_LIFE
+        self.scheduler.release("a")
+        self.acquire("x")
+        self.acquire("y")
+        self.acquire("a", backlog_since=self.clock.now - 20)
+        self.acquire("b", backlog_since=self.clock.now - 10)
+        self.scheduler.release("x")
+        self.assertEqual(self.served[-1], "b")
+        self.assertTrue(self.scheduler.decayed_usage("a") > 0)
+        self.clock.now += USAGE_HALF_LIFE
+        self.assertAlmostEqual(self.scheduler.decayed_usage("a"), USAGE_HALF_LIFE / 2.)
+
+    def test_release_without_slot(self):
+        self.scheduler.release("a")
+        self.assertEqual(self.scheduler.status()["running"], 0)
+
+    def test_cancel(self):
+        self.acquire("a")
+        self.acquire("b")
+        waiting = self.acquire("c")
+        errors = []
+        waiting.addErrback(lambda f: errors.append(f.check(CancelledError)))
+        self.scheduler.forget("c")
+        self.assertEqual(errors, [CancelledError])
+        self.scheduler.release("a")
+        self.assertEqual(self.served, ["a", "b"])
+        self.assertEqual(self.scheduler.status()["waiting"], 0)
@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+from twisted.internet.defer import succeed, fail
+from twisted.internet.task import Clock
+from twisted.test.proto_helpers import StringTransport
+from hyphe_backend.traph import client
+from hyphe_backend.traph.metrics import TraphMetrics
+from hyphe_backend.traph.framing import MsgPackReceiver, pack_message, LINE_FRAMING, LENGTH_PREFIXED_FRAMING
+from hyphe_backend.tests.test_framing import Receiver, frame
+
+
+class FakeMonitor(object):
+    running = False
+
+    def start(self, interval):
+        self.running = True
+
+
+class FakeCorpus(object):
+    # Stands for the TraphCorpus a client protocol talks to the traph for
+
+    def __init__(self):
+        self.status = "starting"
+        self.keepalive = 60
+        self.monitor = FakeMonitor()
+        self.metrics = TraphMetrics()
+        self.lastcall = 0
+        self.call_running = False
+        self.startup_time = None
+        self.reconnections = 0
+        self.logs = []
+
+    def ready(self):
+        self.status = "ready"
+        self.startup_time = 0.1
+
+    def reconnect(self):
+        self.reconnections += 1
+
+    def stopping(self):
+        return self.status in ["stopping", "stopped", "error"]
+
+    def log(self, msg, error=False):
+        self.logs.append(msg)
+
+
+class TraphClientProtocolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.reactor = client.reactor
+        client.reactor = self.clock
+        self.config = client.config
+        client.config = {"DEBUG": 0, "traph": {"query_timeout": 10}}
+        self.corpus = FakeCorpus()
+        self.protocol = client.TraphClientProtocol(self.corpus)
+        self.connect()
+
+    def tearDown(self):
+        client.reactor = self.reactor
+        client.config = self.config
+
+    def connect(self):
+        self.protocol.makeConnection(StringTransport())
+
+    def sent(self):
+        # Decodes the queries sent since the last call
+        server = Receiver(self.protocol.framing)
+        server.dataReceived(self.protocol.transport.value())
+        self.protocol.transport.clear()
+        return server.messages
+
+    def answer(self, msg):
+        data = pack_message(msg)
+        if self.protocol.framing == LINE_FRAMING:
+            self.protocol.dataReceived(data + MsgPackReceiver.delimiter)
+        else:
+            self.protocol.dataReceived(frame(data))
+
+    def negotiate(self, framing=LENGTH_PREFIXED_FRAMING):
+        query = self.sent()[0]
+        self.assertEqual(query["method"], "set_framing")
+        self.answer({"id": query["id"], "code": "success", "result": framing})
+
+    def results(self, deferreds):
+        results = []
+        for d in deferreds:
+            d.addCallback(results.append)
+        return results
+
+    def test_negotiation(self):
+        d = self.protocol.sendQuery("count_pages", [], {})
+        self.assertEqual(self.corpus.status, "starting")
+        self.negotiate()
+        self.assertEqual(self.corpus.status, "ready")
+        self.assertEqual(self.protocol.framing, LENGTH_PREFIXED_FRAMING)
+        query = self.sent()[0]
+        self.assertEqual(query["method"], "count_pages")
+        results = self.results([d])
+        self.answer({"id": query["id"], "code": "success", "result": 3})
+        self.assertEqual(results[0]["result"], 3)
+
+    def test_negotiation_refused_by_older_servers(self):
+        self.sent()
+        self.answer({"code": "fail", "message": "Called non existing Traph method: set_framing"})
+        self.assertEqual(self.corpus.status, "ready")
+        self.assertEqual(self.protocol.framing, LINE_FRAMING)
+        self.assertEqual(self.protocol.pending, {})
+
+    def test_negotiation_timeout(self):
+        # Rather than keeping lines while the traph could still switch to
+        # frames, the connection is dropped and opened again
+        self.protocol.sendQuery("count_pages", [], {}, timeout=0)
+        self.clock.advance(self.protocol.framing_timeout)
+        self.assertTrue(self.protocol.transport.disconnecting)
+        self.protocol.connectionLost(None)
+        self.assertEqual(self.corpus.status, "starting")
+        self.assertEqual(self.protocol.framing, LINE_FRAMING)
+        self.clock.advance(self.protocol.reconnect_delay)
+        self.assertEqual(self.corpus.reconnections, 1)
+        # Queued queries are sent on the new connection once negotiated
+        self.connect()
+        self.negotiate()
+        self.assertEqual(self.corpus.status, "ready")
+        self.assertEqual([q["method"] for q in self.sent()], ["count_pages"])
+
+    def test_no_reconnection_when_stopping(self):
+        self.negotiate()
+        self.corpus.status = "stopping"
+        self.protocol.connectionLost(None)
+        self.clock.advance(self.protocol.reconnect_delay)
+        self.assertEqual(self.corpus.reconnections, 0)
+
+    def test_errors_only_fail_their_query(self):
+        self.negotiate()
+        deferreds = [self.protocol.sendQuery("count_pages", [], {}) for _ in range(3)]
+        results = self.results(deferreds)
+        queries = self.sent()
+        self.answer({"id": queries[1]["id"], "code": "fail", "message": "Traph raised"})
+        self.assertEqual([r["code"] for r in results], ["fail"])
+        self.assertEqual(len(self.protocol.pending), 2)
+        self.assertFalse(self.protocol.transport.disconnecting)
+
+    def test_undecodable_answer_with_id(self):
+        self.negotiate()
+        results = self.results([self.protocol.sendQuery("count_pages", [], {}) for _ in range(2)])
+        queries = self.sent()
+        data = pack_message({"id": queries[0]["id"], "code": "success", "result": [1, 2]})
+        self.protocol.dataReceived(frame(data[:-1] + b"\xc1"))
+        self.assertEqual([r["code"] for r in results], ["fail"])
+        self.assertEqual(self.protocol.pending.keys(), [queries[1]["id"]])
+        self.assertFalse(self.protocol.transport.disconnecting)
+        self.answer({"id": queries[1]["id"], "code": "success", "result": 0})
+        self.assertEqual([r["code"] for r in results], ["fail", "success"])
+
+    def test_unattributable_errors_drop_connection(self):
+        self.negotiate()
+        results = self.results([self.protocol.sendQuery("count_pages", [], {}) for _ in range(2)])
+        self.sent()
+        self.answer({"code": "fail", "message": "Query is not a valid JSON object"})
+        self.assertEqual([r["code"] for r in results], ["fail", "fail"])
+        self.assertTrue(self.protocol.transport.disconnecting)
+
+    def test_undecodable_answer_without_id_drops_connection(self):
+        self.negotiate()
+        results = self.results([self.protocol.sendQuery("count_pages", [], {}) for _ in range(2)])
+        self.sent()
+        self.protocol.dataReceived(frame(b"\xc1"))
+        self.assertEqual([r["code"] for r in results], ["fail", "fail"])
+        self.assertTrue(self.protocol.transport.disconnecting)
+
+    def test_read_deadlines(self):
+        self.negotiate()
+        results = self.results([
+          self.protocol.sendQuery("count_pages", [], {}),
+          self.protocol.sendQuery("add_page", ["s:http|h:com|h:example|"], {})
+        ])
+        self.sent()
+        self.clock.advance(10)
+        # Writes get no deadline
+        self.assertEqual([r["code"] for r in results], ["fail"])
+        self.assertEqual(sorted(q["method"] for q in self.protocol.pending.values()), ["add_page", "cancel"])
+        self.assertEqual(self.sent()[0]["method"], "cancel")
+
+    def test_canceled_writes_keep_running(self):
+        self.negotiate()
+        read = self.protocol.sendQuery("count_pages", [], {})
+        write = self.protocol.sendQuery("add_page", ["s:http|h:com|h:example|"], {})
+        self.sent()
+        read.addErrback(lambda _: None)
+        write.addErrback(lambda _: None)
+        read.cancel()
+        write.cancel()
+        self.assertEqual(sorted(q["method"] for q in self.protocol.pending.values()), ["add_page", "cancel"])
+        self.assertEqual([q["method"] for q in self.sent()], ["cancel"])
+
+
+class BatchCorpus(object):
+    # Stands for a ready TraphCorpus whose batch queries fail as a whole
+
+    status = "ready"
+
+    def __init__(self):
+        self.calls = []
+
+    def call_batch(self, calls, timeout=None):
+        return succeed({"code": "fail", "message": "Query timed out"})
+
+    def call(self, method, *args, **kwargs):
+        self.calls.append((method, args, kwargs))
+        if args[0] == "error":
+            return fail(ValueError("bad prefix"))
+        if args[0] == "missing":
+            return succeed({"code": "fail", "message": "No webentity"})
+        return succeed({"code": "success", "result": args[0]})
+
+
+class TraphFactoryBatchTest(unittest.TestCase):
+
+    def setUp(self):
+        self.factory = client.TraphFactory.__new__(client.TraphFactory)
+        self.factory.corpora = {"test": BatchCorpus()}
+
+    def results(self, calls):
+        results = []
+        self.factory.call_batch("test", calls, timeout=5).addCallback(results.append)
+        return results[0]
+
+    def test_failed_batch_retries_each_call(self):
+        res = self.results([("get_webentity_by_prefix", [prefix], {}) for prefix in ["a", "missing", "error"]])
+        self.assertEqual(res["code"], "success")
+        self.assertEqual([r["code"] for r in res["result"]], ["success", "fail", "fail"])
+        self.assertEqual(res["result"][0]["result"], "a")
+        self.assertTrue("bad prefix" in res["result"][2]["message"])
+        self.assertEqual(self.factory.corpora["test"].calls[0], ("get_webentity_by_prefix", ("a",), {"_timeout": 5}))
+
+    def test_single_call_not_retried(self):
+        res = self.results([("get_webentity_by_prefix", ["a"], {})])
+        self.assertEqual(res["code"], "fail")
+        self.assertEqual(self.factory.corpora["test"].calls, [])
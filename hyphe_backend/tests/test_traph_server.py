@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+
+import unittest
+from shutil import rmtree
+from tempfile import mkdtemp
+from twisted.internet.task import Clock
+from twisted.test.proto_helpers import StringTransport
+from hyphe_backend.traph import server
+from hyphe_backend.traph.sharedblock import LinksBlock
+from hyphe_backend.traph.framing import MsgPackReceiver, pack_message, LINE_FRAMING, LENGTH_PREFIXED_FRAMING
+from hyphe_backend.tests.test_framing import Receiver, frame
+
+
+class TraphProtocolTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = mkdtemp()
+        self.factory = server.TraphServerFactory("test", traph_dir=self.directory)
+        self.clock = Clock()
+        self.reactor = server.reactor
+        server.reactor = self.clock
+        self.protocol = self.factory.buildProtocol(None)
+        self.protocol.makeConnection(StringTransport())
+
+    def tearDown(self):
+        server.reactor = self.reactor
+        self.factory.close()
+        rmtree(self.directory)
+
+    def query(self, msg, framing=None):
+        data = pack_message(msg)
+        if (framing or self.protocol.framing) == LINE_FRAMING:
+            self.protocol.dataReceived(data + MsgPackReceiver.delimiter)
+        else:
+            self.protocol.dataReceived(frame(data))
+
+    def answers(self, framing=LINE_FRAMING):
+        # Runs the scheduled iterations and decodes the answers sent since
+        # the last call
+        while self.clock.getDelayedCalls():
+            self.clock.advance(0)
+        client = Receiver(framing)
+        client.dataReceived(self.protocol.transport.value())
+        self.protocol.transport.clear()
+        return client.messages
+
+    def test_query(self):
+        self.query({"id": 1, "method": "add_page", "args": ["s:http|h:com|h:example|p:page|"], "kwargs": {}})
+        self.query({"id": 2, "method": "count_pages", "args": [], "kwargs": {}})
+        answers = self.answers()
+        self.assertEqual([(a["id"], a["code"]) for a in answers], [(1, "success"), (2, "success")])
+        self.assertEqual(answers[1]["result"], 1)
+
+    def test_errors_carry_query_id(self):
+        self.query({"id": 3, "method": "not_a_traph_method", "args": [], "kwargs": {}})
+        self.query({"id": 4, "method": "count_pages"})
+        self.query({"id": 5, "method": "get_webentity_pages", "args": [], "kwargs": {}})
+        answers = self.answers()
+        self.assertEqual([(a["id"], a["code"]) for a in answers], [(3, "fail"), (4, "fail"), (5, "fail")])
+
+    def test_undecodable_query(self):
+        # The id of a query which cannot be decoded is still sent back
+        data = pack_message({"id": 6, "method": "count_pages", "args": [], "kwargs": {}})
+        self.protocol.dataReceived(data[:-1] + b"\xc1" + MsgPackReceiver.delimiter)
+        self.protocol.dataReceived(b"\xc1" + MsgPackReceiver.delimiter)
+        answers = self.answers()
+        self.assertEqual([a["code"] for a in answers], ["fail", "fail"])
+        self.assertEqual(answers[0]["id"], 6)
+        self.assertFalse("id" in answers[1])
+        self.query(["not", "a", "query"])
+        self.assertEqual(self.answers()[0]["code"], "fail")
+
+    def test_set_framing(self):
+        self.query({"id": 7, "method": "set_framing", "args": ["unknown"], "kwargs": {}})
+        answer = self.answers()[0]
+        self.assertEqual((answer["id"], answer["code"]), (7, "fail"))
+        self.assertEqual(self.protocol.framing, LINE_FRAMING)
+        # The acceptance is the last message sent with lines
+        self.query({"id": 8, "method": "set_framing", "args": [LENGTH_PREFIXED_FRAMING], "kwargs": {}})
+        answer = self.answers()[0]
+        self.assertEqual((answer["id"], answer["result"]), (8, LENGTH_PREFIXED_FRAMING))
+        self.assertEqual(self.protocol.framing, LENGTH_PREFIXED_FRAMING)
+        self.query({"id": 9, "method": "count_pages", "args": [], "kwargs": {}})
+        answer = self.answers(LENGTH_PREFIXED_FRAMING)[0]
+        self.assertEqual((answer["id"], answer["result"]), (9, 0))
+
+
+class WebentitiesInlinksTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = mkdtemp()
+        self.factory = server.TraphServerFactory("test", traph_dir=self.directory)
+        self.traph = self.factory.traph
+        hosts = ["s:http|h:com|h:site%s|" % i for i in range(6)]
+        self.traph.add_pages([host + "p:page%s|" % j for host in hosts for j in range(3)])
+        self.traph.add_page("s:http|h:com|h:uncrawled|")
+        self.traph.add_links([
+          (hosts[i % 6] + "p:page%s|" % (i % 3), hosts[(i * 7) % 6] + "p:page%s|" % (i % 2))
+          for i in range(40)
+        ] + [(hosts[0] + "p:page0|", "s:http|h:com|h:uncrawled|")])
+
+    def tearDown(self):
+        self.factory.close()
+        rmtree(self.directory)
+
+    def run_stream(self, chunk_size):
+        chunks = []
+        for item in server.stream_webentities_inlinks(self.traph, chunk_size):
+            if isinstance(item, server.TraphChunk):
+                chunks.append(item.data)
+        return chunks
+
+    def test_stream(self):
+        # Links are aggregated one target at a time, the same as the traph's
+        expected = dict((target, dict(sources)) for target, sources in self.traph.get_webentities_inlinks().items())
+        chunks = self.run_stream(3)
+        self.assertTrue(len(chunks) > 1)
+        links = {}
+        for chunk in chunks:
+            self.assertFalse(set(chunk) & set(links))
+            links.update(chunk)
+        self.assertEqual(links, expected)
+        self.assertEqual(self.run_stream(1000), [expected])
+
+    def test_shared(self):
+        for state in server.shared_webentities_inlinks(self.traph):
+            pass
+        block = LinksBlock(state.result["shm"])
+        try:
+            self.assertEqual(len(block), state.result["links"])
+            self.assertEqual(block.to_dict(), dict((target, dict(sources)) for target, sources in self.traph.get_webentities_inlinks().items()))
+        finally:
+            block.close()
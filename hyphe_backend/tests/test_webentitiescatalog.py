@@ -0,0 +1,87 @@
+# -*- coding: utf-8 -*-
+
+import random
+import unittest
+from hyphe_backend.lib.webentitieslinks import WebentitiesLinks, STATUSES
+from hyphe_backend.lib.webentitiescatalog import WebentitiesCatalog
+
+
+class WebentitiesCatalogTest(unittest.TestCase):
+
+    def setUp(self):
+        rand = random.Random(1)
+        self.WEs = {}
+        self.catalog = WebentitiesCatalog()
+        self.links = WebentitiesLinks()
+        for weid in xrange(1, 200):
+            if not rand.randrange(10):
+                continue
+            WE = {
+              "_id": weid,
+              "name": rand.choice(["alpha", "Beta", "gamma", "Delta", None]),
+              "status": rand.choice(STATUSES),
+              "crawled": rand.random() < 0.5,
+              "creationDate": rand.randrange(1000),
+              "lastModificationDate": rand.randrange(1000)
+            }
+            self.WEs[weid] = WE
+            self.catalog.update(WE)
+            self.links.add(weid)
+            self.links.set_stat(weid, "pages_crawled", rand.randrange(5))
+            self.links.set_stat(weid, "pages_total", rand.randrange(5, 10))
+            self.links.set_stat(weid, "indegree", rand.randrange(20))
+        self.links.centralities = {"pagerank": [rand.random() for _ in xrange(150)]}
+
+    def value(self, weid, field):
+        if field == "name":
+            return (self.WEs[weid]["name"] or "").upper()
+        if field == "status":
+            return self.WEs[weid]["status"]
+        if field in self.WEs[weid]:
+            return self.WEs[weid][field]
+        if field == "pagerank":
+            return self.links.centralities["pagerank"][weid] if weid < 150 else 0
+        return self.links.stat(weid, field)
+
+    def reference(self, sort):
+        ids = sorted(self.WEs)
+        for sortkey in reversed(sort):
+            field = sortkey.lstrip("-")
+            ids.sort(key=lambda weid: self.value(weid, field), reverse=(field != sortkey))
+        return ids
+
+    def test_len_and_ids(self):
+        self.assertEqual(len(self.catalog), len(self.WEs))
+        self.assertEqual(self.catalog.ids(), sorted(self.WEs))
+        self.assertEqual(self.catalog.name(5), self.WEs[5]["name"] if 5 in self.WEs else None)
+        self.assertEqual(self.catalog.name(500), None)
+
+    def test_sorted_ids(self):
+        for sort in [[], ["name"], ["-name", "_id"], ["status", "-creationDate"], ["-indegree", "name"], ["pages_total"], ["crawled", "-pages_crawled"], ["-pagerank"]]:
+            self.assertEqual(self.catalog.sorted_ids(sort, self.links), self.reference(sort))
+
+    def test_pages(self):
+        # Pages cut from the sorted ids follow each other without overlap
+        ids = self.catalog.sorted_ids(["-lastModificationDate", "_id"], self.links)
+        count = 40
+        pages = [ids[page*count:(page+1)*count] for page in xrange(len(ids) / count + 1)]
+        self.assertEqual(sum(pages, []), self.reference(["-lastModificationDate", "_id"]))
+        self.assertTrue(all(len(page) == count for page in pages[:-1]))
+
+    def test_mongo_and_unknown_fields(self):
+        self.assertEqual(self.catalog.sorted_ids(["tags", "name"], self.links), None)
+        self.assertEqual(self.catalog.sorted_ids(["unknown", "name"], self.links), self.reference(["name"]))
+
+    def test_updates(self):
+        weid = sorted(self.WEs)[0]
+        self.catalog.update({"_id": weid, "name": "zzz", "status": "OUT"})
+        self.WEs[weid].update({"name": "zzz", "status": "OUT"})
+        self.assertEqual(self.catalog.sorted_ids(["-name", "_id"], self.links)[0], weid)
+        self.assertEqual(self.catalog.sorted_ids(["status", "name"], self.links), self.reference(["status", "name"]))
+        self.catalog.remove(weid)
+        del(self.WEs[weid])
+        self.assertEqual(self.catalog.sorted_ids(["name"], self.links), self.reference(["name"]))
+        # Webentities created beyond the current size grow the columns
+        self.catalog.update({"_id": 300, "name": "zzzz", "status": "IN", "crawled": True})
+        self.assertEqual(self.catalog.sorted_ids(["-name"], self.links)[0], 300)
+        self.assertEqual(self.catalog.sorted_ids(["-pages_total"], self.links)[-1], 300)
@@ -0,0 +1,265 @@
+# -*- coding: utf-8 -*-
+
+import os
+import random
+import unittest
+from shutil import rmtree
+from tempfile import mkdtemp
+from hyphe_backend.lib import webentitieslinks
+from hyphe_backend.lib.webentitieslinks import WebentitiesLinks, WebentitiesStatuses, STATUSES
+
+
+def random_links(n_webentities, n_links, seed=1):
+    # Returns random links as {(source, target): weight}
+    rand = random.Random(seed)
+    links = {}
+    while len(links) < n_links:
+        links[(rand.randrange(n_webentities), rand.randrange(n_webentities))] = rand.randint(1, 9)
+    return links
+
+def columns(links):
+    sources, targets, weights = zip(*[(s, t, w) for (s, t), w in sorted(links.items())])
+    return list(sources), list(targets), list(weights)
+
+def reference_degrees(links, kept=None):
+    # Degrees counted with sets of neighbors, only counting the links from
+    # the sources in kept when given
+    inlinks, outlinks = {}, {}
+    for source, target in links:
+        if kept is not None and source not in kept:
+            continue
+        inlinks.setdefault(target, set()).add(source)
+        outlinks.setdefault(source, set()).add(target)
+    return dict((weid, (
+        len(inlinks.get(weid, ())),
+        len(outlinks.get(weid, ())),
+        len(inlinks.get(weid, set()) | outlinks.get(weid, set()))
+    )) for weid in set(inlinks) | set(outlinks))
+
+
+class LinksAssertions(object):
+
+    def assertSameLinks(self, rows, links):
+        self.assertEqual(sorted(rows), sorted((s, t, w) for (s, t), w in links.items()))
+        self.assertEqual(rows.n_links(), len(links))
+        for (source, target), weight in links.items():
+            self.assertEqual(rows.weight(source, target), weight)
+            self.assertTrue(rows.has_link(source, target))
+        for weid in xrange(rows.size):
+            self.assertEqual(sorted(rows.inlinks(weid)), sorted((s, w) for (s, t), w in links.items() if t == weid))
+            self.assertEqual(sorted(rows.outlinks(weid)), sorted((t, w) for (s, t), w in links.items() if s == weid))
+
+    def assertDegrees(self, rows, links, kept=None):
+        degrees = reference_degrees(links, kept)
+        for weid in xrange(rows.size):
+            expected = degrees.get(weid, (0, 0, 0))
+            self.assertEqual((rows.stat(weid, "indegree"), rows.stat(weid, "outdegree"), rows.stat(weid, "undirected_degree")), expected)
+
+
+class WebentitiesLinksTest(LinksAssertions, unittest.TestCase):
+
+    def setUp(self):
+        self.links = random_links(200, 2000)
+        self.rows = WebentitiesLinks.from_columns(*columns(self.links))
+        self.directory = mkdtemp()
+
+    def tearDown(self):
+        rmtree(self.directory)
+
+    def test_from_columns(self):
+        self.assertSameLinks(self.rows, self.links)
+        linked = set(s for s, _ in self.links) | set(t for _, t in self.links)
+        self.assertEqual(len(self.rows), len(linked))
+        self.assertFalse(self.rows.has_link(-1, 0))
+        self.assertEqual(self.rows.weight(0, self.rows.size + 10), 0)
+
+    def test_from_columns_stats(self):
+        rows = WebentitiesLinks.from_columns([-1, -2, 1], [3, 3, 2], [5, 2, 1], ["pages_crawled", "pages_uncrawled"])
+        self.assertEqual(rows.stat(3, "pages_crawled"), 5)
+        self.assertEqual(rows.stat(3, "pages_total"), 7)
+        self.assertEqual(list(rows), [(1, 2, 1)])
+        self.assertTrue(3 in rows)
+
+    def test_add_link(self):
+        links = dict(self.links)
+        rand = random.Random(2)
+        for _ in xrange(300):
+            source, target, weight = rand.randrange(250), rand.randrange(250), rand.randint(1, 3)
+            new = (source, target) not in links
+            self.assertEqual(self.rows.add_link(source, target, weight), new)
+            links[(source, target)] = links.get((source, target), 0) + weight
+        self.assertSameLinks(self.rows, links)
+        self.rows.compact()
+        self.assertEqual(self.rows.n_pending, 0)
+        self.assertSameLinks(self.rows, links)
+
+    def test_dict_round_trip(self):
+        self.rows.set_stat(5, "pages_crawled", 3)
+        self.rows.set_stat(5, "pages_total", 10)
+        rows = WebentitiesLinks.from_dict(self.rows.to_dict())
+        self.assertSameLinks(rows, self.links)
+        self.assertEqual(rows.stat(5, "pages_crawled"), 3)
+        self.assertEqual(rows.stat(5, "pages_uncrawled"), 7)
+
+    def test_save_load(self):
+        path = os.path.join(self.directory, "links.bin")
+        self.rows.set_stat(7, "pages_crawled", 4)
+        self.rows.rank()
+        links = dict(self.links)
+        # Links from the overlay are saved along the columns
+        self.rows.add_link(250, 3, 2)
+        links[(250, 3)] = 2
+        self.assertTrue(self.rows.save(path))
+        self.assertFalse(self.rows.save(path))
+        loaded = WebentitiesLinks.load(path)
+        self.assertFalse(loaded.dirty)
+        self.assertEqual(loaded.size, self.rows.size)
+        self.assertEqual(loaded.to_dict(), self.rows.to_dict())
+        self.assertSameLinks(loaded, links)
+        self.assertEqual(loaded.stat(7, "pages_crawled"), 4)
+        # Memory-mapped links can be modified and merged
+        loaded.add_link(0, 1, 5)
+        links[(0, 1)] = links.get((0, 1), 0) + 5
+        loaded.compact()
+        self.assertSameLinks(loaded, links)
+        self.assertTrue(loaded.dirty)
+
+    def test_load_empty(self):
+        path = os.path.join(self.directory, "links.bin")
+        WebentitiesLinks().save(path)
+        loaded = WebentitiesLinks.load(path)
+        self.assertEqual(len(loaded), 0)
+        self.assertEqual(list(loaded), [])
+
+    def test_load_invalid(self):
+        path = os.path.join(self.directory, "links.bin")
+        self.rows.save(path)
+        with open(path, "ab") as f:
+            f.write("xx")
+        self.assertRaises(ValueError, WebentitiesLinks.load, path)
+        with open(path, "wb") as f:
+            f.write(webentitieslinks.header.pack(b"JSON", webentitieslinks.CACHE_VERSION, 0, 0, 0))
+        self.assertRaises(ValueError, WebentitiesLinks.load, path)
+
+    def test_rank(self):
+        self.rows.rank()
+        self.assertDegrees(self.rows, self.links)
+
+    def test_rank_filtered(self):
+        statuses = WebentitiesStatuses()
+        rand = random.Random(3)
+        for weid in xrange(self.rows.size):
+            statuses.set(weid, rand.choice(STATUSES))
+        kept = set(weid for weid in xrange(self.rows.size) if statuses.get(weid) in ["IN", "UNDECIDED"])
+        self.rows.rank(statuses.mask(["IN", "UNDECIDED"]))
+        self.assertDegrees(self.rows, self.links, kept)
+        # Webentities missing from a shorter mask are filtered out
+        self.rows.rank(statuses.mask(["IN", "UNDECIDED"])[:100])
+        self.assertDegrees(self.rows, self.links, set(weid for weid in kept if weid < 100))
+
+    def test_rank_after_add_link(self):
+        self.rows.rank()
+        links = dict(self.links)
+        for source, target in [(1, 2), (2, 1), (300, 1)]:
+            self.rows.add_link(source, target, 1)
+            links[(source, target)] = links.get((source, target), 0) + 1
+        self.rows.rank()
+        self.assertDegrees(self.rows, links)
+
+    def test_ego_links(self):
+        # Adds a hub so that its links are looked up one by one
+        links = dict(self.links)
+        for weid in xrange(200):
+            links[(weid, 0)] = 1
+        rows = WebentitiesLinks.from_columns(*columns(links))
+        for weid in [0, 1, 50, 199, 500]:
+            neighbors = set([weid]) | set(t for s, t in links if s == weid) | set(s for s, t in links if t == weid)
+            expected = sorted((s, t, w) for (s, t), w in links.items() if s in neighbors and t in neighbors)
+            self.assertEqual(sorted(rows.ego_links(weid)), expected)
+
+
+class WebentitiesLinksStepsTest(LinksAssertions, unittest.TestCase):
+    # Links are added between the steps of the generators, as the indexing
+    # does while they run through twisted's cooperate
+
+    def setUp(self):
+        self.steps = webentitieslinks.STEP, webentitieslinks.LINKS_STEP
+        webentitieslinks.STEP, webentitieslinks.LINKS_STEP = 7, 50
+        self.links = random_links(200, 2000)
+        self.rows = WebentitiesLinks()
+        steps = self.rows.build_from_columns(*columns(self.links))
+        self.assertTrue(len(list(steps)) > 10)
+
+    def tearDown(self):
+        webentitieslinks.STEP, webentitieslinks.LINKS_STEP = self.steps
+
+    def add_links(self, links, rand):
+        for _ in xrange(20):
+            source, target = rand.randrange(230), rand.randrange(230)
+            self.rows.add_link(source, target, 1)
+            self.rows.add_link(target, source, 2)
+            links[(source, target)] = links.get((source, target), 0) + 1
+            links[(target, source)] = links.get((target, source), 0) + 2
+
+    def run_steps(self, steps, links, seed=1):
+        # Adds links every few steps
+        rand = random.Random(seed)
+        for i, _ in enumerate(steps):
+            if not i % 5:
+                self.add_links(links, rand)
+
+    def test_compact_steps(self):
+        links = dict(self.links)
+        self.add_links(links, random.Random(2))
+        self.run_steps(self.rows.compact_steps(), links)
+        # Links added meanwhile are left in the overlay
+        self.assertTrue(self.rows.n_pending)
+        self.assertFalse(self.rows.compacting)
+        self.assertSameLinks(self.rows, links)
+        self.rows.compact()
+        self.assertEqual(self.rows.n_pending, 0)
+        self.assertSameLinks(self.rows, links)
+
+    def test_rank_steps(self):
+        links = dict(self.links)
+        self.add_links(links, random.Random(2))
+        self.run_steps(self.rows.rank_steps(), links)
+        self.assertTrue(self.rows.n_pending)
+        self.assertDegrees(self.rows, links)
+
+    def test_rank_steps_filtered(self):
+        statuses = WebentitiesStatuses()
+        rand = random.Random(3)
+        for weid in xrange(230):
+            statuses.set(weid, rand.choice(STATUSES))
+        kept = set(weid for weid in xrange(230) if statuses.get(weid) in ["IN", "UNDECIDED"])
+        links = dict(self.links)
+        self.run_steps(self.rows.rank_steps(statuses.mask(["IN", "UNDECIDED"])), links)
+        self.assertDegrees(self.rows, links, kept)
+
+    def test_rank_steps_compacted_meanwhile(self):
+        # The columns are read again when replaced while ranking
+        links = dict(self.links)
+        steps = self.rows.rank_steps()
+        for _ in xrange(20):
+            next(steps)
+        self.add_links(links, random.Random(2))
+        builds = self.rows.builds
+        self.rows.compact()
+        self.assertEqual(self.rows.builds, builds + 1)
+        self.run_steps(steps, links)
+        self.assertDegrees(self.rows, links)
+
+
+class WebentitiesStatusesTest(unittest.TestCase):
+
+    def test_mask(self):
+        statuses = WebentitiesStatuses()
+        for weid, status in [(1, "IN"), (2, "OUT"), (4, "UNDECIDED"), (5, "DISCOVERED")]:
+            statuses.set(weid, status)
+        statuses.remove(5)
+        self.assertEqual(statuses.get(2), "OUT")
+        self.assertEqual(statuses.get(5), None)
+        self.assertEqual(statuses.get(10), None)
+        self.assertEqual(list(statuses.mask(["IN", "UNDECIDED"])), [0, 1, 0, 0, 1, 0])
+        self.assertEqual(list(statuses.mask(["OUT"], size=8)), [0, 0, 1, 0, 0, 0, 0, 0])
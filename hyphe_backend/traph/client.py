@@ -2,39 +2,71 @@ import os, sys
 import json, msgpack
 import shutil
 from time import time, sleep
+from itertools import count
 from collections import deque
 from twisted.python import log
 from twisted.internet import reactor
 from twisted.internet.task import LoopingCall
-from twisted.internet.defer import Deferred, inlineCallbacks, returnValue as returnD
+from twisted.internet.defer import Deferred, DeferredList, inlineCallbacks, returnValue as returnD
 from twisted.internet.error import ConnectError
 from twisted.internet.protocol import ProcessProtocol, Factory
 from twisted.internet.endpoints import UNIXClientEndpoint
-from twisted.protocols.basic import LineOnlyReceiver
+from hyphe_backend.traph.framing import MsgPackReceiver, LINE_FRAMING, LENGTH_PREFIXED_FRAMING
+from hyphe_backend.traph.metrics import TraphMetrics
+from hyphe_backend.traph.sharedblock import LinksBlock, remove_block
 from hyphe_backend.lib.utils import deferredSleep, lightLogVar
 from hyphe_backend.lib import config_hci
 config = config_hci.load_config()
 
-class TraphFactory(object):
+def process_memory(pid):
+    # Resident memory of a process in MB as reported by the kernel
+    try:
+        with open("/proc/%s/status" % pid) as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024.
+    except (IOError, ValueError):
+        pass
+    return 0
 
-    # TODO:
-    # handle timedout queries
-    # handle max started corpus ?
-    # max ram ?
+class TraphFactory(object):
 
     sockets_dir = "traph-sockets"
+    pool_name = "traph-pool"
+    # Seconds between two checks of the memory used by the traphs
+    memory_check_interval = 15
+    # Seconds without any call before a corpus can be evicted
+    eviction_min_idle = 60
 
     # TODO reset default chatty to False when fixed problem starting traph with it
-    def __init__(self, data_dir="traph-data", max_corpus=0, chatty=True):
+    def __init__(self, data_dir="traph-data", max_corpus=0, chatty=True, pool_size=0, memory_budget=0):
         self.data_dir = data_dir
         self.max_corpus = max_corpus
+        # Total resident memory in MB allowed to the running traphs
+        self.memory_budget = memory_budget
+        self.evictions = 0
+        self.last_eviction = None
+        # Start requests waiting for a free slot, in arrival order
+        self.start_queue = deque()
         self.chatty = chatty
         self.corpora = {}
+        # Idle traph processes already started and waiting for a corpus
+        self.pool_size = pool_size
+        self.pool = []
+        self.startups = {
+          "warm": {"count": 0, "total_time": 0, "last_time": None},
+          "cold": {"count": 0, "total_time": 0, "last_time": None}
+        }
+        # Traph calls metrics by corpus, kept across restarts
+        self.metrics = {}
         if not os.path.isdir(self.data_dir):
             os.makedirs(self.data_dir)
         if not os.path.isdir(self.sockets_dir):
             os.makedirs(self.sockets_dir)
         reactor.addSystemEventTrigger('before', 'shutdown', self.stop)
+        reactor.callWhenRunning(self.fill_pool)
+        self.memory_monitor = LoopingCall(self.check_memory)
+        reactor.callWhenRunning(self.memory_monitor.start, self.memory_check_interval, False)
 
     def log(self, name, msg, error=False, quiet=False):
         if quiet and not error:
@@ -50,6 +82,8 @@ class TraphFactory(object):
 
     def status_corpus(self, name, simplify=False):
         if name not in self.corpora:
+            if self.queued_corpus(name):
+                return "starting" if simplify else "queued"
             return "stopped"
         if not simplify:
             return self.corpora[name].status
@@ -73,10 +107,23 @@ class TraphFactory(object):
     def total_running(self):
         return len([0 for a in self.corpora if not self.stopped_corpus(a)])
 
+    def queued_corpus(self, name):
+        return any(start["name"] == name for start in self.start_queue)
+
     def is_full(self):
-        return self.max_corpus and self.total_running() >= self.max_corpus
+        if self.max_corpus and self.total_running() >= self.max_corpus:
+            return True
+        return self.over_budget()
+
+    def memory_used(self):
+        return sum(c.memory() for n, c in self.corpora.items() if not self.stopped_corpus(n))
+
+    def over_budget(self):
+        return bool(self.memory_budget) and self.memory_used() >= self.memory_budget
 
     def start_corpus(self, name, quiet=False, **kwargs):
+        # Returns whether the traph started, or a Deferred firing it once
+        # a slot frees up when too many traphs are already running
         if self.test_corpus(name) or self.status_corpus(name) == "started":
             if config["DEBUG"]:
                 self.log(name, "Traph already started", quiet=quiet)
@@ -86,14 +133,87 @@ class TraphFactory(object):
             if "keepalive" not in kwargs:
                 kwargs["keepalive"] = self.corpora[name].keepalive
             del(self.corpora[name])
-        if self.is_full():
-            self.log(name, "Too many Traphs already opened", True)
-            return False
+        for start in self.start_queue:
+            if start["name"] == name:
+                start["deferreds"].append(Deferred())
+                return start["deferreds"][-1]
+        self.process_start_queue()
+        if self.start_queue or not self.make_room():
+            self.log(name, "Too many Traphs already opened, queuing start until a slot frees up", quiet=quiet)
+            start = {
+              "name": name,
+              "quiet": quiet,
+              "kwargs": kwargs,
+              "since": time(),
+              "deferreds": [Deferred()]
+            }
+            self.start_queue.append(start)
+            return start["deferreds"][0]
         self.corpora[name] = TraphCorpus(self, name, quiet=quiet, **kwargs)
         return self.corpora[name].start()
 
+    def process_start_queue(self):
+        while self.start_queue and self.make_room():
+            start = self.start_queue.popleft()
+            self.log(start["name"], "Starting queued Traph after %ss" % int(time() - start["since"]), quiet=start["quiet"])
+            self.corpora[start["name"]] = TraphCorpus(self, start["name"], quiet=start["quiet"], **start["kwargs"])
+            res = self.corpora[start["name"]].start()
+            for d in start["deferreds"]:
+                d.callback(res)
+
+    def cancel_start(self, name):
+        for start in list(self.start_queue):
+            if start["name"] == name:
+                self.start_queue.remove(start)
+                for d in start["deferreds"]:
+                    d.callback(False)
+                return True
+        return False
+
+    def make_room(self):
+        # Stops the least recently used idle traphs while over the memory
+        # budget, then tells whether a new one can be started
+        while self.over_budget() and self.evict_idle_corpus():
+            pass
+        return not self.is_full()
+
+    def evict_idle_corpus(self):
+        idle = [c for c in self.corpora.values() if c.idle(self.eviction_min_idle)]
+        if not idle:
+            return False
+        corpus = min(idle, key=lambda c: c.lastcall)
+        used = self.memory_used()
+        corpus.log("Stopping least recently used Traph (%.1fMB) to stay within memory budget (%.1fMB used out of %sMB)" % (corpus.memory(), used, self.memory_budget))
+        self.evictions += 1
+        self.last_eviction = {
+          "corpus": corpus.name,
+          "memory": corpus.memory(),
+          "memory_used": used,
+          "time": int(time() * 1000)
+        }
+        corpus.stop()
+        return True
+
+    def check_memory(self):
+        self.make_room()
+        self.process_start_queue()
+
+    def memory_status(self):
+        corpora = dict((n, round(c.memory(), 1)) for n, c in self.corpora.items() if not self.stopped_corpus(n))
+        return {
+          "budget": self.memory_budget,
+          "used": round(sum(corpora.values()), 1),
+          "corpora": corpora,
+          "pool": round(sum(process_memory(p.transport.pid) for p in self.pool if p.transport and p.transport.pid), 1),
+          "evictions": self.evictions,
+          "last_eviction": self.last_eviction,
+          "queued_starts": [start["name"] for start in self.start_queue]
+        }
+
     @inlineCallbacks
     def stop_corpus(self, name, quiet=False):
+        if self.cancel_start(name):
+            returnD(True)
         if self.stopped_corpus(name):
             if config["DEBUG"]:
                 self.log(name, "Traph already stopped", quiet=quiet)
@@ -106,17 +226,155 @@ class TraphFactory(object):
     def destroy_corpus(self, name, quiet=False):
         if name in self.corpora:
             yield self.corpora[name].destroy()
+        self.metrics.pop(name, None)
 
     @inlineCallbacks
     def stop(self):
+        if self.memory_monitor.running:
+            self.memory_monitor.stop()
+        while self.start_queue:
+            self.cancel_start(self.start_queue[0]["name"])
+        self.pool_size = 0
+        for process in self.pool:
+            process.stop()
+        self.pool = []
         for corpus in self.corpora:
             yield self.stop_corpus(corpus, True)
 
+    def fill_pool(self):
+        while len(self.pool) < self.pool_size:
+            process = TraphProcessProtocol(self)
+            reactor.spawnProcess(
+              process,
+              sys.executable,
+              [sys.executable, "-u", TraphCorpus.exec_path, "--pool"],
+              env=os.environ
+            )
+            self.pool.append(process)
+
+    def pop_pool_process(self):
+        # Only hand out processes which finished their imports
+        for process in self.pool:
+            if process.warm:
+                self.pool.remove(process)
+                return process
+        return None
+
+    def record_startup(self, duration, warm):
+        stats = self.startups["warm" if warm else "cold"]
+        stats["count"] += 1
+        stats["total_time"] += duration
+        stats["last_time"] = duration
+
+    def pool_status(self):
+        res = {
+          "size": self.pool_size,
+          "idle": len([p for p in self.pool if p.warm])
+        }
+        for kind, stats in self.startups.items():
+            res["%s_starts" % kind] = stats["count"]
+            res["%s_startup_time" % kind] = stats["total_time"] / stats["count"] if stats["count"] else None
+            res["last_%s_startup_time" % kind] = stats["last_time"]
+        return res
+
     def call(self, corpus, method, *args, **kwargs):
         if not self.test_corpus(corpus):
             return {"code": "fail", "message": "Corpus traph not ready"}
         return self.corpora[corpus].call(method, *args, **kwargs)
 
+    def queue_status(self, corpus):
+        if not self.test_corpus(corpus):
+            return {}
+        return self.corpora[corpus].queue_status()
+
+    @inlineCallbacks
+    def call_batch(self, corpus, calls, timeout=None):
+        # Runs a list of (method, args, kwargs) calls in a single query and
+        # returns the list of their individual results or errors
+        if not self.test_corpus(corpus):
+            returnD({"code": "fail", "message": "Corpus traph not ready"})
+        if not calls:
+            returnD({"code": "success", "result": []})
+        res = yield self.corpora[corpus].call_batch(calls, timeout)
+        if res["code"] != "fail" or len(calls) == 1 or not self.test_corpus(corpus):
+            returnD(res)
+        # When the batch failed as a whole, its calls are run one by one so
+        # that an error only reaches the call it belongs to
+        results = yield DeferredList([self.corpora[corpus].call(method, *args, **dict(kwargs, _timeout=timeout)) for method, args, kwargs in calls], consumeErrors=True)
+        returnD({"code": "success", "result": [
+          result if ok else {"code": "fail", "message": "%s: %s" % (method, result.getErrorMessage())}
+          for (method, _, _), (ok, result) in zip(calls, results)
+        ]})
+
+    @inlineCallbacks
+    def stream(self, corpus, method, callback, *args, **kwargs):
+        # Runs a query whose result is sent back in successive chunks, each
+        # one being handed to callback before the next one is asked for
+        if not self.test_corpus(corpus):
+            returnD({"code": "fail", "message": "Corpus traph not ready"})
+        # The deadline applies to each chunk
+        timeout = kwargs.pop("_timeout", None)
+        res = yield self.corpora[corpus].call_chunked(method, config["traph"]["stream_chunk_size"], timeout, *args, **kwargs)
+        metrics = self.corpus_metrics(corpus)
+        round_trips = 1
+        try:
+            while res["code"] != "fail":
+                if res["result"] is not None:
+                    yield callback(res["result"])
+                if "iterator" not in res:
+                    break
+                if not self.test_corpus(corpus):
+                    res = {"code": "fail", "message": "Corpus traph stopped while streaming %s" % method}
+                    break
+                iteratorId = res["iterator"]
+                res = yield self.corpora[corpus].next_chunk(method, iteratorId, timeout)
+                round_trips += 1
+        except:
+            # Do not leave the traph keeping the rest of the results when the
+            # callback failed or the stream was canceled in between chunks
+            if "iterator" in res and self.test_corpus(corpus):
+                self.corpora[corpus].cancel_iterator(res["iterator"])
+            raise
+        metrics.record_call(method, round_trips, res.get("iterations"))
+        if res["code"] == "fail":
+            returnD(res)
+        returnD({"code": "success", "result": res["query"]["chunks"], "query": res["query"]})
+
+    @inlineCallbacks
+    def call_shared(self, corpus, method, *args, **kwargs):
+        # Runs a query whose bulk result is written by the traph in a shared
+        # memory block and returns it mapped as a LinksBlock to be closed
+        if not self.test_corpus(corpus):
+            returnD({"code": "fail", "message": "Corpus traph not ready"})
+        timeout = kwargs.pop("_timeout", None)
+        res = yield self.corpora[corpus].call_shared(method, timeout, *args, **kwargs)
+        if res["code"] == "fail":
+            returnD(res)
+        try:
+            res["result"] = LinksBlock(res["result"]["shm"])
+        except Exception as e:
+            remove_block(res["result"]["shm"])
+            returnD({"code": "fail", "message": "Could not read shared result of %s: %s %s" % (method, type(e), e)})
+        returnD(res)
+
+    def call_links_deltas(self, corpus, method, *args, **kwargs):
+        # Runs an indexing query whose report also holds the changes it
+        # brought to the links between webentities
+        if not self.test_corpus(corpus):
+            return {"code": "fail", "message": "Corpus traph not ready"}
+        timeout = kwargs.pop("_timeout", None)
+        return self.corpora[corpus].call_links_deltas(method, timeout, *args, **kwargs)
+
+    def corpus_metrics(self, name):
+        if name not in self.metrics:
+            self.metrics[name] = TraphMetrics()
+        return self.metrics[name]
+
+    def get_metrics(self, name=None):
+        if name is not None:
+            return self.corpus_metrics(name).json()
+        return dict((c, m.json()) for c, m in self.metrics.items())
+
 class TraphCorpus(object):
 
     exec_path = os.path.join("hyphe_backend", "traph", "server.py")
@@ -130,7 +388,7 @@ class TraphCorpus(object):
         self.socket = os.path.join(self.factory.sockets_dir, name)
         self.pidfile = self.socket + ".pid"
         self.options_file = self.socket + "-options.json"
-        self.links_file = os.path.join(self.factory.data_dir, name + "_webentitieslinks.json")
+        self.links_files = [os.path.join(self.factory.data_dir, name + "_webentitieslinks." + ext) for ext in ["bin", "json"]]
         self.options = {
           "traph_dir": self.factory.data_dir,
           "default_WECR": default_WECR,
@@ -140,6 +398,10 @@ class TraphCorpus(object):
         self.keepalive = keepalive
         self.lastcall = time()
         self.call_running = False
+        self.start_time = None
+        self.startup_time = None
+        self.warm_start = False
+        self.metrics = factory.corpus_metrics(name)
         self.monitor = LoopingCall(self.__check_timeout__)
         self.error = None
         self.transport = None
@@ -149,31 +411,93 @@ class TraphCorpus(object):
     def start(self):
         self.error = None
         self.status = "started"
-        cmd = [
-          sys.executable,
-          "-u",
-          self.exec_path,
-          self.socket,
-          self.name
-        ]
+        self.start_time = time()
+        self.startup_time = None
         self.checkAndRemovePID(True)
         with open(self.options_file, "w") as f:
             json.dump(self.options, f)
-        self.log("Starting Traph for at least %ss: %s" % (self.keepalive, " ".join(cmd)))
-        self.protocol = TraphProcessProtocol(self.socket, self)
-        self.transport = reactor.spawnProcess(
-          self.protocol,
-          cmd[0],
-          cmd,
-          env=os.environ
-        )
+        self.protocol = self.factory.pop_pool_process()
+        self.warm_start = self.protocol is not None
+        if self.warm_start:
+            self.log("Starting Traph from a pooled process for at least %ss" % self.keepalive)
+            self.protocol.assign(self.socket, self)
+            self.transport = self.protocol.transport
+        else:
+            cmd = [
+              sys.executable,
+              "-u",
+              self.exec_path,
+              self.socket,
+              self.name
+            ]
+            self.log("Starting Traph for at least %ss: %s" % (self.keepalive, " ".join(cmd)))
+            self.protocol = TraphProcessProtocol(self.factory, self.socket, self)
+            self.transport = reactor.spawnProcess(
+              self.protocol,
+              cmd[0],
+              cmd,
+              env=os.environ
+            )
         with open(self.pidfile, "w") as f:
             f.write(str(self.transport.pid))
         self.client = self.protocol.client
+        self.factory.fill_pool()
         return True
 
+    def ready(self):
+        self.status = "ready"
+        self.startup_time = time() - self.start_time
+        self.factory.record_startup(self.startup_time, self.warm_start)
+
+    def reconnect(self):
+        # Opens a new connection to the running traph process after the
+        # previous one was dropped, queued queries being sent once ready
+        if self.status != "starting" or not self.transport:
+            return
+        self.log("Reconnecting to Traph")
+        d = self.protocol.connectClient()
+        d.addErrback(lambda failure: self.log("Could not reconnect to Traph: %s" % failure.getErrorMessage(), True))
+
     def call(self, method, *args, **kwargs):
-        return self.client.sendMessage(method, *args, **kwargs)
+        # _timeout sets the deadline of the query in seconds instead of the
+        # configured one, 0 for none
+        timeout = kwargs.pop("_timeout", None)
+        return self.client.sendQuery(method, args, kwargs, timeout=timeout)
+
+    def call_chunked(self, method, chunk_size, timeout=None, *args, **kwargs):
+        return self.client.sendQuery(method, args, kwargs, timeout=timeout, chunk_size=chunk_size)
+
+    def call_shared(self, method, timeout=None, *args, **kwargs):
+        return self.client.sendQuery(method, args, kwargs, timeout=timeout, transfer="shm")
+
+    def call_links_deltas(self, method, timeout=None, *args, **kwargs):
+        return self.client.sendQuery(method, args, kwargs, timeout=timeout, links_deltas=True)
+
+    def call_batch(self, calls, timeout=None):
+        priority = min((method_priority(method) for method, _, _ in calls), key=PRIORITY_CLASSES.index)
+        return self.client.sendQuery("batch", [[{
+          "method": method,
+          "args": args,
+          "kwargs": kwargs
+        } for method, args, kwargs in calls]], {}, priority=priority, timeout=timeout)
+
+    def next_chunk(self, method, iteratorId, timeout=None):
+        return self.client.sendQuery("iterate_previous_query", [iteratorId], {}, label=method, timeout=timeout)
+
+    def cancel_iterator(self, iteratorId):
+        return self.client.sendCancel(iterator=iteratorId)
+
+    def queue_status(self):
+        return self.client.queue.status()
+
+    def memory(self):
+        if self.transport and self.transport.pid:
+            return process_memory(self.transport.pid)
+        return 0
+
+    def idle(self, delay=0):
+        return self.status == "ready" and not self.call_running and \
+          self.client.queue.empty() and time() - self.lastcall >= delay
 
     @inlineCallbacks
     def __check_timeout__(self):
@@ -201,6 +525,8 @@ class TraphCorpus(object):
         if not self.error:
             self.status = "stopped"
         self.checkAndRemovePID()
+        # Let corpora waiting for a slot take this one
+        reactor.callLater(0, self.factory.process_start_queue)
 
     def checkAndRemovePID(self, warn=False):
         if os.path.exists(self.pidfile):
@@ -233,8 +559,9 @@ class TraphCorpus(object):
             shutil.rmtree(self.directory)
         if os.path.exists(self.options_file):
             os.remove(self.options_file)
-        if os.path.exists(self.links_file):
-            os.remove(self.links_file)
+        for links_file in self.links_files:
+            if os.path.exists(links_file):
+                os.remove(links_file)
 
     def log(self, msg, error=False):
         self.factory.log(self.name, msg, error, quiet=self.quiet)
@@ -242,26 +569,42 @@ class TraphCorpus(object):
 
 class TraphProcessProtocol(ProcessProtocol):
 
-    def __init__(self, socket, corpus):
+    def __init__(self, factory, socket=None, corpus=None):
+        self.factory = factory
         self.socket = socket
         self.corpus = corpus
-        self.client = TraphClientProtocol(corpus)
+        self.client = TraphClientProtocol(corpus) if corpus else None
+        # Pooled processes wait for a corpus to be assigned to them
+        self.warm = False
 
     def connectionMade(self):
+        if self.corpus:
+            self.corpus.status = "starting"
+
+    def assign(self, socket, corpus):
+        self.socket = socket
+        self.corpus = corpus
+        self.client = TraphClientProtocol(corpus)
         self.corpus.status = "starting"
+        self.transport.write(json.dumps({"socket": socket, "corpus": corpus.name}) + "\n")
 
     def connectClient(self):
         class TraphClientFactory(Factory):
             def buildProtocol(this, addr):
                 return self.client
         t = TraphClientFactory()
-        if not self.corpus.factory.chatty:
+        if not self.factory.chatty:
             t.noisy = False
-        UNIXClientEndpoint(reactor, self.socket).connect(t)
+        return UNIXClientEndpoint(reactor, self.socket).connect(t)
 
     def childDataReceived(self, childFD, data):
         data = data.strip()
-        if childFD == 1 and data == "READY":
+        if not self.corpus:
+            if childFD == 1 and data == "WAITING":
+                self.warm = True
+            else:
+                self.factory.log(self.factory.pool_name, 'Pooled Traph process received "%s"' % data, childFD == 2 and "RuntimeWarning" not in data and "DeprecationWarning" not in data)
+        elif childFD == 1 and data == "READY":
             try:
                 self.connectClient()
             except ConnectError as e:
@@ -275,8 +618,14 @@ class TraphProcessProtocol(ProcessProtocol):
         pass
 
     def processExited(self, reason):
-        self.corpus.status = "stopping"
         self.transport.loseConnection()
+        if not self.corpus:
+            if self in self.factory.pool:
+                self.factory.pool.remove(self)
+            if reason.value.exitCode:
+                self.factory.log(self.factory.pool_name, "Pooled Traph process crashed: %s" % reason, True)
+            return
+        self.corpus.status = "stopping"
         rc = reason.value.exitCode
         if not rc:
             self.corpus.status = "stopped"
@@ -286,112 +635,375 @@ class TraphProcessProtocol(ProcessProtocol):
             self.corpus.error = reason
             self.corpus.log("Traph process crashed: %s" % reason, True)
         self.corpus.checkAndRemovePID()
+        reactor.callLater(0, self.factory.process_start_queue)
 
     def stop(self):
-        self.corpus.status = "stopping"
+        if self.corpus:
+            self.corpus.status = "stopping"
         self.transport.loseConnection()
         if self.transport.pid:
             self.transport.signalProcess("TERM")
 
+# Priority classes of traph queries, from the most to the least urgent
+PRIORITY_CLASSES = ["interactive", "default", "indexing", "analytics"]
+METHODS_PRIORITY = {
+  "get_webentity_by_prefix": "interactive",
+  "retrieve_webentity": "interactive",
+  "get_potential_prefix": "interactive",
+  "get_webentity_parent_webentities": "interactive",
+  "get_webentity_child_webentities": "interactive",
+  "paginate_webentity_pages": "interactive",
+  "paginate_webentity_pagelinks": "interactive",
+  "index_batch_crawl": "indexing",
+  "get_webentities_links": "analytics",
+  "get_webentities_inlinks": "analytics",
+  "get_webentities_outlinks": "analytics",
+  "get_webentity_pagelinks": "analytics"
+}
+
+def method_priority(method):
+    return METHODS_PRIORITY.get(method, "default")
+
+# Methods modifying the traph, which never get a deadline since canceling
+# them could leave their changes partly applied
+WRITE_METHODS = set([
+  "add_page",
+  "add_pages",
+  "add_prefix_to_webentity",
+  "add_webentity_creation_rule",
+  "clear",
+  "create_webentity",
+  "delete_webentity",
+  "index_batch_crawl",
+  "remove_prefix_from_webentity",
+  "remove_webentity_creation_rule"
+])
+
+def method_writes(method, args):
+    if method == "batch":
+        return any(method_writes(call["method"], call["args"]) for call in args[0])
+    return method in WRITE_METHODS
+
 class Queue(object):
 
+    # Seconds after which a waiting query goes before more urgent ones
+    starvation_delay = 5
+
     def __init__(self):
-        self.queue = []
+        self.queues = dict((c, deque()) for c in PRIORITY_CLASSES)
+        self.stats = dict((c, {
+          "queued": 0,
+          "max_queued": 0,
+          "sent": 0,
+          "promoted": 0
+        }) for c in PRIORITY_CLASSES)
 
-    def empty(self):
-        return len(self.queue) == 0
+    def empty(self, classes=PRIORITY_CLASSES):
+        return not any(self.queues[c] for c in classes)
 
-    def put_nowait(self, value):
-        self.queue.append(value)
+    def put_nowait(self, value, priority="default"):
+        self.queues[priority].append((time(), value))
+        stats = self.stats[priority]
+        stats["queued"] = len(self.queues[priority])
+        stats["max_queued"] = max(stats["max_queued"], stats["queued"])
 
-    def get_nowait(self):
-        return self.queue.pop(0)
+    def get_nowait(self, classes=PRIORITY_CLASSES):
+        # Take the most urgent query, unless one has been waiting too long
+        classes = [c for c in classes if self.queues[c]]
+        oldest = min(classes, key=lambda c: self.queues[c][0][0])
+        if time() - self.queues[oldest][0][0] > self.starvation_delay and oldest != classes[0]:
+            priority = oldest
+            self.stats[priority]["promoted"] += 1
+        else:
+            priority = classes[0]
+        _, value = self.queues[priority].popleft()
+        self.stats[priority]["queued"] = len(self.queues[priority])
+        self.stats[priority]["sent"] += 1
+        return value
 
     def len(self):
-        return len(self.queue)
+        return sum(len(q) for q in self.queues.values())
+
+    def remove(self, value):
+        for c in PRIORITY_CLASSES:
+            for i, (_, item) in enumerate(self.queues[c]):
+                if item is value:
+                    del(self.queues[c][i])
+                    self.stats[c]["queued"] = len(self.queues[c])
+                    return True
+        return False
 
     def drop(self):
-        self.queue = []
+        for c in PRIORITY_CLASSES:
+            self.queues[c].clear()
+            self.stats[c]["queued"] = 0
 
-class TraphClientProtocol(LineOnlyReceiver):
+    def status(self):
+        now = time()
+        res = {}
+        for c in PRIORITY_CLASSES:
+            res[c] = dict(self.stats[c])
+            res[c]["oldest_wait"] = now - self.queues[c][0][0] if self.queues[c] else 0
+        return res
 
-    delimiter = b"\r\n##TxHypheMsgPackDelimiter\r\n"
-    MAX_LENGTH = 536870912
+class TraphClientProtocol(MsgPackReceiver):
 
-    def __init__(self, corpus, max_successive_non_iterated_calls=10):
+    # Seconds after which a traph not answering the framing negotiation is
+    # reconnected to, since it could still switch framing afterwards
+    framing_timeout = 30
+    # Seconds before reconnecting to a traph after dropping the connection
+    reconnect_delay = 1
+
+    def __init__(self, corpus, max_simultaneous_queries=10):
         self.corpus = corpus
-        self.deferred = None
         self.queue = Queue()
-        self.iteratorQueue = Queue()
-        self.last_query = None
-        self.last_queries = deque(maxlen=max_successive_non_iterated_calls)
-        self.start_query = None
+        # Queries sent to the traph server and not answered yet, by query id
+        self.pending = {}
+        # Ids of queries canceled after being sent, whose answer is ignored
+        self.canceled = set()
+        self.query_ids = count(1)
+        self.max_simultaneous_queries = max_simultaneous_queries
+        self.negotiating = False
 
     def connectionMade(self):
-        self.corpus.log("Traph ready")
-        self.corpus.status = "ready"
-        self.corpus.monitor.start(max(1, int(self.corpus.keepalive/6)))
+        if not self.corpus.monitor.running:
+            self.corpus.monitor.start(max(1, int(self.corpus.keepalive/6)))
+        # Ask for length-prefixed framing before sending anything else,
+        # older traph servers will refuse it, with an answer without query
+        # id, and keep using lines
+        self.setFraming(LINE_FRAMING)
+        self._buffer = b""
+        self.negotiating = True
+        query = self._newQuery("set_framing", [LENGTH_PREFIXED_FRAMING], {})
+        query["deadline"] = reactor.callLater(self.framing_timeout, self._framingTimedOut)
+        self._sendQuery(query).addBoth(self._framingNegotiated)
+
+    def _framingTimedOut(self):
+        # The traph could still accept the framing later on, so rather than
+        # talking over a half-negotiated connection, open a new one
+        self.corpus.log("WARNING: Traph did not answer the framing negotiation within %ss, reconnecting" % self.framing_timeout)
+        self.transport.loseConnection()
+
+    def _framingNegotiated(self, msg):
+        # Answers failed by a lost connection are left to the next one
+        if not self.negotiating:
+            return
+        self.negotiating = False
+        if isinstance(msg, dict) and msg.get("code") == "success":
+            self.setFraming(msg["result"])
+        else:
+            self.setFraming(LINE_FRAMING)
+        if self.corpus.startup_time is None:
+            self.corpus.ready()
+            self.corpus.log("Traph ready in %.2fs (%s framing)" % (self.corpus.startup_time, self.framing))
+        else:
+            self.corpus.status = "ready"
+            self.corpus.log("Reconnected to Traph (%s framing)" % self.framing)
+        self._sendMessageNow()
+
+    def connectionLost(self, reason):
+        self.negotiating = False
+        self.canceled.clear()
+        self._failPending("Connection to Traph lost while running %s")
+        # Queued queries are kept for the next connection to the traph
+        # process, unless it is being stopped or crashed
+        if self.corpus.status in ["starting", "ready"]:
+            self.corpus.status = "starting"
+            reactor.callLater(self.reconnect_delay, self.corpus.reconnect)
+
+    def _dropConnection(self, message):
+        # The answers received can no longer be matched to their queries,
+        # all pending ones are failed and a new connection is opened
+        self.corpus.log("WARNING: %s, reconnecting to Traph" % message)
+        self._failPending("Traph connection dropped while running %%s: %s" % message.replace("%", "%%"))
+        self.transport.loseConnection()
+
+    def _failPending(self, message):
+        # Answers with a fail all queries sent and not answered yet,
+        # message being formatted with each query's method
+        pending = self.pending
+        self.pending = {}
+        for queryId, query in pending.items():
+            self._clearDeadline(query)
+            query["deferred"].callback({
+              "code": "fail",
+              "message": message % query["method"]
+            })
+        self.corpus.call_running = False
 
     def sendMessage(self, method, *args, **kwargs):
-        deferred = Deferred()
+        return self.sendQuery(method, args, kwargs)
+
+    def sendQuery(self, method, args, kwargs, priority=None, label=None, timeout=None, **options):
+        # label is the method under which metrics are recorded, for
+        # instance the original query for the next chunks of a stream
         self.corpus.lastcall = time()
-        self.queue.put_nowait((deferred, method, args, kwargs))
-        if self.corpus.status == "ready" and not self.deferred:
+        query = self._newQuery(method, args, kwargs, options, label)
+        # Deadline counted from now, so including the time spent in queue,
+        # only for queries reading from the traph
+        if timeout is None:
+            timeout = config["traph"]["query_timeout"]
+        if timeout and not method_writes(method, args):
+            query["deadline"] = reactor.callLater(timeout, self._queryTimedOut, query, timeout)
+        self.queue.put_nowait(query, priority or method_priority(label or method))
+        if self.corpus.status == "ready":
             self._sendMessageNow()
-        return deferred
+        return query["deferred"]
+
+    def _newQuery(self, method, args, kwargs, options={}, label=None):
+        query = {
+          "method": method,
+          "args": args,
+          "kwargs": kwargs,
+          "options": options,
+          "label": label or method,
+          "streamed": bool(label or options.get("chunk_size")),
+          "queued": time(),
+          "deadline": None
+        }
+        # Canceling the deferred, for instance when the HTTP client of an
+        # API call gave up, drops the query from the queue or the traph
+        query["deferred"] = Deferred(canceller=lambda _: self._queryCanceled(query))
+        return query
+
+    def _clearDeadline(self, query):
+        if query["deadline"] and query["deadline"].active():
+            query["deadline"].cancel()
+        query["deadline"] = None
 
-    def reiterateMessage(self, deferred, iteratorId, *args, **kwargs):
-        self.iteratorQueue.put_nowait((deferred, "iterate_previous_query", [iteratorId], kwargs))
+    def _dropQuery(self, query):
+        # Removes a query from the queue or, when already sent, from the
+        # pending ones, and asks the traph to stop working on it
+        self._clearDeadline(query)
+        if self.queue.remove(query):
+            return
+        for queryId, pending in self.pending.items():
+            if pending is query:
+                del(self.pending[queryId])
+                self.canceled.add(queryId)
+                self.sendCancel(query=queryId)
+        self.corpus.call_running = bool(self.pending)
         self._sendMessageNow()
 
+    def _queryTimedOut(self, query, timeout):
+        query["deadline"] = None
+        self.corpus.log("WARNING: Traph query %s timed out after %ss, canceling it" % (query["label"], timeout))
+        self.corpus.metrics.record_cancel(query["label"], timeout=True)
+        self._dropQuery(query)
+        query["deferred"].callback({
+          "code": "fail",
+          "message": "Traph query %s timed out after %ss" % (query["label"], timeout)
+        })
+
+    def _queryCanceled(self, query):
+        if config["DEBUG"]:
+            self.corpus.log("Canceling traph query %s" % query["label"])
+        self.corpus.metrics.record_cancel(query["label"])
+        # Writes already sent are left to finish, their answer being ignored
+        if method_writes(query["method"], query["args"]) and any(q is query for q in self.pending.values()):
+            return
+        self._dropQuery(query)
+
+    def sendCancel(self, **kwargs):
+        # Sent right away without going through the queue
+        if self.corpus.status != "ready":
+            return
+        query = self._newQuery("cancel", [], kwargs)
+        if "query" in kwargs:
+            query["deferred"].addCallback(lambda _: self.canceled.discard(kwargs["query"]))
+        return self._sendQuery(query)
+
     def _sendMessageNow(self):
-        if self.queue.empty() and self.iteratorQueue.empty():
+        if self.corpus.status != "ready":
             return
+        while len(self.pending) < self.max_simultaneous_queries:
+            # Always keep a slot free for interactive queries
+            if len(self.pending) < self.max_simultaneous_queries - 1:
+                classes = PRIORITY_CLASSES
+            else:
+                classes = PRIORITY_CLASSES[:1]
+            if self.queue.empty(classes):
+                break
+            query = self.queue.get_nowait(classes)
+            if config["DEBUG"]:
+                self.corpus.log("Traph client query: %s %s %s" % (query["method"], lightLogVar(query["args"]), lightLogVar(query["kwargs"])))
+            if query["method"] == "clear":
+                self.corpus.log("Dropping cleared traph queued queries: %s calls" % self.queue.len())
+                self.queue.drop()
+            self._sendQuery(query)
+
+    def _sendQuery(self, query):
+        queryId = next(self.query_ids)
+        self.pending[queryId] = query
         self.corpus.call_running = True
-        if not self.iteratorQueue.empty() and (
-          self.queue.empty() or "iterate_previous_query" not in self.last_queries
-        ):
-            queue = self.iteratorQueue
-        else: queue = self.queue
-        self.deferred, method, args, kwargs = queue.get_nowait()
-        if config["DEBUG"] and (method != "iterate_previous_query" or config["DEBUG"] == 2):
-            self.corpus.log("Traph client query: %s %s %s" % (method, lightLogVar(args), lightLogVar(kwargs)))
-        self.last_query = {
-          "method": method,
-          "args": args,
-          "kwargs": kwargs
+        msg = {
+          "id": queryId,
+          "method": query["method"],
+          "args": query["args"],
+          "kwargs": query["kwargs"]
         }
-        self.last_queries.append(method)
-        if method == "clear":
-            self.corpus.log("Dropping cleared traph queued queries: %s calls & %s iterative calls" % (self.queue.len(), self.iteratorQueue.len()))
-            self.iteratorQueue.drop()
-            self.queue.drop()
-        self.start_query = time()
-        self.sendLine(msgpack.packb(self.last_query))
+        msg.update(query["options"])
+        query["start"] = time()
+        query["bytes_out"] = self.sendPacked(msg)
+        return query["deferred"]
 
     def lineLengthExceeded(self, line):
-        self.corpus.log("Line length (%s) exceeded limit (%s) on UNIX socket: %s %s" % (len(line), self.MAX_LENGTH, type(e), e), True)
+        self.corpus.log("Line length (%s) exceeded limit (%s) on UNIX socket" % (len(line), self.MAX_LENGTH), True)
+
+    def frameLengthExceeded(self, length):
+        self.corpus.log("Frame length (%s) exceeded limit (%s) on UNIX socket" % (length, self.MAX_LENGTH), True)
+        self.transport.loseConnection()
 
-    def lineReceived(self, data):
+    def messageDecodingFailed(self, e, length, queryId):
         self.corpus.lastcall = time()
-        try:
-            msg = msgpack.unpackb(data)
+        error = "%s: %s - Received badly formatted data of length %s" % (type(e), e, length)
+        if queryId in self.pending:
+            query = self.pending.pop(queryId)
+            self.corpus.log("WARNING: %s answering %s" % (error, query["method"]))
+            self._clearDeadline(query)
+            query["deferred"].callback({
+              "code": "fail",
+              "message": "%s answering %s" % (error, query["method"])
+            })
+        elif queryId in self.canceled:
+            self.canceled.discard(queryId)
+        elif self.pending:
+            # Without a readable id we cannot know which query this was answering
+            return self._dropConnection(error)
+        self.corpus.call_running = bool(self.pending)
+        self._sendMessageNow()
+
+    def messageReceived(self, msg):
+        self.corpus.lastcall = time()
+        if msg.get("id") is None and msg.get("code") == "fail" and self.pending:
+            # Servers older than query ids refuse the framing negotiation
+            # without one, other errors without id cannot be matched to
+            # a query unless only one is running
+            if len(self.pending) > 1:
+                return self._dropConnection("Traph error without query id: %s" % msg.get("message"))
+            msg["id"] = self.pending.keys()[0]
+        query = self.pending.pop(msg.get("id"), None)
+        if query is None and msg.get("id") in self.canceled:
+            # Answer of a query finished before its cancel reached the traph
+            self.canceled.discard(msg.get("id"))
+            if isinstance(msg.get("result"), dict) and "shm" in msg["result"]:
+                remove_block(msg["result"]["shm"])
+        elif query is None:
+            self.corpus.log("Received answer from Traph for unknown query id %s: %s" % (msg.get("id"), lightLogVar(msg)), True)
+        else:
             if config["DEBUG"]:
-                exec_time = time() - self.start_query
+                exec_time = time() - query["start"]
                 if exec_time > 1:
-                    self.corpus.log("WARNING: query took a long time! (%ss) %s %s %s" % (exec_time, self.last_query["method"], lightLogVar(self.last_query["args"]), lightLogVar(self.last_query["kwargs"])))
+                    self.corpus.log("WARNING: query took a long time! (%ss) %s %s %s" % (exec_time, query["method"], lightLogVar(query["args"]), lightLogVar(query["kwargs"])))
             if config["DEBUG"] == 2:
                 self.corpus.log("Traph server answer: %s" % lightLogVar(msg))
-            if "iterator" in msg:
-                return self.reiterateMessage(self.deferred, msg["iterator"])
-            self.deferred.callback(msg)
-        except (msgpack.exceptions.ExtraData, msgpack.exceptions.UnpackValueError) as e:
-            error = "%s: %s - Received badly formatted data of length %s in answer to %s %s %s" % (type(e), e, len(data), self.last_query["method"], lightLogVar(self.last_query["args"]), lightLogVar(self.last_query["kwargs"]))
-            self.corpus.log(error, True)
-            if self.deferred:
-                self.deferred.errback(Exception(error))
-        self.corpus.call_running = False
-        self.deferred = None
+            self.corpus.metrics.record_query(query["label"], query["start"] - query["queued"], time() - query["start"], query["bytes_out"], self.received_size, msg)
+            # Streamed calls are accounted for as a whole by TraphFactory.stream
+            if not query["streamed"]:
+                self.corpus.metrics.record_call(query["label"], 1, msg.get("iterations"))
+            self._clearDeadline(query)
+            query["deferred"].callback(msg)
+        self.corpus.call_running = bool(self.pending)
         self._sendMessageNow()
 
 
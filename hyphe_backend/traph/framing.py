@@ -0,0 +1,164 @@
+import msgpack
+from struct import Struct
+from twisted.protocols.basic import LineOnlyReceiver
+
+# Framing modes of msgpack messages on the traph UNIX socket:
+# - "line": messages are separated by a delimiter (historic default, still
+#   used until both peers agree to switch)
+# - "length-prefixed": each message is preceded by its size as a 4 bytes
+#   big-endian unsigned int and streamed into a msgpack Unpacker as it comes
+LINE_FRAMING = "line"
+LENGTH_PREFIXED_FRAMING = "length-prefixed"
+FRAMINGS = [LINE_FRAMING, LENGTH_PREFIXED_FRAMING]
+
+DECODING_ERRORS = (
+  msgpack.exceptions.ExtraData,
+  msgpack.exceptions.UnpackValueError,
+  msgpack.exceptions.OutOfData
+)
+
+# Messages are packed with their id first, so that the id of a message
+# which cannot be decoded can still be read from its first bytes
+ID_HEAD_SIZE = 32
+
+
+def pack_message(msg):
+    if isinstance(msg, dict) and "id" in msg:
+        return msgpack.Packer().pack_map_pairs([("id", msg["id"])] + [(k, v) for k, v in msg.iteritems() if k != "id"])
+    return msgpack.packb(msg)
+
+def read_message_id(head):
+    # Returns the id found at the start of a packed message, or None
+    unpacker = msgpack.Unpacker()
+    unpacker.feed(head)
+    try:
+        if unpacker.read_map_header() and unpacker.unpack() == "id":
+            queryId = unpacker.unpack()
+            if isinstance(queryId, (int, long)):
+                return queryId
+    except DECODING_ERRORS:
+        pass
+    return None
+
+
+class MsgPackReceiver(LineOnlyReceiver):
+
+    delimiter = b"\r\n##TxHypheMsgPackDelimiter\r\n"
+    MAX_LENGTH = 536870912
+    prefix = Struct("!I")
+
+    framing = LINE_FRAMING
+    _header = b""
+    _frame_size = 0
+    _frame_left = None
+    _frame_head = b""
+    _unpacker = None
+    # Size of the message being handled by messageReceived
+    received_size = 0
+
+    def setFraming(self, framing):
+        if framing not in FRAMINGS:
+            raise ValueError("Unknown framing %s" % framing)
+        self.framing = framing
+        self._resetFrame()
+
+    def _resetFrame(self):
+        self._header = b""
+        self._frame_left = None
+        self._frame_head = b""
+        self._unpacker = msgpack.Unpacker(max_buffer_size=self.MAX_LENGTH)
+
+    def sendPacked(self, msg):
+        # Returns the size of the packed message
+        data = pack_message(msg)
+        if self.framing == LINE_FRAMING:
+            self.sendLine(data)
+        else:
+            self.transport.writeSequence((self.prefix.pack(len(data)), data))
+        return len(data)
+
+    def dataReceived(self, data):
+        if self.framing != LINE_FRAMING:
+            return self._framesReceived(data)
+        lines = (self._buffer + data).split(self.delimiter)
+        self._buffer = lines.pop(-1)
+        for i, line in enumerate(lines):
+            if self.transport.disconnecting:
+                return
+            if len(line) > self.MAX_LENGTH:
+                return self.lineLengthExceeded(line)
+            self.lineReceived(line)
+            # A message can switch framing, the rest then has to be read as frames
+            if self.framing != LINE_FRAMING:
+                rest = self.delimiter.join(lines[i+1:] + [self._buffer])
+                self._buffer = b""
+                return self._framesReceived(rest)
+        if len(self._buffer) > self.MAX_LENGTH:
+            return self.lineLengthExceeded(self._buffer)
+
+    def _framesReceived(self, data):
+        offset = 0
+        while offset < len(data):
+            if self.transport.disconnecting:
+                return
+            if self._frame_left is None:
+                needed = self.prefix.size - len(self._header)
+                self._header += data[offset:offset+needed]
+                offset += needed
+                if len(self._header) < self.prefix.size:
+                    return
+                self._frame_size = self.prefix.unpack(self._header)[0]
+                self._frame_left = self._frame_size
+                self._header = b""
+                if not self._frame_size or self._frame_size > self.MAX_LENGTH:
+                    return self.frameLengthExceeded(self._frame_size)
+            # Feed the payload to the unpacker as it comes instead of
+            # accumulating the whole message before decoding it
+            chunk = data[offset:offset+self._frame_left]
+            offset += len(chunk)
+            if len(self._frame_head) < ID_HEAD_SIZE:
+                self._frame_head += chunk[:ID_HEAD_SIZE - len(self._frame_head)]
+            self._frame_left -= len(chunk)
+            self._unpacker.feed(chunk)
+            if self._frame_left:
+                return
+            self._frame_left = None
+            head = self._frame_head
+            self._frame_head = b""
+            try:
+                msg = self._unpacker.unpack()
+                try:
+                    self._unpacker.unpack()
+                    raise msgpack.exceptions.ExtraData(msg, None)
+                except msgpack.exceptions.OutOfData:
+                    pass
+            except DECODING_ERRORS as e:
+                # Frames are delimited independently from their content, so
+                # one corrupted message does not break the following ones
+                self._unpacker = msgpack.Unpacker(max_buffer_size=self.MAX_LENGTH)
+                self.messageDecodingFailed(e, self._frame_size, read_message_id(head))
+                continue
+            self.received_size = self._frame_size
+            self.messageReceived(msg)
+
+    def lineReceived(self, line):
+        try:
+            msg = msgpack.unpackb(line)
+        except DECODING_ERRORS as e:
+            return self.messageDecodingFailed(e, len(line), read_message_id(line[:ID_HEAD_SIZE]))
+        self.received_size = len(line)
+        self.messageReceived(msg)
+
+    def messageReceived(self, msg):
+        # Called with each decoded message, ignored unless the protocols
+        # handle them
+        pass
+
+    def messageDecodingFailed(self, error, length, queryId):
+        # Called instead of messageReceived with messages which could not
+        # be decoded, along with their id when it could still be read,
+        # ignored unless the protocols answer them
+        pass
+
+    def frameLengthExceeded(self, length):
+        return self.transport.loseConnection()
@@ -0,0 +1,126 @@
+from time import time
+from bisect import bisect_left
+
+# Upper bounds of the histograms buckets, the last one catching the rest
+TIME_BUCKETS = [0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300]
+BYTES_BUCKETS = [256 * 4**i for i in range(12)]
+COUNT_BUCKETS = [1, 2, 5, 10, 50, 100, 500, 1000, 5000, 10000]
+
+
+class Histogram(object):
+
+    def __init__(self, buckets):
+        self.bounds = buckets
+        self.buckets = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0
+        self.min = None
+        self.max = None
+
+    def add(self, value):
+        self.buckets[bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+        if self.min is None or value < self.min:
+            self.min = value
+        if self.max is None or value > self.max:
+            self.max = value
+
+    def percentile(self, p):
+        # Upper bound of the bucket holding the p-th percentile
+        if not self.count:
+            return None
+        threshold = self.count * p / 100.
+        total = 0
+        for bound, n in zip(self.bounds + [self.max], self.buckets):
+            total += n
+            if total >= threshold:
+                return min(bound, self.max)
+        return self.max
+
+    def json(self):
+        return {
+          "count": self.count,
+          "sum": self.sum,
+          "mean": float(self.sum) / self.count if self.count else None,
+          "min": self.min,
+          "max": self.max,
+          "p50": self.percentile(50),
+          "p95": self.percentile(95),
+          "buckets": [[b, n] for b, n in zip(self.bounds + [None], self.buckets) if n]
+        }
+
+
+class MethodMetrics(object):
+
+    def __init__(self):
+        self.calls = 0
+        self.errors = 0
+        self.timeouts = 0
+        self.cancels = 0
+        self.histograms = {
+          "queue_wait": Histogram(TIME_BUCKETS),
+          "exec_time": Histogram(TIME_BUCKETS),
+          "total_time": Histogram(TIME_BUCKETS),
+          "iterations": Histogram(COUNT_BUCKETS),
+          "round_trips": Histogram(COUNT_BUCKETS),
+          "bytes_out": Histogram(BYTES_BUCKETS),
+          "bytes_in": Histogram(BYTES_BUCKETS)
+        }
+
+    def add(self, key, value):
+        if value is not None:
+            self.histograms[key].add(value)
+
+    def json(self):
+        res = {
+          "calls": self.calls,
+          "errors": self.errors,
+          "timeouts": self.timeouts,
+          "cancels": self.cancels
+        }
+        for key, histogram in self.histograms.items():
+            res[key] = histogram.json()
+        return res
+
+
+class TraphMetrics(object):
+    """Histograms of the dialogue between a corpus and its traph, by method"""
+
+    def __init__(self):
+        self.methods = {}
+        self.since = time()
+
+    def method(self, method):
+        if method not in self.methods:
+            self.methods[method] = MethodMetrics()
+        return self.methods[method]
+
+    def record_query(self, method, queue_wait, total_time, bytes_out, bytes_in, answer):
+        metrics = self.method(method)
+        if answer.get("code") == "fail":
+            metrics.errors += 1
+        metrics.add("queue_wait", queue_wait)
+        metrics.add("total_time", total_time)
+        metrics.add("exec_time", answer.get("time"))
+        metrics.add("bytes_out", bytes_out)
+        metrics.add("bytes_in", bytes_in)
+
+    def record_call(self, method, round_trips, iterations=None):
+        metrics = self.method(method)
+        metrics.calls += 1
+        metrics.add("round_trips", round_trips)
+        metrics.add("iterations", iterations)
+
+    def record_cancel(self, method, timeout=False):
+        metrics = self.method(method)
+        if timeout:
+            metrics.timeouts += 1
+        else:
+            metrics.cancels += 1
+
+    def json(self):
+        return {
+          "since": int(self.since * 1000),
+          "methods": dict((m, metrics.json()) for m, metrics in self.methods.items())
+        }
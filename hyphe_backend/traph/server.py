@@ -1,86 +1,453 @@
 import os, sys, json, msgpack
 from time import time
+from collections import deque, defaultdict, Counter
 from types import GeneratorType
+from itertools import groupby
+from operator import itemgetter
 from traph import Traph, TraphException, TraphWriteReport, TraphIteratorState
 from warnings import filterwarnings
 filterwarnings(action='ignore', message="Python 2 is no longer supported by the Python core team")
 from twisted.internet import reactor
 from twisted.internet.protocol import Factory
 from twisted.internet.endpoints import UNIXServerEndpoint
-from twisted.protocols.basic import LineOnlyReceiver
+from framing import MsgPackReceiver, FRAMINGS
+from sharedblock import LinksColumns, write_links_block
 
 class TraphIterator(object):
 
-    def __init__(self, iteratorId, iterator, query):
+    def __init__(self, iteratorId, iterator, query, queryId=None, chunked=False):
         self.id = iteratorId
         self.iter = iterator
         self.query = query
+        self.queryId = queryId
+        self.chunked = chunked
+        self.n_chunks = 0
+        # Chunked queries wait for the client to ask for each next chunk
+        self.waiting = False
         self.n_iterations = 0
         self.iteration_time = 0
         self.total_time = 0
+        # Time spent computing since the last chunk sent
+        self.chunk_time = 0
 
-class TraphProtocol(LineOnlyReceiver):
+class TraphChunk(object):
 
-    delimiter = b"\r\n##TxHypheMsgPackDelimiter\r\n"
-    MAX_LENGTH = 536870912
+    def __init__(self, data):
+        self.data = data
+
+
+# Generators streaming large results in chunks of bounded size instead of
+# building them whole, they yield TraphChunks, in between unfinished
+# TraphIteratorStates every so many steps as the traph's own iterators do,
+# so that other queries run meanwhile even when few results are found.
+
+def stream_webentity_pages(traph, chunk_size, weid, prefixes, crawled_only=False):
+    state = TraphIteratorState()
+    chunk = []
+    for node, lru in traph.webentity_page_nodes_iter(weid, prefixes):
+        crawled = node.is_crawled()
+        if not crawled_only or crawled:
+            chunk.append({
+              "lru": lru,
+              "crawled": crawled
+            })
+        if len(chunk) >= chunk_size:
+            yield TraphChunk(chunk)
+            chunk = []
+        elif state.should_yield(2000):
+            yield state
+    if chunk:
+        yield TraphChunk(chunk)
+
+def stream_webentity_crawled_pages(traph, chunk_size, weid, prefixes):
+    return stream_webentity_pages(traph, chunk_size, weid, prefixes, crawled_only=True)
+
+def stream_webentity_pagelinks(traph, chunk_size, weid, prefixes, include_inbound=False, include_internal=True, include_outbound=False):
+    if not include_internal and not include_outbound and not include_inbound:
+        raise TraphException('At least one of include _internal or include_outbound or include_inbound should be true')
+    state = TraphIteratorState()
+    chunk = []
+    other_node = traph.lru_trie.node()
+    for node, lru in traph.webentity_page_nodes_iter(weid, prefixes):
+        if node.has_outlinks() and (include_outbound or include_internal):
+            for target, weight in traph.link_store.weighted_link_nodes_iter(node.outlinks()):
+                other_node.read(target)
+                target_webentity = traph.lru_trie.windup_lru_for_webentity(other_node)
+                if (include_outbound and target_webentity != weid) or (include_internal and target_webentity == weid):
+                    chunk.append([lru, traph.lru_trie.windup_lru(other_node.block), weight])
+                if len(chunk) >= chunk_size:
+                    yield TraphChunk(chunk)
+                    chunk = []
+                elif state.should_yield(5000):
+                    yield state
+        if node.has_inlinks() and include_inbound:
+            for source, weight in traph.link_store.weighted_link_nodes_iter(node.inlinks()):
+                other_node.read(source)
+                source_webentity = traph.lru_trie.windup_lru_for_webentity(other_node)
+                if source_webentity != weid:
+                    chunk.append([traph.lru_trie.windup_lru(other_node.block), lru, weight])
+                if len(chunk) >= chunk_size:
+                    yield TraphChunk(chunk)
+                    chunk = []
+                elif state.should_yield(5000):
+                    yield state
+        if state.should_yield(5000):
+            yield state
+    if chunk:
+        yield TraphChunk(chunk)
+
+def webentities_inlinks_iter(traph, include_auto=False):
+    # Same links as the traph's get_webentities_inlinks_iter, but yielded as
+    # (target, {source: weight}) one target webentity at a time instead of
+    # aggregated whole: the pages holding inlinks are grouped by webentity
+    # once all pages are solved to their webentity
+    state = TraphIteratorState()
+    page_to_webentity = {}
+    pages = defaultdict(Counter)
+    link_pointers = []
+    for node, webentity in traph.lru_trie.dfs_with_webentity_iter():
+        if not node.is_page() or not webentity:
+            continue
+        pages[webentity]["pages_crawled" if node.is_crawled() else "pages_uncrawled"] += 1
+        page_to_webentity[node.block] = webentity
+        if node.has_links(out=False):
+            link_pointers.append((webentity, node.links(out=False)))
+        if state.should_yield():
+            yield state
+    link_pointers.sort()
+    yield state
+    for target, pointers in groupby(link_pointers, itemgetter(0)):
+        sources = Counter()
+        for _, links_block in pointers:
+            for source, weight in traph.link_store.weighted_link_nodes_iter(links_block):
+                source_webentity = page_to_webentity.get(source)
+                if not source_webentity or (not include_auto and source_webentity == target):
+                    continue
+                sources[source_webentity] += weight
+                if state.should_yield(5000):
+                    yield state
+        sources.update(pages.pop(target))
+        yield target, dict(sources)
+    # Webentities whose pages have no inlinks only carry their pages counts
+    while pages:
+        target, counts = pages.popitem()
+        yield target, dict(counts)
+
+def stream_webentities_inlinks(traph, chunk_size, include_auto=False):
+    # Links between webentities are sent by groups of targets totalling
+    # about chunk_size links as soon as they are aggregated
+    chunk = {}
+    n_links = 0
+    for item in webentities_inlinks_iter(traph, include_auto=include_auto):
+        if isinstance(item, TraphIteratorState):
+            yield item
+            continue
+        target, sources = item
+        chunk[target] = sources
+        n_links += len(sources)
+        if n_links >= chunk_size:
+            yield TraphChunk(chunk)
+            chunk = {}
+            n_links = 0
+    if chunk:
+        yield TraphChunk(chunk)
+
+def shared_webentities_inlinks(traph, include_auto=False):
+    # Same links as get_webentities_inlinks, written in a shared links block
+    # whose path only is sent back to the client
+    state = TraphIteratorState()
+    links = LinksColumns()
+    for item in webentities_inlinks_iter(traph, include_auto=include_auto):
+        if isinstance(item, TraphIteratorState):
+            yield item
+        else:
+            links.add(*item)
+    path, n_links = write_links_block(links)
+    yield state.finalize({
+      "shm": path,
+      "links": n_links
+    })
+
+def index_batch_crawl_links_deltas(traph, data, yield_frequency=50, groups=None):
+    # Indexes a batch of crawled pages like index_batch_crawl and adds to its
+    # report how the links and pages counts between webentities changed, in
+    # the same shape as get_webentities_inlinks, unless webentities created
+    # within existing ones took some of their pages, which requires a rebuild
+    # When groups of the batch's crawled pages are given, for instance by
+    # crawl job, the pages created are also counted by the first group
+    # holding or linking them
+    lru_trie = traph.lru_trie
+    state = TraphIteratorState()
+    encode = lambda lru: lru.encode(traph.encoding) if isinstance(lru, unicode) else lru
+    pages = set()
+    for source, targets in data.items():
+        pages.add(encode(source))
+        pages.update(encode(target) for target in targets)
+    previous = {}
+    for lru in pages:
+        node = lru_trie.lru_node(lru)
+        previous[lru] = node is not None and node.is_page(), node is not None and node.is_crawled()
+        if state.should_yield(yield_frequency * 10):
+            yield state
+    for substate in traph.index_batch_crawl_iter(data, yield_frequency):
+        if substate.done:
+            break
+        yield state
+    report = substate.result.__dict__()
+    if groups:
+        created = set(lru for lru, (existed, _) in previous.items() if not existed)
+        report["created_pages_by_group"] = {}
+        for group, sources in groups.items():
+            report["created_pages_by_group"][group] = 0
+            for source in sources:
+                for lru in [source] + list(data.get(source, [])):
+                    lru = encode(lru)
+                    if lru in created:
+                        created.remove(lru)
+                        report["created_pages_by_group"][group] += 1
+    report["webentities_links"] = {}
+    report["structural"] = False
+    for weid, prefixes in report["created_webentities"].items():
+        for prefix in prefixes:
+            node = lru_trie.lru_node(encode(prefix))
+            if node and any(parent.has_webentity() and parent.webentity() != weid for parent in lru_trie.node_parents_iter(node)):
+                report["structural"] = True
+                yield state.finalize(report)
+                return
+    webentities = {}
+    deltas = defaultdict(Counter)
+    for lru in pages:
+        node = lru_trie.lru_node(lru)
+        weid = webentities[lru] = lru_trie.windup_lru_for_webentity(node)
+        if not weid:
+            continue
+        existed, crawled = previous[lru]
+        if not existed:
+            deltas[weid]["pages_crawled" if node.is_crawled() else "pages_uncrawled"] += 1
+        elif not crawled and node.is_crawled():
+            deltas[weid]["pages_uncrawled"] -= 1
+            deltas[weid]["pages_crawled"] += 1
+        if state.should_yield(yield_frequency * 10):
+            yield state
+    # Each indexed page link adds 1 to the weight of its webentities link
+    for source, targets in data.items():
+        source_weid = webentities[encode(source)]
+        if not source_weid:
+            continue
+        for target in targets:
+            target_weid = webentities[encode(target)]
+            if target_weid and target_weid != source_weid:
+                deltas[target_weid][source_weid] += 1
+    report["webentities_links"] = deltas
+    yield state.finalize(report)
+
+def run_batch(traph, calls):
+    # Runs a list of method calls within a single query and returns the list
+    # of their results or errors, yielding in between the steps of the
+    # iterative ones so that the batch is scheduled like any iterator
+    state = TraphIteratorState()
+    results = []
+    for call in calls:
+        try:
+            method = call["method"]
+            if method in ["batch", "cancel", "clear", "iterate_previous_query", "set_framing"]:
+                raise ValueError("Method %s cannot be batched" % method)
+            iter_method = "%s_iter" % method
+            if hasattr(Traph, iter_method):
+                method = iter_method
+            fct = getattr(Traph, method)
+            res = fct(traph, *call.get("args", []), **call.get("kwargs", {}))
+            if type(res) == GeneratorType:
+                for substate in res:
+                    if substate.done:
+                        break
+                    yield state
+                res = substate.result
+            if isinstance(res, TraphWriteReport):
+                res = res.__dict__()
+            results.append({
+              "code": "success",
+              "result": res
+            })
+        except KeyError as e:
+            results.append({"code": "fail", "message": "Argument missing from batched query: %s" % str(e)})
+        except AttributeError as e:
+            results.append({"code": "fail", "message": "Called non existing Traph method: %s" % str(e)})
+        except TraphException as e:
+            results.append({"code": "fail", "message": "Traph raised: %s" % str(e)})
+        except Exception as e:
+            results.append({"code": "fail", "message": str(e)})
+    yield state.finalize(results)
+
+STREAMED_METHODS = {
+  "get_webentity_pages": stream_webentity_pages,
+  "get_webentity_crawled_pages": stream_webentity_crawled_pages,
+  "get_webentity_pagelinks": stream_webentity_pagelinks,
+  "get_webentities_inlinks": stream_webentities_inlinks
+}
+
+# Methods whose result can be transferred as a shared memory block
+SHARED_METHODS = {
+  "get_webentities_inlinks": shared_webentities_inlinks
+}
+
+class TraphProtocol(MsgPackReceiver):
 
     def __init__(self, traph):
         self.traph = traph
         self.iterators = {}
+        # Iterative queries sent with an id are run here step by step in
+        # turns, so that other queries can be answered in between
+        self.scheduled_iterators = deque()
+        self.next_iteration = None
 
     def connectionMade(self):
         pass
 
     def connectionLost(self, reason):
-        pass
+        if self.next_iteration and self.next_iteration.active():
+            self.next_iteration.cancel()
+        self.next_iteration = None
+        self.scheduled_iterators.clear()
+        self.iterators = {}
+
+    def sendAnswer(self, msg, queryId=None):
+        if queryId is not None:
+            msg["id"] = queryId
+        self.sendPacked(msg)
 
-    def returnResult(self, res, query):
+    def returnResult(self, res, query, queryId=None, exec_time=None, iterations=None):
         if isinstance(res, TraphWriteReport):
             res = res.__dict__()
-        self.sendLine(msgpack.packb({
+        msg = {
           "code": "success",
           "result": res,
           "query": query
-        }))
+        }
+        # Execution stats used by the client's metrics
+        if exec_time is not None:
+            msg["time"] = exec_time
+        if iterations is not None:
+            msg["iterations"] = iterations
+        self.sendAnswer(msg, queryId)
 
     def returnIterator(self, iterator, iteratorState):
-        self.sendLine(msgpack.packb({
+        self.sendAnswer({
           "code": "success",
           "iterator": iterator.id,
           "iterations": iterator.n_iterations,
           "atomic_iterations": iteratorState.n_iterations,
           "iteration_time": iterator.iteration_time,
           "query": iterator.query
-        }))
+        })
+
+    def returnChunk(self, iterator, data):
+        self.sendAnswer({
+          "code": "success",
+          "result": data,
+          "iterator": iterator.id,
+          "chunk": iterator.n_chunks,
+          "time": iterator.chunk_time,
+          "iterations": iterator.n_iterations,
+          "query": iterator.query
+        }, iterator.queryId)
+        iterator.chunk_time = 0
 
-    def returnError(self, msg, query):
-        self.sendLine(msgpack.packb({
+    def returnError(self, msg, query, queryId=None):
+        self.sendAnswer({
           "code": "fail",
           "message": msg,
           "query": query
-        }))
+        }, queryId)
 
     def iterate(self, iteratorId):
+        # Runs one step of an iterative query, returns whether it still has some left
         iterator = self.iterators[iteratorId]
         try:
             start_time = time()
             state = next(iterator.iter)
             iterator.iteration_time = time() - start_time
             iterator.total_time += iterator.iteration_time
+            iterator.chunk_time += iterator.iteration_time
             iterator.n_iterations += 1
         except StopIteration:
             del(self.iterators[iteratorId])
-            return self.returnError("Tried to iterate on already closed iterative query!", iterator.query)
+            if iterator.chunked:
+                self.returnResult(None, {"method": iterator.query, "total_time": iterator.total_time, "chunks": iterator.n_chunks}, iterator.queryId, iterator.chunk_time, iterator.n_iterations)
+            else:
+                self.returnError("Tried to iterate on already closed iterative query!", iterator.query, iterator.queryId)
+            return False
+        except TraphException as e:
+            del(self.iterators[iteratorId])
+            self.returnError("Traph raised: %s" % str(e), iterator.query, iterator.queryId)
+            return False
+        except Exception as e:
+            del(self.iterators[iteratorId])
+            self.returnError(str(e), iterator.query, iterator.queryId)
+            return False
+        if isinstance(state, TraphChunk):
+            iterator.n_chunks += 1
+            iterator.waiting = True
+            self.returnChunk(iterator, state.data)
+            return False
         if not state.done:
-            return self.returnIterator(iterator, state)
+            # Legacy clients without query ids drive iterations themselves
+            if iterator.queryId is None:
+                self.returnIterator(iterator, state)
+            return True
         del(self.iterators[iteratorId])
-        return self.returnResult(state.result, {"method": iterator.query, "total_time": iterator.total_time})
+        self.returnResult(state.result, {"method": iterator.query, "total_time": iterator.total_time}, iterator.queryId, iterator.total_time, iterator.n_iterations)
+        return False
 
-    def lineReceived(self, query):
-        try:
-            query = msgpack.unpackb(query)
-        except (msgpack.exceptions.ExtraData, msgpack.exceptions.UnpackValueError) as e:
-            return self.returnError("Query is not a valid JSON object: %s" % str(e), query)
+    def startIterator(self, iterator, method, queryId, chunked=False):
+        iteratorId = id(iterator)
+        self.iterators[iteratorId] = TraphIterator(iteratorId, iterator, method, queryId, chunked=chunked)
+        if queryId is None:
+            return self.iterate(iteratorId)
+        return self.scheduleIterator(iteratorId)
+
+    def scheduleIterator(self, iteratorId):
+        self.scheduled_iterators.append(iteratorId)
+        if not self.next_iteration:
+            self.next_iteration = reactor.callLater(0, self.iterateScheduled)
+
+    def iterateScheduled(self):
+        # Round-robin on pending iterative queries, one step each, giving
+        # back the hand to the reactor in between to read new queries
+        self.next_iteration = None
+        if not self.scheduled_iterators:
+            return
+        iteratorId = self.scheduled_iterators.popleft()
+        if iteratorId in self.iterators and self.iterate(iteratorId):
+            self.scheduled_iterators.append(iteratorId)
+        if self.scheduled_iterators:
+            self.next_iteration = reactor.callLater(0, self.iterateScheduled)
+
+    def cancelIterator(self, query=None, iterator=None):
+        # Drops the iterative query run for the client query id or with the
+        # given iterator id, the client does not wait for its answer anymore
+        for iteratorId, it in self.iterators.items():
+            if iteratorId == iterator or (query is not None and it.queryId == query):
+                del(self.iterators[iteratorId])
+                try:
+                    it.iter.close()
+                except Exception as e:
+                    print >> sys.stderr, "WARNING could not close canceled iterator %s: %s" % (it.query, e)
+                return True
+        return False
+
+    def dropIterators(self, reason):
+        for iteratorId, iterator in self.iterators.items():
+            if iterator.queryId is not None and not iterator.waiting:
+                self.returnError(reason, iterator.query, iterator.queryId)
+        self.iterators = {}
+        self.scheduled_iterators.clear()
+
+    def messageDecodingFailed(self, error, length, queryId):
+        self.returnError("Query is not a valid JSON object: %s" % str(error), None, queryId)
+
+    def messageReceived(self, query):
+        queryId = query.get("id") if isinstance(query, dict) else None
         try:
             method = query["method"]
             iter_method = "%s_iter" % method
@@ -88,33 +455,70 @@ class TraphProtocol(LineOnlyReceiver):
                 method = iter_method
             args = query["args"]
             kwargs = query["kwargs"]
-        except KeyError as e:
-            return self.returnError("Argument missing from JSON query: %s" % str(e), query)
+        except (KeyError, TypeError) as e:
+            return self.returnError("Argument missing from JSON query: %s" % str(e), query, queryId)
         if method == "iterate_previous_query":
             if not args:
-                return self.returnError("No iterator id given.", query)
+                return self.returnError("No iterator id given.", query, queryId)
             if args[0] not in self.iterators:
-                return self.returnError("No iterator pending with id %s." % args[0], query)
+                return self.returnError("No iterator pending with id %s." % args[0], query, queryId)
+            iterator = self.iterators[args[0]]
+            if iterator.chunked:
+                if not iterator.waiting:
+                    return self.returnError("Iterator %s is already preparing its next chunk." % args[0], query, queryId)
+                iterator.waiting = False
+                iterator.queryId = queryId
+                if queryId is not None:
+                    return self.scheduleIterator(args[0])
+            elif iterator.queryId is not None:
+                return self.returnError("Iterator %s is already run by the server." % args[0], query, queryId)
             return self.iterate(args[0])
+        # Framing negotiation: answer with the current framing then switch
+        if method == "set_framing":
+            if not args or args[0] not in FRAMINGS:
+                return self.returnError("Unsupported framing, choose one of %s." % ", ".join(FRAMINGS), query, queryId)
+            self.returnResult(args[0], query["method"], queryId)
+            return self.setFraming(args[0])
+        if method == "cancel":
+            return self.returnResult(self.cancelIterator(kwargs.get("query"), kwargs.get("iterator")), query["method"], queryId)
+        if method == "batch":
+            if not args or not isinstance(args[0], list):
+                return self.returnError("Batch queries require a list of calls as argument.", query, queryId)
+            return self.startIterator(run_batch(self.traph, args[0]), query["method"], queryId)
         try:
             fct = getattr(Traph, method)
         except AttributeError as e:
-            return self.returnError("Called non existing Traph method: %s" % str(e), query)
+            return self.returnError("Called non existing Traph method: %s" % str(e), query, queryId)
+        if method == "clear":
+            self.dropIterators("Iterative query canceled by a clear of the Traph")
+        chunk_size = query.get("chunk_size")
+        if chunk_size and query["method"] in STREAMED_METHODS:
+            res = STREAMED_METHODS[query["method"]](self.traph, int(chunk_size), *args, **kwargs)
+            return self.startIterator(res, query["method"], queryId, chunked=True)
+        if query.get("links_deltas") and query["method"] == "index_batch_crawl":
+            res = index_batch_crawl_links_deltas(self.traph, *args, **kwargs)
+            return self.startIterator(res, query["method"], queryId)
+        if query.get("transfer") == "shm" and query["method"] in SHARED_METHODS:
+            res = SHARED_METHODS[query["method"]](self.traph, *args, **kwargs)
+            return self.startIterator(res, query["method"], queryId)
         try:
+            start_time = time()
             res = fct(self.traph, *args, **kwargs)
             if type(res) == GeneratorType:
-                iteratorId = id(res)
-                self.iterators[iteratorId] = TraphIterator(iteratorId, res, query["method"])
-                return self.iterate(iteratorId)
+                return self.startIterator(res, query["method"], queryId)
         except TraphException as e:
-            return self.returnError("Traph raised: %s" % str(e), query)
+            return self.returnError("Traph raised: %s" % str(e), query, queryId)
         except Exception as e:
-            return self.returnError(str(e), query)
-        return self.returnResult(res, query["method"])
+            return self.returnError(str(e), query, queryId)
+        return self.returnResult(res, query["method"], queryId, time() - start_time)
 
     def lineLengthExceeded(self, line):
         print >> sys.stderr, "WARNING line length exceeded server side %s (max %s)" % (len(line), self.MAX_LENGTH)
 
+    def frameLengthExceeded(self, length):
+        print >> sys.stderr, "WARNING frame length exceeded server side %s (max %s)" % (length, self.MAX_LENGTH)
+        self.transport.loseConnection()
+
 
 class TraphServerFactory(Factory):
 
@@ -145,8 +549,18 @@ class TraphServerFactory(Factory):
         self.traph.close()
 
 if __name__ == "__main__":
-    sock = sys.argv[1]
-    corpus = sys.argv[2]
+    if sys.argv[1] == "--pool":
+        # Pooled process: everything is imported, wait for a corpus to open
+        print "WAITING"
+        assignment = sys.stdin.readline()
+        if not assignment:
+            sys.exit(0)
+        assignment = json.loads(assignment)
+        sock = assignment["socket"].encode("utf-8")
+        corpus = assignment["corpus"].encode("utf-8")
+    else:
+        sock = sys.argv[1]
+        corpus = sys.argv[2]
     try:
         with open(sock+"-options.json") as f:
             options = json.load(f)
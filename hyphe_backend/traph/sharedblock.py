@@ -0,0 +1,128 @@
+import os
+import mmap
+import tempfile
+from array import array
+from ctypes import c_int32, sizeof
+from itertools import count, izip
+from struct import Struct
+
+# Bulk results can be handed from the traph server to the core through a
+# memory-mapped file instead of the socket: the server writes a compact
+# binary block and only sends its path, the core maps it without decoding.
+#
+# Links blocks are made of a header followed by three parallel arrays of
+# native int32: sources, targets and weights of the webentity links.
+# The pages counts the traph adds to each webentity's inlinks are stored as
+# links from reserved negative sources.
+LINKS_MAGIC = b"HTLB"
+LINKS_VERSION = 1
+header = Struct("=4sII")
+INT_SIZE = sizeof(c_int32)
+STAT_KEYS = ["pages_crawled", "pages_uncrawled"]
+STAT_SOURCES = dict((key, -i - 1) for i, key in enumerate(STAT_KEYS))
+
+block_ids = count(1)
+
+def shared_dir():
+    # Prefer RAM-backed storage when the system provides it
+    if os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK):
+        return "/dev/shm"
+    return tempfile.gettempdir()
+
+class LinksColumns(object):
+    # Sources, targets and weights of webentity links gathered target by
+    # target to be written as a links block
+
+    def __init__(self):
+        self.sources = array("i")
+        self.targets = array("i")
+        self.weights = array("i")
+
+    def __len__(self):
+        return len(self.sources)
+
+    def add(self, target, target_sources):
+        for source, weight in target_sources.iteritems():
+            self.sources.append(STAT_SOURCES[source] if source in STAT_SOURCES else source)
+            self.targets.append(target)
+            self.weights.append(weight)
+
+def write_links_block(links, directory=None):
+    # Writes LinksColumns, or a {target: {source: weight}} dict emptied on
+    # the way, as a links block and returns its path and number of links
+    if not isinstance(links, LinksColumns):
+        columns = LinksColumns()
+        while links:
+            columns.add(*links.popitem())
+        links = columns
+    # Shared memory can be small (64MB by default in Docker containers),
+    # fallback on the temporary directory when the block does not fit
+    directories = [directory] if directory else [shared_dir(), tempfile.gettempdir()]
+    name = "hyphe-traph-%s-%s.links" % (os.getpid(), next(block_ids))
+    for directory in directories:
+        path = os.path.join(directory, name)
+        try:
+            # Only expose the block once complete
+            with open(path + ".tmp", "wb") as f:
+                f.write(header.pack(LINKS_MAGIC, LINKS_VERSION, len(links)))
+                links.sources.tofile(f)
+                links.targets.tofile(f)
+                links.weights.tofile(f)
+            os.rename(path + ".tmp", path)
+            return path, len(links)
+        except (IOError, OSError):
+            remove_block(path + ".tmp")
+            if directory == directories[-1]:
+                raise
+
+def remove_block(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+class LinksBlock(object):
+    """Webentity links read in place from a block written by the traph"""
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        # The mapping stays valid once the file is gone
+        remove_block(path)
+        magic, version, n_links = header.unpack_from(self.map)
+        if magic != LINKS_MAGIC or version != LINKS_VERSION:
+            self.close()
+            raise ValueError("Unsupported links block %s (version %s)" % (magic, version))
+        if len(self.map) != header.size + 3 * n_links * INT_SIZE:
+            self.close()
+            raise ValueError("Truncated links block, expected %s links" % n_links)
+        self.n_links = n_links
+        column = c_int32 * n_links
+        offset = header.size
+        self.sources = column.from_buffer(self.map, offset)
+        offset += n_links * INT_SIZE
+        self.targets = column.from_buffer(self.map, offset)
+        offset += n_links * INT_SIZE
+        self.weights = column.from_buffer(self.map, offset)
+
+    def __len__(self):
+        return self.n_links
+
+    def __iter__(self):
+        return izip(self.sources, self.targets, self.weights)
+
+    def to_dict(self):
+        links = {}
+        for source, target, weight in self:
+            if target not in links:
+                links[target] = {}
+            if source < 0:
+                source = STAT_KEYS[-source - 1]
+            links[target][source] = weight
+        return links
+
+    def close(self):
+        self.sources = self.targets = self.weights = None
+        if self.map:
+            self.map.close()
+            self.map = None